@@ -1,10 +1,16 @@
 """
 This module manages the low level parameters describing the mesh.
 """
-from morphic import interpolator
+from morphic import discretizer, interpolator
+import functools
 import string
 import random
 import numpy
+import scipy.sparse
+import scipy.special
+
+# Maximum number of quadrature basis weights kept by get_quadrature_weights
+QUADRATURE_CACHE_SIZE = 256
 
 
 def dimensions(basis):
@@ -17,6 +23,292 @@ def dimensions(basis):
     return dimensions
 
 
+def _freeze(*arrays):
+    for array in arrays:
+        array.flags.writeable = False
+    return list(arrays)
+
+
+def _gauss_key(ng):
+    if isinstance(ng, (list, tuple, numpy.ndarray)):
+        return tuple(int(n) for n in ng)
+    return int(ng)
+
+
+@functools.lru_cache(maxsize=None)
+def _gauss_legendre(ng):
+    if ng < 1:
+        raise ValueError('Invalid number of gauss points')
+    x, w = numpy.polynomial.legendre.leggauss(ng)
+    return _freeze(0.5 * (x + 1.)[:, numpy.newaxis], 0.5 * w)
+
+
+@functools.lru_cache(maxsize=None)
+def _gauss_tensor(ngs):
+    # xi1 varies fastest, consistent with the element node ordering
+    rules = [_gauss_legendre(ng) for ng in ngs[::-1]]
+    Xig = numpy.meshgrid(*[rule[0][:, 0] for rule in rules], indexing='ij')
+    Wg = numpy.meshgrid(*[rule[1] for rule in rules], indexing='ij')
+    Xi = numpy.array([xi.flatten() for xi in Xig[::-1]]).T
+    W = numpy.prod([w.flatten() for w in Wg], axis=0)
+    return _freeze(Xi, W)
+
+
+@functools.lru_cache(maxsize=None)
+def _gauss_triangle(ng):
+    # Collapsed coordinates, xi1 = u and xi2 = v * (1 - u), using
+    # Gauss-Jacobi points for the (1 - u) jacobian in u.
+    if ng < 1:
+        raise ValueError('Invalid number of gauss points')
+    u, wu = scipy.special.roots_jacobi(ng, 1., 0.)
+    u, wu = 0.5 * (u + 1.), 0.25 * wu
+    v, wv = _gauss_legendre(ng)
+    ug, vg = numpy.meshgrid(u, v[:, 0], indexing='ij')
+    Xi = numpy.array([ug.flatten(), (vg * (1. - ug)).flatten()]).T
+    W = numpy.outer(wu, wv).flatten()
+    return _freeze(Xi, W)
+
+
+def gauss_points(ng):
+    """
+    Gauss-Legendre points and weights on [0, 1] of any order. For a
+    list of the number of points in each dimension the tensor-product
+    points are returned with xi1 varying fastest. The returned arrays
+    are cached and read-only.
+
+    >>> Xi, W = gauss_points([2, 1])
+    >>> Xi
+    array([[0.21132487, 0.5       ],
+           [0.78867513, 0.5       ]])
+    >>> W
+    array([0.5, 0.5])
+    """
+    ng = _gauss_key(ng)
+    if isinstance(ng, int):
+        return _gauss_legendre(ng)
+    if len(ng) > 3:
+        raise Exception('Gauss points for 4 dimensions and above not supported')
+    return _gauss_tensor(ng)
+
+
+def triangle_gauss_points(ng):
+    """
+    Quadrature points and weights on the triangle x1, x2 >= 0,
+    x1 + x2 <= 1 using ``ng`` points in each collapsed direction. The
+    rule is exact for polynomials of degree ``2 * ng - 1``.
+    """
+    ng = _gauss_key(ng)
+    if not isinstance(ng, int):
+        ng = max(ng)
+    return _gauss_triangle(ng)
+
+
+def basis_gauss_points(basis, ng):
+    """
+    Quadrature points and weights for an element basis. ``ng`` is the
+    number of points in each dimension, or a list per dimension.
+    """
+    ng = _basis_gauss_key(basis, ng)
+    if basis[0][0] == 'T':
+        return triangle_gauss_points(ng)
+    if len(ng) == 1:
+        return gauss_points(ng[0])
+    return gauss_points(ng)
+
+
+def _basis_gauss_key(basis, ng):
+    ng = _gauss_key(ng)
+    if basis[0][0] == 'T':
+        return ng if isinstance(ng, int) else max(ng)
+    if isinstance(ng, int):
+        return (ng,) * dimensions(basis)
+    return ng
+
+
+@functools.lru_cache(maxsize=QUADRATURE_CACHE_SIZE)
+def _quadrature_weights(basis, ng, deriv):
+    Xi = basis_gauss_points(basis, ng)[0]
+    Phi = interpolator.weights(list(basis), Xi, deriv=list(deriv))
+    return _freeze(Phi)[0]
+
+
+def get_quadrature_weights(basis, ng, deriv=None):
+    """
+    Returns the basis weights evaluated at the quadrature points of
+    ``basis_gauss_points(basis, ng)``. Cached per basis, number of gauss
+    points and derivative.
+    """
+    if deriv is None:
+        deriv = [0] * dimensions(basis)
+    return _quadrature_weights(tuple(basis), _basis_gauss_key(basis, ng),
+                               tuple(int(d) for d in deriv))
+
+
+def clear_quadrature_cache():
+    """
+    Removes the cached quadrature basis weights.
+    """
+    _quadrature_weights.cache_clear()
+
+
+def _triangle_dims(basis):
+    """
+    Returns the pairs of xi dimensions of the triangular bases.
+    """
+    pairs, dim = [], 0
+    for base in basis:
+        if base[0] == 'T':
+            pairs.append([dim, dim + 1])
+            dim += 2
+        else:
+            dim += 1
+    return pairs
+
+
+def clamp_xi(basis, xi):
+    """
+    Clamps the ``xi`` locations, an array of size (num_points, num_xi),
+    to the bounds of an element ``basis``, i.e., [0, 1] in each
+    dimension and ``xi1 + xi2 <= 1`` for triangular bases.
+    """
+    xi = numpy.clip(xi, 0, 1)
+    for i, j in _triangle_dims(basis):
+        excess = numpy.maximum(xi[:, i] + xi[:, j] - 1, 0)
+        xi[:, i] -= 0.5 * excess
+        xi[:, j] -= 0.5 * excess
+        xi[:, [i, j]] = numpy.clip(xi[:, [i, j]], 0, 1)
+        xi[:, i] = numpy.minimum(xi[:, i], 1 - xi[:, j])
+    return xi
+
+
+def _free_xi_directions(basis, xi, grad):
+    """
+    Returns, for each point, a (num_xi, num_xi) matrix whose columns
+    span the xi directions the point can move in without leaving the
+    element, given the gradient ``grad`` of the distance. A bound is
+    active if the point is on it and the descent direction points out
+    of the element. Zero columns are fixed directions.
+    """
+    num_points, dims = xi.shape
+    Z = numpy.tile(numpy.eye(dims), (num_points, 1, 1))
+    fixed = ((xi <= 0) & (grad > 0)) | ((xi >= 1) & (grad < 0))
+    points, dims_fixed = numpy.nonzero(fixed)
+    Z[points, dims_fixed, dims_fixed] = 0
+    for i, j in _triangle_dims(basis):
+        diagonal = (xi[:, i] + xi[:, j] >= 1) & \
+            (grad[:, i] + grad[:, j] < 0) & ~fixed[:, i] & ~fixed[:, j]
+        Z[diagonal, :, i] = 0
+        Z[diagonal, :, j] = 0
+        Z[diagonal, i, i] = numpy.sqrt(0.5)
+        Z[diagonal, j, i] = -numpy.sqrt(0.5)
+    return Z
+
+
+def basis_shape(basis):
+    """
+    Returns the ``discretizer`` shape of an element ``basis``, 'line',
+    'quad', 'tri' or 'hex', or None for bases that mix triangular and
+    line components in 3d, e.g., prisms.
+    """
+    triangles = [base[0] == 'T' for base in basis]
+    dims = dimensions(basis)
+    if dims == 1:
+        return 'line'
+    if dims == 2:
+        return 'tri' if triangles[0] else 'quad'
+    if dims == 3 and not any(triangles):
+        return 'hex'
+    return None
+
+
+def basis_xi_grid(basis, res):
+    """
+    Returns the regular grid of xi locations covering an element
+    ``basis`` with ``res`` divisions in each dimension, see
+    ``discretizer.xi_grid``. The grid is read-only. Bases without a
+    discretizer shape use the product of the line and triangle grids of
+    their components.
+    """
+    shape = basis_shape(basis)
+    if shape is not None:
+        return discretizer.xi_grid(shape=shape, res=res)[0]
+    Xi = numpy.zeros((1, 0))
+    for base in basis:
+        comp = discretizer.xi_grid(
+            shape='tri' if base[0] == 'T' else 'line', res=res)[0]
+        Xi = numpy.hstack([numpy.repeat(Xi, comp.shape[0], axis=0),
+                           numpy.tile(comp, (Xi.shape[0], 1))])
+    return _freeze(Xi)[0]
+
+
+@functools.lru_cache(maxsize=QUADRATURE_CACHE_SIZE)
+def _start_grid(basis, res):
+    # Grid points and, per point, the indices of the point and its grid
+    # neighbours, padded with the point itself
+    Xi = basis_xi_grid(basis, res)
+    near = numpy.absolute(Xi[:, None, :] - Xi[None, :, :]).max(2) <= \
+        1.01 / res
+    count = near.sum(1)
+    neighbours = numpy.tile(numpy.arange(Xi.shape[0])[:, None],
+                            (1, count.max()))
+    points, others = numpy.nonzero(near)
+    first = numpy.concatenate([[0], numpy.cumsum(count)[:-1]])
+    neighbours[points, numpy.arange(points.size) - first[points]] = others
+    return _freeze(Xi, neighbours)
+
+
+def _basis_corners(base):
+    """
+    Returns the number of nodes, the indices of the corner nodes and
+    the number of xi dimensions of a basis component.
+    """
+    if base[0] == 'T':
+        order = int(base[1])
+        num_nodes = (order + 1) * (order + 2) // 2
+        return num_nodes, [0, order, num_nodes - 1], 2
+    if base[0] == 'H':
+        return 2, [0, 1], 1
+    order = int(base[1:])
+    return order + 1, [0, order], 1
+
+
+def basis_corners(basis):
+    """
+    Returns the indices of the corner nodes in the element nodes of a
+    ``basis``, ordered with the first xi direction varying fastest.
+
+    >>> basis_corners(['L2', 'L1'])
+    [0, 2, 3, 5]
+    """
+    corners, stride = [0], 1
+    for base in basis:
+        num_nodes, comp, dims = _basis_corners(base)
+        corners = [i + stride * c for c in comp for i in corners]
+        stride *= num_nodes
+    return corners
+
+
+def basis_corner_weights(basis, xi):
+    """
+    Returns the linear weights of the corners of a ``basis``, ordered as
+    ``basis_corners``, at the ``xi`` locations. Points on an element
+    edge or face only have weights on the corners of that edge or face.
+    """
+    xi = numpy.asarray(xi, dtype=float)
+    W = numpy.ones((xi.shape[0], 1))
+    d = 0
+    for base in basis:
+        if base[0] == 'T':
+            x1, x2 = xi[:, d], xi[:, d + 1]
+            comp = numpy.array([1 - x1 - x2, x1, x2]).T
+            d += 2
+        else:
+            comp = numpy.array([1 - xi[:, d], xi[:, d]]).T
+            d += 1
+        W = (W[:, None, :] * comp[:, :, None]).reshape((xi.shape[0], -1))
+    return W
+
+
 def element_face_nodes(basis, node_ids):
     dims = dimensions(basis)
     for base in basis:
@@ -243,39 +535,116 @@ class ObjectList:
         return self._objects.__iter__()
         
         
+class Tessellation(object):
+    """
+    A tessellation of mesh elements into triangles with precomputed
+    basis weights. Points are added in blocks of elements that share the
+    same xi locations, the weights and parameter indices of each basis
+    group are computed once and ``evaluate`` only gathers the current
+    parameters and multiplies them by the weights.
+
+    The triangles ``T`` and xi locations ``Xi`` are read-only since
+    they are shared by all the evaluations.
+    """
+
+    def __init__(self, core, num_points, num_fields, T, Xi=None):
+        self.core = core
+        self.num_points = num_points
+        self.num_fields = num_fields
+        self.T = _freeze(T)[0]
+        self.Xi = None if Xi is None else _freeze(Xi)[0]
+        self.blocks = []
+
+    def add_points(self, cids, xi, offsets):
+        """
+        Adds the points at the ``xi`` locations of each element
+        ``cids``, starting at the row ``offsets`` of the element in X.
+        """
+        cids = numpy.asarray(cids, dtype=int)
+        offsets = numpy.asarray(offsets, dtype=int)
+        for basis, idx in self.core.group_elements_by_basis(cids.tolist()):
+            Phi = interpolator.weights(basis, xi)
+            emap = self.core.element_map(cids[idx])[:, :self.num_fields]
+            rows = (offsets[idx][:, None] + numpy.arange(xi.shape[0])).ravel()
+            self.blocks.append([rows, emap, Phi])
+
+    def merge_points(self, index):
+        """
+        Merges points that are shared between elements. ``index`` maps
+        each point to its merged point, the merged points are numbered
+        from zero and keep the xi location of their first point.
+        """
+        index = numpy.asarray(index, dtype=int)
+        first = numpy.unique(index, return_index=True)[1]
+        num_points = first.size
+        self.T = _freeze(index[self.T].astype(self.T.dtype))[0]
+        if self.Xi is not None:
+            self.Xi = _freeze(self.Xi[first])[0]
+        for block in self.blocks:
+            block[0] = index[block[0]]
+        self.num_points = num_points
+
+    def evaluate(self, P=None, out=None):
+        """
+        Evaluates the points for the parameters ``P``, by default the
+        core parameters, or a batch of parameter vectors of size
+        (num_samples, num_params). Returns an array of size
+        (num_points, num_fields), or (num_samples, num_points,
+        num_fields), written into ``out`` if given.
+        """
+        if P is None:
+            P = self.core.P
+        shape = P.shape[:-1] + (self.num_points, self.num_fields)
+        if out is None:
+            out = numpy.zeros(shape)
+        elif out.shape != shape:
+            raise ValueError('Expected an output array of size %s' % (
+                str(shape)))
+        for rows, emap, Phi in self.blocks:
+            Xe = numpy.matmul(Phi, P[..., emap].swapaxes(-1, -2))
+            out[..., rows, :] = Xe.reshape(
+                P.shape[:-1] + (-1, emap.shape[1]))
+        return out
+
+
 class Core(object):
     
     def __init__(self):
         self.debug_on = False
         self.P = numpy.array([])
+        self.param_version = 0
         self.EFn = []
         self.EMap = []
+        self.EGroups = []
+        self.EGroupId = numpy.array([], dtype=int)
+        self.EGroupIndex = numpy.array([], dtype=int)
         self.DNMap = []
+        self.DNPlan = None
         self.PCAMap = []
+        self.PCAPlan = None
         self.ParamMap = [[], [], []]
+        self.ParamMapPlan = None
         self.has_maps = False
         self.fixed = numpy.array([])
         self.idx_unfixed = []
-        self.variable_ids = []
-        
-        self.gauss_points = {}
-        self.gauss_points[2] = [
-                numpy.array([[0.21132486540518708], [0.78867513459481287]]),
-                numpy.array([0.5, 0.5])]
-        self.gauss_points[3] = [
-                numpy.array([[0.1127016653792583], [0.5], [0.8872983346207417]]),
-                numpy.array([5./18., 4./9., 5./18])]
-        self.gauss_points[4] = [numpy.array([[0.33000947820757187, 0.6699905217924281, 0.06943184420297371, 0.9305681557970262]]).T,
-                numpy.array([0.32607257743127305, 0.32607257743127305, 0.1739274225687269, 0.1739274225687269])]
-        self.gauss_points[5] = [numpy.array([[0.5, 0.230765344947, 0.769234655053, 0.0469100770307, 0.953089922969]]).T,
-                numpy.array([0.284444444444, 0.23931433525, 0.23931433525, 0.118463442528, 0.118463442528])]
-        self.gauss_points[6] = [numpy.array([[0.8306046932331322, 0.1693953067668678, 0.3806904069584016, 0.6193095930415985, 0.0337652428984240, 0.9662347571015760]]).T,
-                numpy.array([0.1803807865240693, 0.1803807865240693, 0.2339569672863455, 0.2339569672863455, 0.0856622461895852, 0.0856622461895852])]
+        self.variable_mask = numpy.zeros(0, dtype=bool)
+        self.variable_ids = numpy.zeros(0, dtype=int)
+
+    def touch_params(self):
+        """
+        Marks the parameters ``P`` as changed by incrementing
+        ``param_version``. The core methods and node setters that change
+        ``P`` call this, code writing to ``P`` directly should too, so
+        that caches of the evaluated mesh, e.g., spatial indices, know
+        when to update.
+        """
+        self.param_version += 1
 
     def add_params(self, params):
         i0 = self.P.size
         self.P = numpy.append(self.P, params)
         self.fixed = numpy.append(self.fixed, [False for p in params])
+        self.touch_params()
         return range(i0, self.P.size)
 
     def add_map(self, src_pid, dst_pid, scale):
@@ -283,9 +652,11 @@ class Core(object):
         self.ParamMap[0].append(src_pid)
         self.ParamMap[1].append(dst_pid)
         self.ParamMap[2].append(scale)
+        self.ParamMapPlan = None
 
     def update_params(self, cids, params):
         self.P[cids] = params
+        self.touch_params()
         return True
         
     def fix_parameters(self, cids, fixed):
@@ -295,56 +666,107 @@ class Core(object):
         self.idx_unfixed = numpy.array([i 
                 for i, f in  enumerate(self.fixed) if f == False])
     
+    def _set_variables_mask(self, cids, state):
+        """
+        Sets the variable state of the parameters ``cids``. Variables are
+        kept as a boolean mask over ``P`` and the sorted int array
+        ``variable_ids`` of the parameters in the mask.
+        """
+        if self.variable_mask.size < self.P.size:
+            self.variable_mask = numpy.append(self.variable_mask, numpy.zeros(
+                self.P.size - self.variable_mask.size, dtype=bool))
+        self.variable_mask[numpy.asarray(cids, dtype=int)] = state
+        self.variable_ids = numpy.flatnonzero(self.variable_mask)
+
     def add_variables(self, cids):
-        if isinstance(cids, int):
-            cids = [cids]
-        for cid in cids:
-            if cid not in self.variable_ids:
-                self.variable_ids.append(cid)
+        self._set_variables_mask(numpy.atleast_1d(cids), True)
     
     def remove_variables(self, cids):
-        if not isinstance(cids, list):
-            cids = [cids]
-        for cid in cids:
-            if cid in self.variable_ids:
-                self.variable_ids.remove(cid)
+        self._set_variables_mask(numpy.atleast_1d(cids), False)
     
     def get_variables(self):
         return self.P[self.variable_ids]
     
     def set_variables(self, variables):
         self.P[self.variable_ids] = variables
+        self.touch_params()
+    
+    def get_variable_map(self):
+        """
+        Returns the sparse matrix, of size (num_params, num_variables),
+        of the derivatives of the parameters ``P`` with respect to the
+        variables after the updates of ``Mesh.update``, i.e., the PCA
+        node, dependent node and map updates. The variables map to
+        themselves unless they are updated.
+
+        The maps are linear so ``dP = M.dot(dx)`` is exact for these.
+        The dependent nodes are linear in the element parameters and
+        are linearised in their element xi parameters, and the PCA nodes
+        are linearised in their modes, weights and variance, at the
+        current parameters.
+        """
+        num_params = self.P.size
+        M = scipy.sparse.csr_matrix(
+            (numpy.ones(self.variable_ids.size),
+             (self.variable_ids, numpy.arange(self.variable_ids.size))),
+            shape=(num_params, self.variable_ids.size))
+        if self.PCAPlan is None:
+            self.generate_pca_plan()
+        for targets, mode_cids, weights_cids, variance_cids in self.PCAPlan:
+            num_modes = weights_cids.size
+            modes = self.P[mode_cids]
+            scale = self.P[weights_cids] * self.P[variance_cids]
+            rows = numpy.repeat(numpy.arange(targets.size), 3 * num_modes)
+            cols = numpy.hstack([
+                numpy.tile(numpy.append(weights_cids, variance_cids),
+                           (targets.size, 1)), mode_cids]).ravel()
+            values = numpy.hstack([
+                modes * self.P[variance_cids], modes * self.P[weights_cids],
+                numpy.tile(scale, (targets.size, 1))]).ravel()
+            D = scipy.sparse.csr_matrix((values, (rows, cols)),
+                                        shape=(targets.size, num_params))
+            M = self._replace_rows(M, targets, D.dot(M))
+        if len(self.DNMap) > 0:
+            G = self._dependent_node_xi_jacobian()
+            for targets, D in self.get_dependent_node_plan():
+                M = self._replace_rows(M, targets, (D + G[targets]).dot(M))
+        if self.has_maps:
+            if self.ParamMapPlan is None:
+                self.generate_map_plan()
+            src, dst, scale = self.ParamMapPlan
+            D = scipy.sparse.csr_matrix(
+                (scale, (numpy.arange(src.size), src)),
+                shape=(src.size, num_params))
+            M = self._replace_rows(M, dst, D.dot(M))
+        return M
+
+    def _replace_rows(self, M, rows, R):
+        """
+        Returns the sparse matrix ``M`` with the ``rows`` replaced by the
+        rows of ``R``.
+        """
+        keep = numpy.ones(M.shape[0])
+        keep[rows] = 0
+        S = scipy.sparse.csr_matrix(
+            (numpy.ones(rows.size), (rows, numpy.arange(rows.size))),
+            shape=(M.shape[0], rows.size))
+        return (scipy.sparse.diags(keep).dot(M) + S.dot(R)).tocsr()
     
     def get_gauss_points(self, ng):
-        if isinstance(ng, int):
-            return self.gauss_points.get(ng)
-        elif isinstance(ng, list):
-            if len(ng) > 3:
-                raise Exception('Gauss points for 4 dimensions and above not supported')
-            if len(ng) == 2:
-                Xi1, W1 = self.get_gauss_points(ng[0])
-                Xi2, W2 = self.get_gauss_points(ng[1])
-                Xi1g, Xi2g = numpy.meshgrid(Xi1.flatten(), Xi2.flatten())
-                Xi1 = numpy.array([Xi1g.flatten(), Xi2g.flatten()]).T
-                W1g, W2g = numpy.meshgrid(W1.flatten(), W2.flatten())
-                W1 = W1g.flatten() * W2g.flatten()
-                return Xi1, W1
-            elif len(ng) == 3:
-                Xi1, W1 = self.get_gauss_points(ng[0])
-                Xi2, W2 = self.get_gauss_points(ng[1])
-                Xi3, W3 = self.get_gauss_points(ng[2])
-                gindex = numpy.mgrid[0:ng[0], 0:ng[1], 0:ng[2]]
-                gindex = numpy.array([
-                    gindex[2, :, :].flatten(),
-                    gindex[1, :, :].flatten(),
-                    gindex[0, :, :].flatten()]).T
-                Xi = numpy.array([
-                    Xi1[gindex[:, 0]], Xi2[gindex[:, 1]], Xi3[gindex[:, 2]]])[:, :, 0].T
-                W = numpy.array([
-                    W1[gindex[:, 0]], W2[gindex[:, 1]], W3[gindex[:, 2, ]]]).T.prod(1)
-                return Xi, W
-            
-        raise Exception('Invalid number of gauss points')
+        """
+        Returns the Gauss-Legendre points and weights on [0, 1] for
+        ``ng`` points, or the tensor-product points and weights if ``ng``
+        is a list with the number of points in each dimension.
+        """
+        return gauss_points(ng)
+
+    def get_basis_gauss_points(self, basis, ng):
+        """
+        Returns the quadrature points and weights for an element
+        ``basis``. Triangular bases use a triangle rule, otherwise a
+        tensor-product rule with ``ng`` points in each dimension.
+        """
+        return basis_gauss_points(basis, ng)
 
     def generate_element_map(self, mesh):
         self.EFn = []
@@ -356,6 +778,30 @@ class Core(object):
             self.EMap.append(elem._get_param_indicies())
             elem.set_core_id(cid)
             cid += 1
+        self.generate_element_groups()
+
+    def generate_element_groups(self):
+        """
+        Groups the elements by basis. For each distinct basis,
+        ``EGroups`` stores ``[basis, cids, emap]`` where ``cids`` is an
+        int array of element cids and ``emap`` is a dense
+        (num_elements, num_fields, num_dof) int32 array of parameter
+        indices. ``EGroupId`` and ``EGroupIndex`` give the group and the
+        row in the group of each element cid.
+        """
+        groups = {}
+        for cid, basis in enumerate(self.EFn):
+            groups.setdefault(tuple(basis), []).append(cid)
+        self.EGroups = []
+        self.EGroupId = numpy.zeros(len(self.EFn), dtype=int)
+        self.EGroupIndex = numpy.zeros(len(self.EFn), dtype=int)
+        for gid, (basis, cids) in enumerate(groups.items()):
+            cids = numpy.array(cids, dtype=int)
+            emap = numpy.array([self.EMap[cid] for cid in cids],
+                               dtype=numpy.int32)
+            self.EGroups.append([list(basis), cids, emap])
+            self.EGroupId[cids] = gid
+            self.EGroupIndex[cids] = numpy.arange(cids.size)
     
     def generate_dependent_node_map(self, mesh):
         self.DNMap = []
@@ -364,58 +810,219 @@ class Core(object):
                 elem = node.mesh.elements[node.element]
                 pnode = node.mesh.nodes[node.node]
                 self.DNMap.append([elem.cid, pnode.cids, node.cids, node.shape, node.scale])
-    
-    def update_dependent_nodes(self):
-        # update dependent nodes
+        self.DNPlan = None
+
+    def generate_dependent_node_plan(self):
+        """
+        Compiles the dependent node updates into sparse operators so
+        that ``update_dependent_nodes`` is a sparse mat-vec per level.
+        Dependent nodes embedded in elements that use other dependent
+        nodes are placed in a later level.
+
+        The plan is stored as ``[xi_cids, xi_values, levels]`` where
+        levels is a list of ``[target_cids, D]`` and is rebuilt when the
+        element xi values of the dependent nodes change.
+        """
+        entries = []
+        owner = {}
+        for dn_idx, dn in enumerate(self.DNMap):
+            for target, field_cids, weights in self._dependent_node_weights(dn):
+                entries.append([dn_idx, target, field_cids, weights])
+                owner[target] = dn_idx
+
+        # Dependent nodes using other dependent nodes go in later levels
+        dn_level = {}
+        for dn_idx in range(len(self.DNMap)):
+            dn_level[dn_idx] = 0
+        for iteration in range(len(self.DNMap)):
+            changed = False
+            for dn_idx, target, field_cids, weights in entries:
+                for c in field_cids:
+                    if c in owner and owner[c] != dn_idx and \
+                            dn_level[dn_idx] <= dn_level[owner[c]]:
+                        dn_level[dn_idx] = dn_level[owner[c]] + 1
+                        changed = True
+            if not changed:
+                break
+
+        levels = []
+        for level in sorted(set(dn_level[e[0]] for e in entries)):
+            targets, rows, cols, vals = [], [], [], []
+            for dn_idx, target, field_cids, weights in entries:
+                if dn_level[dn_idx] == level:
+                    rows.extend([len(targets)] * len(weights))
+                    cols.extend(field_cids)
+                    vals.extend(weights)
+                    targets.append(target)
+            D = scipy.sparse.csr_matrix((vals, (rows, cols)),
+                                        shape=(len(targets), self.P.size))
+            levels.append([numpy.array(targets, dtype=int), D])
+
+        xi_cids = numpy.array([c for dn in self.DNMap for c in dn[1]],
+                              dtype=int)
+        self.DNPlan = [xi_cids, self.P[xi_cids].copy(), levels]
+
+    def _dependent_node_weights(self, dn, xi_deriv=None):
+        """
+        Returns ``[target_cid, field_cids, weights]`` for each parameter
+        of a dependent node ``dn``, an entry of ``DNMap``, so that
+        ``P[target_cid] = weights.dot(P[field_cids])``. If ``xi_deriv``
+        is given, the weights are differentiated with respect to the
+        element xi in that direction.
+        """
+        cid, xi_cids, dn_cids, shape, scale = dn
+        basis = self.EFn[cid]
+        xi = numpy.array([self.P[xi_cids]]).reshape((1, -1))
+        if len(shape) == 1:
+            derivs = [None]
+            scale = [1.]
+        elif len(shape) == 2:
+            derivs = {2: [None, [1]],
+                      4: [None, [1, 0], [0, 1], [1, 1]]}.get(shape[1], [None])
+            if scale is None:
+                scale = numpy.ones((shape[1]))
+        else:
+            return []
+        if xi_deriv is not None:
+            dims = xi.shape[1]
+            derivs = [(numpy.zeros(dims, dtype=int) if d is None else
+                       numpy.array(d)) + numpy.eye(dims, dtype=int)[xi_deriv]
+                      for d in derivs]
+            derivs = [d.tolist() for d in derivs]
+        Phi = [interpolator.weights(basis, xi, deriv=d) for d in derivs]
+        entries = []
+        comp_idx = 0
+        for field_cids in self.EMap[cid]:
+            for j, phi in enumerate(Phi):
+                entries.append([dn_cids[comp_idx], field_cids,
+                                scale[j] * numpy.asarray(phi).reshape(-1)])
+                comp_idx += 1
+        return entries
+
+    def _dependent_node_xi_jacobian(self):
+        """
+        Returns the sparse matrix, of size (num_params, num_params), of
+        the derivatives of the dependent node parameters with respect to
+        their element xi parameters at the current parameters.
+        """
+        rows, cols, values = [], [], []
         for dn in self.DNMap:
-            cid = dn[0]
             xi_cids = dn[1]
-            dn_cids = dn[2]
-            shape = dn[3]
-            scale = dn[4]
-            num_fields = len(self.EMap[cid])
-            if num_fields == 1:
-                xi = numpy.array([self.P[xi_cids]]).T
-            else:
-                xi = numpy.array([self.P[xi_cids]])
-            if len(shape) == 1:
-                Phi = interpolator.weights(self.EFn[cid], xi)
-                for i in range(num_fields):
-                    self.P[dn_cids[i]] = numpy.dot(Phi, self.P[self.EMap[cid][i]])
-            elif len(shape) == 2:
-                components = shape[1]
-                Phi = [interpolator.weights(self.EFn[cid], xi)]
-                if components == 2:
-                    Phi.append(interpolator.weights(self.EFn[cid], xi, deriv=[1]))
-                elif components == 4:
-                    Phi.append(interpolator.weights(self.EFn[cid], xi, deriv=[1, 0]))
-                    Phi.append(interpolator.weights(self.EFn[cid], xi, deriv=[0, 1]))
-                    Phi.append(interpolator.weights(self.EFn[cid], xi, deriv=[1, 1]))
-                comp_idx = 0
-                if scale is None:
-                    scale = numpy.ones((shape[1]))
-                for i in range(num_fields):
-                    for j, phi in enumerate(Phi):
-                        self.P[dn_cids[comp_idx]] = scale[j] * numpy.dot(phi, self.P[self.EMap[cid][i]])
-                        comp_idx += 1
+            for k, xi_cid in enumerate(xi_cids):
+                for target, field_cids, weights in \
+                        self._dependent_node_weights(dn, xi_deriv=k):
+                    rows.append(target)
+                    cols.append(xi_cid)
+                    values.append(weights.dot(self.P[field_cids]))
+        return scipy.sparse.csr_matrix(
+            (values, (rows, cols)), shape=(self.P.size, self.P.size))
+
+    def get_dependent_node_plan(self):
+        """
+        Returns the dependent node operators, ``[[target_cids, D], ...]``,
+        regenerating them if the element xi values have changed.
+        """
+        if self.DNPlan is None or \
+                (len(self.DNPlan[2]) > 0 and
+                 self.DNPlan[2][0][1].shape[1] != self.P.size) or \
+                not numpy.array_equal(self.P[self.DNPlan[0]], self.DNPlan[1]):
+            self.generate_dependent_node_plan()
+        return self.DNPlan[2]
+
+    def update_dependent_nodes(self):
+        # update dependent nodes
+        if len(self.DNMap) == 0:
+            return
+        for targets, D in self.get_dependent_node_plan():
+            self.P[targets] = D.dot(self.P)
+        self.touch_params()
 
     def add_pca_node(self, pca_node):
         self.PCAMap.append([
             pca_node.cids,
             pca_node.node.shape, pca_node.node.cids,
             pca_node.weights.cids, pca_node.variance.cids])
+        self.PCAPlan = None
         return len(self.PCAMap) - 1
+
+    def generate_pca_plan(self):
+        """
+        Compiles the PCA nodes into dense mode matrices. PCA nodes that
+        share weights and variance nodes are stacked into one
+        (num_pca_params, num_modes) matrix so the group is reconstructed
+        with a single matmul.
+
+        The plan is a list of
+        ``[target_cids, mode_cids, weights_cids, variance_cids]``. Only
+        the indices are kept, the mode values are read from ``P`` at each
+        update so edits to the mode nodes are used.
+        """
+        groups = {}
+        for pcamap in self.PCAMap:
+            key = (tuple(pcamap[3]), tuple(pcamap[4]))
+            groups.setdefault(key, []).append(pcamap)
+        self.PCAPlan = []
+        for (weights_cids, variance_cids), pcamaps in groups.items():
+            targets = numpy.concatenate([
+                numpy.asarray(pcamap[0], dtype=int) for pcamap in pcamaps])
+            mode_cids = numpy.concatenate([
+                numpy.asarray(pcamap[2], dtype=int).reshape(
+                    (-1, pcamap[1][-1])) for pcamap in pcamaps])
+            self.PCAPlan.append([
+                targets, mode_cids,
+                numpy.array(weights_cids, dtype=int),
+                numpy.array(variance_cids, dtype=int)])
     
     def update_pca_nodes(self):
-        for pcamap in self.PCAMap:
-            self.P[pcamap[0]] = numpy.dot(
-                self.P[pcamap[2]].reshape(pcamap[1]),
-                self.P[pcamap[3]] * self.P[pcamap[4]]).flatten()
+        if self.PCAPlan is None:
+            self.generate_pca_plan()
+        for targets, mode_cids, weights_cids, variance_cids in self.PCAPlan:
+            self.P[targets] = numpy.dot(
+                self.P[mode_cids], self.P[weights_cids] * self.P[variance_cids])
+        if len(self.PCAPlan) > 0:
+            self.touch_params()
+
+    def generate_map_plan(self):
+        """
+        Converts the parameter maps into source, destination and scale
+        arrays.
+        """
+        self.ParamMapPlan = [
+            numpy.array(self.ParamMap[0], dtype=int),
+            numpy.array(self.ParamMap[1], dtype=int),
+            numpy.array(self.ParamMap[2], dtype=float)]
 
     def update_maps(self):
         if self.has_maps:
-            self.P[self.ParamMap[1]] = self.ParamMap[2] * self.P[self.ParamMap[0]]
+            if self.ParamMapPlan is None:
+                self.generate_map_plan()
+            src, dst, scale = self.ParamMapPlan
+            self.P[dst] = scale * self.P[src]
+            self.touch_params()
     
+    def update_batch(self, Ps):
+        """
+        Applies the PCA node, dependent node and map updates to a batch
+        of parameter vectors of size (num_samples, num_params). This is
+        the batched equivalent of ``Mesh.update``. The dependent nodes
+        use the element xi values in ``P``.
+        """
+        if self.PCAPlan is None:
+            self.generate_pca_plan()
+        for targets, mode_cids, weights_cids, variance_cids in self.PCAPlan:
+            Ps[:, targets] = numpy.einsum(
+                'stm,sm->st', Ps[:, mode_cids],
+                Ps[:, weights_cids] * Ps[:, variance_cids])
+        if len(self.DNMap) > 0:
+            for targets, D in self.get_dependent_node_plan():
+                Ps[:, targets] = D.dot(Ps.T).T
+        if self.has_maps:
+            if self.ParamMapPlan is None:
+                self.generate_map_plan()
+            src, dst, scale = self.ParamMapPlan
+            Ps[:, dst] = scale * Ps[:, src]
+        return Ps
+
     def weights(self, cid, xi, deriv=None):
         return interpolator.weights(self.EFn[cid], xi, deriv=deriv)
     
@@ -423,35 +1030,330 @@ class Core(object):
         num_fields = len(self.EMap[cid])
         X = numpy.zeros((xi.shape[0], num_fields))
         Phi = interpolator.weights(self.EFn[cid], xi, deriv=deriv)
-        for i in range(num_fields):
-            X[:, i] = numpy.dot(Phi, self.P[self.EMap[cid][i]])
+        X[:] = numpy.dot(Phi, self.P[self.EMap[cid]].T)
         return X
-       
-    def evaluates(self, cids, xi, deriv=None, X=None):
+
+    def element_params(self, cids, P=None):
+        """
+        Gathers the parameters of the elements ``cids`` into an array of
+        size (num_elements, num_fields, num_basis). All the elements
+        must have the same basis and number of fields.
+
+        A batch of parameter vectors of size (num_samples, num_params)
+        can be given with ``P``, in which case the returned array has
+        size (num_samples, num_elements, num_fields, num_basis).
+        """
+        if P is None:
+            P = self.P
+        return P[..., self.element_map(cids)]
+
+    def element_map(self, cids):
+        """
+        Returns the parameter indices of the elements ``cids`` as an
+        array of size (num_elements, num_fields, num_basis). All the
+        elements must have the same basis and number of fields.
+        """
+        cids = numpy.asarray(cids, dtype=int)
+        if self.EGroupId.size == len(self.EMap):
+            gids = self.EGroupId[cids]
+            if cids.size > 0 and (gids == gids[0]).all():
+                return self.EGroups[gids[0]][2][self.EGroupIndex[cids]]
+        return numpy.array([self.EMap[cid] for cid in cids])
+
+    def group_elements_by_basis(self, cids):
+        """
+        Groups the elements ``cids`` by basis. Returns a list of
+        ``[basis, indices]`` where ``indices`` is an int array of the
+        positions in ``cids`` of the elements that use ``basis``.
+        """
+        if self.EGroupId.size == len(self.EMap):
+            gids = self.EGroupId[numpy.asarray(cids, dtype=int)]
+            return [[self.EGroups[gid][0], numpy.nonzero(gids == gid)[0]]
+                    for gid in numpy.unique(gids)]
+        groups = {}
+        for idx, cid in enumerate(cids):
+            groups.setdefault(tuple(self.EFn[cid]), []).append(idx)
+        return [[list(basis), numpy.array(idx)]
+                for basis, idx in groups.items()]
+
+    def evaluates(self, cids, xi, deriv=None, X=None, P=None):
+        """
+        Evaluates the elements ``cids`` at the same ``xi`` locations.
+        Elements sharing a basis are gathered and evaluated with a single
+        matrix product. Returns an array of size
+        (len(cids) * num_xi, num_fields) ordered by element.
+
+        If a batch of parameter vectors (num_samples, num_params) is
+        given with ``P``, the returned array has size
+        (num_samples, len(cids) * num_xi, num_fields).
+        """
+        if P is None:
+            P = self.P
         num_fields = len(self.EMap[cids[0]])
-        if X==None:
-            X = numpy.zeros((len(cids) * xi.shape[0], num_fields))
-        Phi = interpolator.weights(self.EFn[cids[0]], xi, deriv=deriv)
-        Nxi = xi.shape[0]
-        ind = 0
-        for cid in cids:
-            for i in range(num_fields):
-                X[ind:ind+Nxi, i] = numpy.dot(Phi, self.P[self.EMap[cid][i]])
-            ind += Nxi
+        Xe = numpy.zeros(P.shape[:-1] + (len(cids), xi.shape[0], num_fields))
+        for basis, idx in self.group_elements_by_basis(cids):
+            Phi = interpolator.weights(basis, xi, deriv=deriv)
+            Xe[..., idx, :, :] = numpy.matmul(Phi, self.element_params(
+                [cids[i] for i in idx], P=P).swapaxes(-1, -2))
+        Xe = Xe.reshape(P.shape[:-1] + (-1, num_fields))
+        if X is None:
+            return Xe
+        X[:] = Xe
         return X
     
     def evaluates_weights(self, cids, Phi, X=None):
+        """
+        Evaluates the elements ``cids``, which must share a basis, using
+        precomputed weights ``Phi``.
+        """
         num_fields = len(self.EMap[cids[0]])
-        if X==None:
-            X = numpy.zeros((len(cids) * Phi.shape[0], num_fields))
-        Nxi = Phi.shape[0]
-        ind = 0
-        for cid in cids:
-            for i in range(num_fields):
-                X[ind:ind+Nxi, i] = numpy.dot(Phi, self.P[self.EMap[cid][i]])
-            ind += Nxi
+        Xe = numpy.matmul(Phi, self.element_params(cids).transpose(0, 2, 1))
+        if X is None:
+            return Xe.reshape((-1, num_fields))
+        X[:] = Xe.reshape((-1, num_fields))
         return X
     
+    def evaluate_points(self, cids, xi, deriv=None):
+        """
+        Evaluates points that each have their own element and xi
+        location. ``cids`` and ``xi`` are parallel arrays of length
+        num_points. The points are grouped by element basis, the weights
+        are computed in bulk for each group and the values are returned
+        in the input order as an array of size (num_points, num_fields),
+        which is empty for no points.
+        
+        Elements of lower dimension than ``xi`` use its leading columns.
+        """
+        cids = numpy.asarray(cids, dtype=int)
+        xi = numpy.asarray(xi, dtype=float)
+        if xi.ndim == 1:
+            xi = xi[:, None]
+        ucids, inverse = numpy.unique(cids, return_inverse=True)
+        inverse = inverse.reshape(cids.shape)
+        X = None
+        for basis, idx in self.group_elements_by_basis(ucids.tolist()):
+            points = numpy.nonzero(numpy.isin(inverse, idx))[0]
+            local = numpy.searchsorted(idx, inverse[points])
+            Phi = interpolator.weights(
+                basis, xi[points, :dimensions(basis)], deriv=deriv)
+            Pe = self.element_params(ucids[idx])[local]
+            Xg = numpy.einsum('pb,pfb->pf', Phi, Pe)
+            if X is None:
+                X = numpy.zeros((cids.size, Xg.shape[1]))
+            X[points] = Xg
+        if X is None:
+            num_fields = len(self.EMap[0]) if len(self.EMap) > 0 else 0
+            X = numpy.zeros((0, num_fields))
+        return X
+    
+    def project_points(self, cids, X, xi, max_iterations=50, xtol=1e-8):
+        """
+        Projects the points ``X`` of size (num_points, num_fields) onto
+        the elements ``cids``, one element per point, starting from the
+        ``xi`` locations. The xi locations of all the points are updated
+        together by Levenberg-Marquardt iterations on the distance using
+        the basis derivatives and the curvature of the elements, and are
+        kept in the element bounds, see ``clamp_xi``. A step is accepted
+        if it reduces the distance, in which case the damping is reduced,
+        otherwise the damping is increased and the step is retried. A
+        point has converged when its step, accepted or not, is smaller
+        than ``xtol``. ``closest_points`` starts from several xi
+        locations to avoid local minima.
+
+        Returns the projected xi locations, of the same size as ``xi``,
+        and the distances to the points.
+        """
+        cids = numpy.asarray(cids, dtype=int)
+        X = numpy.asarray(X, dtype=float)
+        xi = numpy.array(xi, dtype=float)
+        if xi.ndim == 1:
+            xi = xi[:, None]
+        dist = numpy.zeros(cids.size)
+        ucids, inverse = numpy.unique(cids, return_inverse=True)
+        inverse = inverse.reshape(cids.shape)
+        for basis, idx in self.group_elements_by_basis(ucids.tolist()):
+            dims = dimensions(basis)
+            derivs = numpy.eye(dims, dtype=int).tolist()
+            points = numpy.nonzero(numpy.isin(inverse, idx))[0]
+            local = numpy.searchsorted(idx, inverse[points])
+            Pe = self.element_params(ucids[idx])[local]
+            Xp = X[points]
+            
+            def residual(active, xa):
+                Phi = interpolator.weights(basis, xa)
+                return numpy.einsum('pb,pfb->pf', Phi, Pe[active]) - Xp[active]
+            
+            xg = clamp_xi(basis, xi[points, :dims])
+            r = residual(numpy.arange(points.size), xg)
+            err = (r * r).sum(1)
+            damping = 1e-3 * numpy.ones(points.size)
+            active = numpy.arange(points.size)
+            
+            def jacobian(active, xa):
+                return numpy.stack([numpy.einsum(
+                    'pb,pfb->pf', interpolator.weights(basis, xa, deriv=d),
+                    Pe[active]) for d in derivs], axis=2)
+            
+            for iteration in range(max_iterations):
+                xa = xg[active]
+                ra = r[active]
+                J = jacobian(active, xa)
+                JtJ = numpy.einsum('pfi,pfj->pij', J, J)
+                Jtr = numpy.einsum('pfi,pf->pi', J, ra)
+                # Curvature of the elements from forward differences of the
+                # jacobian, Gauss-Newton alone converges slowly or not at
+                # all for points far from a curved element
+                H = JtJ.copy()
+                for i in range(dims):
+                    xh = xa.copy()
+                    xh[:, i] += 1e-7
+                    H[:, i] += numpy.einsum(
+                        'pfj,pf->pj', jacobian(active, xh) - J, ra) / 1e-7
+                H = 0.5 * (H + H.transpose((0, 2, 1)))
+                Z = _free_xi_directions(basis, xa, Jtr)
+                A = numpy.einsum('pki,pkl,plj->pij', Z, H, Z)
+                # Marquardt damping scaled by the Gauss-Newton diagonal, with
+                # a floor for degenerate element points, and unit fixed
+                # directions
+                diag = numpy.einsum('pki,pkl,pli->pi', Z, JtJ, Z)
+                A[:, range(dims), range(dims)] += damping[active, None] * (
+                    diag + 1e-12 * (1 + diag.sum(1))[:, None])
+                A[:, range(dims), range(dims)] += (Z * Z).sum(1) == 0
+                u = numpy.linalg.solve(
+                    A, -numpy.einsum('pki,pk->pi', Z, Jtr)[:, :, None])
+                step = numpy.einsum('pij,pj->pi', Z, u[:, :, 0])
+                xn = clamp_xi(basis, xa + step)
+                rn = residual(active, xn)
+                errn = (rn * rn).sum(1)
+                better = errn < err[active]
+                accepted = active[better]
+                xg[accepted], r[accepted], err[accepted] = \
+                    xn[better], rn[better], errn[better]
+                damping[accepted] = numpy.maximum(
+                    0.25 * damping[accepted], 1e-12)
+                damping[active[~better]] *= 4
+                moved = (numpy.absolute(xn - xa).max(1) > xtol) & \
+                    (damping[active] < 1e12)
+                active = active[moved]
+                if active.size == 0:
+                    break
+            xi[points, :dims] = xg
+            dist[points] = numpy.sqrt(err)
+        return xi, dist
+    
+    def closest_points(self, cids, X, num_starts=3, res=8,
+                       max_iterations=50, xtol=1e-8):
+        """
+        Finds the closest points on the elements ``cids``, one element
+        per point, to the points ``X`` of size (num_points, num_fields).
+        The distance is evaluated on a grid with ``res`` divisions of
+        each element and ``project_points`` starts from up to
+        ``num_starts`` of the closest local minima of the grid. Points
+        that end on an element bound are projected again from inside the
+        element, a quarter of the way from that bound, since a curved
+        element can have a constrained minimum on the bound next to a
+        closer interior one.
+
+        Returns the xi locations of the closest points, of size
+        (num_points, num_xi), and the distances to the points.
+        """
+        cids = numpy.asarray(cids, dtype=int)
+        X = numpy.asarray(X, dtype=float)
+        num_xi = max([dimensions(self.EFn[cid]) for cid in set(cids)] + [0])
+        pairs, starts = [], []
+        for basis, idx in self.group_elements_by_basis(cids.tolist()):
+            Xi, neighbours = _start_grid(tuple(basis), res)
+            Pe = self.element_params(cids[idx])
+            grid = numpy.einsum('gb,pfb->pgf',
+                                interpolator.weights(basis, Xi), Pe)
+            d = ((grid - X[idx][:, None, :]) ** 2).sum(2)
+            d[d > d[:, neighbours].min(2)] = numpy.inf
+            order = numpy.argsort(d, axis=1)[:, :num_starts]
+            points, k = numpy.nonzero(numpy.isfinite(
+                numpy.take_along_axis(d, order, 1)))
+            xi = numpy.zeros((points.size, num_xi))
+            xi[:, :Xi.shape[1]] = Xi[order[points, k]]
+            pairs.append(idx[points])
+            starts.append(xi)
+        pairs = numpy.concatenate(pairs + [numpy.zeros(0, dtype=int)])
+        xi = numpy.concatenate(starts + [numpy.zeros((0, num_xi))])
+        xi, dist = self.project_points(
+            cids[pairs], X[pairs], xi, max_iterations=max_iterations,
+            xtol=xtol)
+        
+        # Restart from inside the element, trailing xi columns of lower
+        # dimensional elements are zero and are not bounds
+        bound = numpy.zeros(xi.shape, dtype=bool)
+        for basis, idx in self.group_elements_by_basis(cids[pairs].tolist()):
+            dims = dimensions(basis)
+            bound[idx, :dims] = (xi[idx, :dims] <= 0) | (xi[idx, :dims] >= 1)
+        redo = numpy.nonzero(bound.any(1))[0]
+        if redo.size > 0:
+            xr = xi[redo]
+            xr[bound[redo]] = numpy.where(xr[bound[redo]] <= 0, 0.25, 0.75)
+            xr, dr = self.project_points(
+                cids[pairs[redo]], X[pairs[redo]], xr,
+                max_iterations=max_iterations, xtol=xtol)
+            better = dr < dist[redo]
+            xi[redo[better]], dist[redo[better]] = xr[better], dr[better]
+        
+        # Keep the closest result of each point
+        order = numpy.lexsort((dist, pairs))
+        first = numpy.ones(order.size, dtype=bool)
+        first[1:] = pairs[order[1:]] != pairs[order[:-1]]
+        best = order[first]
+        return xi[best], dist[best]
+    
+    def point_weights(self, cids, xi, fields, deriv=None):
+        """
+        Computes the parameter weights of points that each have their
+        own element, xi location and field. ``cids``, ``xi`` and
+        ``fields`` are parallel arrays of length num_points; ``fields``
+        and ``deriv`` can also be shared by all the points. ``deriv`` can
+        be given per point as a (num_points, num_xi) array.
+
+        The weights are computed in bulk for each basis and derivative
+        group and returned as COO triplets ``[points, pids, weights]``,
+        so the value of point ``i`` is the sum of ``weights * P[pids]``
+        where ``points == i``.
+        """
+        cids = numpy.asarray(cids, dtype=int)
+        xi = numpy.asarray(xi, dtype=float)
+        if xi.ndim == 1:
+            xi = xi[:, None]
+        fields = numpy.broadcast_to(numpy.asarray(fields, dtype=int),
+                                    cids.shape)
+        if deriv is not None:
+            deriv = numpy.asarray(deriv, dtype=int)
+        ucids, inverse = numpy.unique(cids, return_inverse=True)
+        inverse = inverse.reshape(cids.shape)
+        points, pids, weights = [], [], []
+        for basis, idx in self.group_elements_by_basis(ucids.tolist()):
+            dims = dimensions(basis)
+            emap = self.element_map(ucids[idx])
+            gpoints = numpy.nonzero(numpy.isin(inverse, idx))[0]
+            if deriv is None or deriv.ndim == 1:
+                derivs = [[deriv, gpoints]]
+            else:
+                uderiv, dinv = numpy.unique(deriv[gpoints, :dims], axis=0,
+                                            return_inverse=True)
+                dinv = dinv.reshape(gpoints.shape)
+                derivs = [[d, gpoints[dinv == k]]
+                          for k, d in enumerate(uderiv)]
+            for d, gp in derivs:
+                if d is not None:
+                    d = d.tolist()
+                Phi = interpolator.weights(basis, xi[gp, :dims], deriv=d)
+                local = numpy.searchsorted(idx, inverse[gp])
+                points.append(numpy.repeat(gp, Phi.shape[1]))
+                pids.append(emap[local, fields[gp]].ravel())
+                weights.append(Phi.ravel())
+        if len(points) == 0:
+            return [numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int),
+                    numpy.zeros(0)]
+        return [numpy.concatenate(points), numpy.concatenate(pids),
+                numpy.concatenate(weights)]
+
     def evaluate_fields(self, cid, xi, fields):
         num_fields = len(fields)
         X = numpy.zeros((xi.shape[0], num_fields))
@@ -460,6 +1362,51 @@ class Core(object):
             X[:, i] = numpy.dot(Phi, self.P[self.EMap[cid][field[0]]])
         return X
 
+    def evaluates_fields(self, cids, xi, fields):
+        """
+        Evaluates ``fields`` (see ``evaluate_fields``) for the elements
+        ``cids`` at the same ``xi`` locations. Each basis group is
+        evaluated with one matrix product per field. Returns an array of
+        size (len(cids), num_xi, len(fields)).
+        """
+        X = numpy.zeros((len(cids), xi.shape[0], len(fields)))
+        for basis, idx in self.group_elements_by_basis(cids):
+            params = self.element_params([cids[i] for i in idx])
+            for i, field in enumerate(fields):
+                Phi = interpolator.weights(basis, xi, deriv=field[1:])
+                X[idx, :, i] = numpy.dot(params[:, field[0], :], Phi.T)
+        return X
+
+    def integrates(self, cids, fields, func=None, ng=4):
+        """
+        Integrates ``fields`` over the elements ``cids`` using gaussian
+        quadrature with ``ng`` points in each dimension, see
+        ``basis_gauss_points``. The quadrature points, weights and basis
+        weights are cached per basis so each basis group costs a gather
+        and a matrix product per field.
+
+        All the quadrature points of a basis group are passed to
+        ``func`` in one call as a (num_points, len(fields)) array, so
+        ``func`` must operate on whole arrays row-wise. Returns the
+        per-element integrals of size (len(cids), ...).
+        """
+        integrals = None
+        for basis, idx in self.group_elements_by_basis(cids):
+            W = basis_gauss_points(basis, ng)[1]
+            params = self.element_params([cids[i] for i in idx])
+            X = numpy.zeros((len(idx), W.size, len(fields)))
+            for i, field in enumerate(fields):
+                Phi = get_quadrature_weights(basis, ng, deriv=field[1:])
+                X[:, :, i] = numpy.dot(params[:, field[0], :], Phi.T)
+            if func is not None:
+                Y = numpy.asarray(func(X.reshape((-1, len(fields)))))
+                X = Y.reshape((len(idx), W.size) + Y.shape[1:])
+            I = numpy.einsum('j,ij...->i...', W, X)
+            if integrals is None:
+                integrals = numpy.zeros((len(cids),) + I.shape[1:])
+            integrals[idx] = I
+        return integrals
+
     def debug(self, msg):
         if self.debug_on:
             print(msg)
@@ -1,69 +1,151 @@
-import numpy    
+"""
+Regular xi grids on the element shapes. ``xi_grid`` returns the xi
+locations of the grid points and their connectivity, segments for
+lines, triangles for quads and triangles and hexahedra for hexagonal
+elements. Grids are cached per shape, resolution and method and the
+returned arrays are read-only.
+
+>>> Xi, T = xi_grid(shape='quad', res=[2, 1])
+>>> Xi
+array([[0. , 0. ],
+       [0.5, 0. ],
+       [1. , 0. ],
+       [0. , 1. ],
+       [0.5, 1. ],
+       [1. , 1. ]])
+>>> T
+array([[0, 1, 3],
+       [1, 4, 3],
+       [1, 2, 4],
+       [2, 5, 4]], dtype=uint32)
+"""
+import functools
+
+import numpy
+
+XI_GRID_CACHE_SIZE = 64
+
+SHAPE_DIMENSIONS = {'line': 1, 'quad': 2, 'tri': 2, 'hex': 3,
+                    'hexagonal': 3}
+
+
+def _freeze(*arrays):
+    for array in arrays:
+        array.flags.writeable = False
+    return arrays
+
+
+def _axis(divs, method):
+    if method == 'center':
+        dx = 0.5 / (divs + 1)
+        return numpy.linspace(dx, 1 - dx, divs + 1)
+    return numpy.linspace(0, 1, divs + 1)
+
+
+def _tensor_grid(divs, method):
+    """
+    Returns the grid points of a tensor product grid with the first xi
+    direction varying fastest and the index of each point as an array
+    of size (divs[-1] + 1, ..., divs[0] + 1).
+    """
+    axes = [_axis(d, method) for d in divs]
+    Xi = numpy.array(numpy.meshgrid(*axes[::-1], indexing='ij'))
+    Xi = Xi.reshape((len(divs), -1))[::-1].T
+    index = numpy.arange(Xi.shape[0]).reshape([d + 1 for d in divs[::-1]])
+    return Xi, index
+
+
+def _line_grid(divs, method):
+    Xi, index = _tensor_grid(divs, method)
+    return Xi, numpy.array([index[:-1], index[1:]]).T
+
+
+def _quad_grid(divs, method):
+    Xi, index = _tensor_grid(divs, method)
+    p00, p01 = index[:-1, :-1], index[:-1, 1:]
+    p10, p11 = index[1:, :-1], index[1:, 1:]
+    # Two triangles per cell, ordered by row then column
+    T = numpy.array([[p00, p01, p10], [p01, p11, p10]])
+    return Xi, T.transpose((2, 3, 0, 1)).reshape((-1, 3))
+
+
+def _tri_grid(divs, method):
+    n = divs[0]
+    xi = _axis(n, method)
+    row, col = numpy.nonzero(numpy.tri(n + 1, dtype=bool)[::-1])
+    Xi = numpy.array([xi[col], xi[row]]).T
+
+    # Index of the first point of each row, row r has n + 1 - r points
+    start = numpy.zeros(n + 2, dtype=int)
+    start[1:] = numpy.cumsum(numpy.arange(n + 1, 0, -1))
+    row, col = numpy.nonzero(numpy.tri(n, dtype=bool)[::-1])
+    p = start[row] + col
+    up = numpy.array([p, p + 1, p + n + 1 - row]).T
+    down = numpy.array([p + 1, p + n + 2 - row, p + n + 1 - row]).T
+    has_down = col < n - row - 1
+    # Interleave the up and down triangles of each row
+    key = numpy.concatenate([2 * numpy.arange(p.size),
+                             2 * numpy.nonzero(has_down)[0] + 1])
+    T = numpy.concatenate([up, down[has_down]])[numpy.argsort(key)]
+    return Xi, T
+
+
+def _hex_grid(divs, method):
+    Xi, index = _tensor_grid(divs, method)
+    cells = [index[k:index.shape[0] - 1 + k, j:index.shape[1] - 1 + j,
+                   i:index.shape[2] - 1 + i]
+             for k in range(2) for j in range(2) for i in range(2)]
+    return Xi, numpy.array([c.ravel() for c in cells]).T
+
+
+GRIDS = {'line': _line_grid, 'quad': _quad_grid, 'tri': _tri_grid,
+         'hex': _hex_grid, 'hexagonal': _hex_grid}
+
+
+@functools.lru_cache(maxsize=XI_GRID_CACHE_SIZE)
+def _xi_grid(shape, divs, method):
+    Xi, T = GRIDS[shape](divs, method)
+    return _freeze(Xi, T.astype('uint32'))
+
 
 def xi_grid(shape='quad', res=[8, 8], units='div', method='fit'):
-    
-    if units == 'div':
-        if isinstance(res, int):
-            divs = [res, res]
-        else:
-            divs = res
-    elif units == 'xi':
+    """
+    Returns the xi locations ``Xi`` of a regular grid on an element
+    ``shape``, 'line', 'quad', 'tri' or 'hex' ('hexagonal'), and the
+    connectivity ``T`` of the grid: segments for lines, triangles for
+    quads and triangles, and hexahedra with the corners ordered like
+    the nodes of a trilinear element for hexes.
+
+    ``res`` is the number of divisions, either the same in all the xi
+    directions or given per direction. Triangle grids need the same
+    number of divisions in both directions. The ``method`` 'fit' places
+    the points from 0 to 1 and 'center' places them at the centres of
+    ``res + 1`` equal intervals.
+
+    The grids are cached and the returned arrays are shared and
+    read-only, copy them before modifying them. ``Element.grid`` and
+    ``Mesh.grid`` return copies.
+    """
+    if units == 'xi':
         raise TypeError('Unimplemented units')
-    
-    nx = divs[0]+1
-    dx = 0.5 / nx
-    if method == 'fit':
-        xi = numpy.linspace(0, 1, divs[0] + 1)
-    elif method == 'center':
-        xi = numpy.linspace(dx, 1 - dx, divs[0] + 1)
+    if shape not in GRIDS:
+        raise ValueError('Unknown shape %s' % shape)
+    dims = SHAPE_DIMENSIONS[shape]
+    if isinstance(res, (int, numpy.integer)):
+        divs = (int(res),) * dims
     else:
-        xi = numpy.linspace(0, 1, divs[0] + 1)
-
-    
-    if shape == 'quad':
-        NPQ = int(nx*nx)
-        NTQ = int(2*(divs[0]*divs[0]))
-        
-        xi1,xi2 = numpy.meshgrid(xi, xi)
-        xi1 = xi1.reshape([xi1.size])
-        xi2 = xi2.reshape([xi2.size])
-        XiQ = numpy.array([xi1, xi2]).T
-        TQ = numpy.zeros((NTQ, 3), dtype='uint32')
-        np = 0
-        for row in range(divs[0]):
-            for col in range(divs[0]):
-                NPPR = row*nx
-                TQ[np,:] = [NPPR+col,NPPR+col+1,NPPR+col+nx]
-                np += 1
-                TQ[np,:] = [NPPR+col+1,NPPR+col+nx+1,NPPR+col+nx]
-                np += 1
-        
-        return XiQ, TQ
-        
-    elif shape == 'tri':
-        NPT = int(0.5*nx*(nx-1)+nx)
-        NTT = int(divs[0]*divs[0])
-        
-        XiT = numpy.zeros([NPT,2])
-        TT = numpy.zeros((NTT, 3), dtype='uint32')
-        NodesPerLine = range(divs[0], 0, -1)
-        np = 0
-        for row in range(nx):
-            for col in range(nx-row):
-                XiT[np,0] = xi[col]
-                XiT[np,1] = xi[row]
-                np += 1
-        
-        np = 0
-        ns = 0
-        for row in range(divs[0]):
-            for col in range(divs[0]-row):
-                TT[np,:] = [ns,ns+1,ns+nx-row]
-                np += 1
-                if col!=divs[0]-row-1:
-                    TT[np,:] = [ns+1,ns+nx-row+1, ns+nx-row]
-                    np += 1
-                ns += 1
-            ns += 1
-        
-        return XiT, TT
+        divs = tuple(int(d) for d in res)
+        if len(divs) < dims:
+            divs = divs + (divs[-1],) * (dims - len(divs))
+        divs = divs[:dims]
+    if shape == 'tri' and divs[0] != divs[1]:
+        raise ValueError('Triangle grids need the same resolution in both '
+                         'directions')
+    return _xi_grid(shape, divs, method)
+
+
+def clear_xi_grid_cache():
+    """
+    Removes the cached xi grids.
+    """
+    _xi_grid.cache_clear()
@@ -6,27 +6,50 @@ class FEMatrix(object):
     Generates a sparse matrix from mesh nodes and element points.
     This can be used for fast matrix evaluations of mesh values,
     particularly for fitting purposes.
+
+    Points added in bulk with ``add_element_points`` are stored as COO
+    triplets and assembled into a CSR matrix when ``A`` is accessed.
     """
 
     def __init__(self, shape):
         self.mesh = None
         self.row_id = 0
         self._auto_increment_row_id = False
-        self.A = scipy.sparse.dok_matrix(shape)
+        self._A = scipy.sparse.dok_matrix(shape)
+        self._triplets = []
         self.rhs = np.zeros(shape[1])
-    
+
+    @property
+    def A(self):
+        if len(self._triplets) > 0:
+            self._assemble()
+        return self._A
+
+    @A.setter
+    def A(self, A):
+        self._A = A
+
+    def _assemble(self):
+        rows, cols, values = [np.concatenate(t) for t in zip(*self._triplets)]
+        self._triplets = []
+        A = scipy.sparse.coo_matrix(
+            (values, (rows, cols)), shape=self._A.shape).tocsr()
+        if self._A.nnz > 0:
+            A = A + self._A.tocsr()
+        self._A = A
+
     def tocsr(self):
         self.A = self.A.tocsr()
-    
+
     def dot(self, other):
         return self.A.dot(other)
-    
+
     def add_mesh(self, mesh):
         self.mesh = mesh
-    
+
     def auto_increment_rows(self, state=True):
         self._auto_increment_row_id = state
-    
+
     def set_row(self, row_index):
         self.row_id = row_index
 
@@ -41,9 +64,63 @@ class FEMatrix(object):
             xi = np.array(xi)
         if len(xi.shape) == 1:
             xi = np.array([xi])
+        if not isinstance(self.A, scipy.sparse.dok_matrix):
+            self.A = self.A.todok()
         cids = self.mesh.elements[eid].get_field_cids(field)
         weights = self.mesh.elements[eid].weights(np.array(xi), deriv=deriv)[0]
         for cid, weight in zip(cids, weights):
             self.A[self.row_id, cid] += scalar * weight
         if self._auto_increment_row_id:
             self.next_row()
+
+    def add_element_points(self, element_ids, xi, fields, deriv=None,
+                           scalars=1, rows=None):
+        """
+        Adds many element points at once. ``element_ids``, ``xi``,
+        ``fields``, ``scalars`` and ``rows`` are parallel arrays with an
+        entry per point; ``fields``, ``deriv`` and ``scalars`` can also be
+        shared by all the points and ``deriv`` can be given per point as
+        a (num_points, num_xi) array.
+
+        If ``rows`` is not given the points are added to the current row
+        or, if rows are auto-incremented, to consecutive rows starting
+        from the current row. Entries with the same row and column are
+        summed.
+
+        >>> from morphic import mesher
+        >>> mesh = mesher.Mesh()
+        >>> n = mesh.add_stdnode(1, [0.])
+        >>> n = mesh.add_stdnode(2, [2.])
+        >>> e = mesh.add_element(1, ['L1'], [1, 2])
+        >>> mesh.generate()
+        >>> fe = FEMatrix((3, 2))
+        >>> fe.add_mesh(mesh)
+        >>> fe.add_element_points([1, 1, 1], [[0.], [0.25], [1.]], 0,
+        ...                       rows=[0, 1, 1])
+        >>> fe.A.toarray()
+        array([[1.  , 0.  ],
+               [0.75, 1.25],
+               [0.  , 0.  ]])
+        """
+        element_ids = np.asarray(element_ids)
+        num_points = element_ids.size
+        cid_map = {}
+        cids = np.zeros(num_points, dtype=int)
+        for idx, eid in enumerate(element_ids.tolist()):
+            if eid not in cid_map:
+                cid_map[eid] = self.mesh.elements[eid].cid
+            cids[idx] = cid_map[eid]
+
+        if rows is None:
+            if self._auto_increment_row_id:
+                rows = self.row_id + np.arange(num_points)
+                self.row_id += num_points
+            else:
+                rows = self.row_id * np.ones(num_points, dtype=int)
+        rows = np.asarray(rows, dtype=int)
+        scalars = np.broadcast_to(np.asarray(scalars, dtype=float),
+                                  (num_points,))
+
+        points, pids, weights = self.mesh._core.point_weights(
+            cids, xi, fields, deriv=deriv)
+        self._triplets.append([rows[points], pids, scalars[points] * weights])
@@ -1,5 +1,6 @@
 import time
 
+import numpy
 import scipy
 import scipy.optimize
 import scipy.sparse
@@ -7,6 +8,7 @@ import scipy.sparse.linalg
 from scipy.spatial import cKDTree
 
 from morphic import core
+from morphic import solvers
 
 class BoundElementPoint:
     
@@ -97,7 +99,7 @@ class BoundNodeValue:
         if self.data_index == None:
             x = mesh.nodes[self.nid].values[0]
             xc = data[self.data].find_closest(x, 1)
-            if isinstance(xc, scipy.ndarray):
+            if isinstance(xc, numpy.ndarray):
                 return xc[field]
             else:
                 return xc
@@ -111,25 +113,28 @@ class Data:
         self.id = label
         self.values = values
         self.tree = None
-        if isinstance(self.values, scipy.ndarray):
+        if isinstance(self.values, numpy.ndarray):
             if len(values.shape) == 2 and values.shape[0] > 1:
                 self.tree = cKDTree(self.values)
             else:
                 self.xc = values
         else:
-            self.values = self.values * scipy.ones((10)) ### HACK ####
-            self.xc = self.values * scipy.ones((10)) ### HACK ####
+            self.values = self.values * numpy.ones((10)) ### HACK ####
+            self.xc = self.values * numpy.ones((10)) ### HACK ####
                 
             
         self.row_ind = 0
         self.Phi = None
         self.ii = None
+        self.rr = None
+        self.xq = None
         self.err_sqr_sum = None
         self.num_err = None
     
     def init_phi(self, M, N):
         self.row_ind = 0
         self.Phi = scipy.sparse.lil_matrix((M, N))
+        self.xq = None
     
     def add_point(self, point):
         if point._class_ == 'elem' and self.tree != None:
@@ -138,14 +143,42 @@ class Data:
                 self.Phi[self.row_ind, pids] = point.param_weights
                 point.data_ids.append(self.row_ind)
                 self.row_ind += 1
+    
+    def query(self, x, tolerance=None):
+        '''
+        Returns the distances and indices of the data closest to the
+        points ``x``. If a ``tolerance`` is given, only the points that
+        moved more than the tolerance since they were last queried are
+        queried, the others keep their closest data point.
+        '''
+        if tolerance is None or self.xq is None or \
+                self.xq.shape != x.shape:
+            self.rr, self.ii = self.tree.query(x, workers=-1)
+            self.xq = x.copy()
+            return self.rr, self.ii
+        dx = x - self.xq
+        moved = numpy.nonzero((dx * dx).sum(1) > tolerance * tolerance)[0]
+        if moved.size > 0:
+            self.ii[moved] = self.tree.query(x[moved], workers=-1)[1]
+            self.xq[moved] = x[moved]
+        dx = x - self.values[self.ii]
+        self.rr = numpy.sqrt((dx * dx).sum(1))
+        return self.rr, self.ii
                 
-    def update_point_data(self, params):
-        if self.Phi != None and self.tree != None:
-            xd = self.Phi.dot(params)
-            rr, ii = self.tree.query(xd.reshape((xd.size/self.values.shape[1], self.values.shape[1])))
-            self.xc = self.values[ii, :].reshape(xd.size)
-            self.num_err = rr.shape[0]
-            self.err_sqr_sum = (rr*rr).sum()
+    def update_point_data(self, params, tolerance=None):
+        if self.Phi is not None and self.tree is not None:
+            self.update_closest(self.Phi.dot(params), tolerance=tolerance)
+    
+    def update_closest(self, xd, tolerance=None):
+        '''
+        Updates the closest data of the element point values ``xd``,
+        see ``query`` for the ``tolerance``.
+        '''
+        rr, ii = self.query(xd.reshape((-1, self.values.shape[1])),
+                            tolerance=tolerance)
+        self.xc = self.values[ii, :].reshape(xd.size)
+        self.num_err = rr.shape[0]
+        self.err_sqr_sum = (rr*rr).sum()
     
     def get_data(self, ind):
         if ind == None:
@@ -154,7 +187,7 @@ class Data:
     
     def find_closest(self, x, num=1):
         if self.tree:
-            r, ii = self.tree.query(list(x))
+            r, ii = self.tree.query(list(x), workers=-1)
             return self.values[ii]
         else:
             return self.values
@@ -173,11 +206,24 @@ class Fit:
             'm2dc': self.objfn_mesh_to_data_closest,
             'data_to_mesh_project': self.objfn_data_to_mesh_project,
             'data_to_mesh_closest': self.objfn_data_to_mesh_closest,
-            'mesh_to_data_closest': self.objfn_mesh_to_data_closest
+            'mesh_to_data_closest': self.objfn_mesh_to_data_closest,
+            'd2ms': self.objfn_data_to_mesh_surface,
+            'data_to_mesh_surface': self.objfn_data_to_mesh_surface
             }
         
+        self._jacfns = {
+            'd2mc': self.jac_data_to_mesh_closest,
+            'm2dc': self.jac_mesh_to_data_closest,
+            'data_to_mesh_closest': self.jac_data_to_mesh_closest,
+            'mesh_to_data_closest': self.jac_mesh_to_data_closest,
+            'd2ms': self.jac_data_to_mesh_surface,
+            'data_to_mesh_surface': self.jac_data_to_mesh_surface
+            }
+        
+        self.jacfn = None
         if isinstance(method, str):
             self.objfn = self._objfns[method]
+            self.jacfn = self._jacfns.get(method)
         
         self.on_start = None
         self.objective_function = None
@@ -185,15 +231,18 @@ class Fit:
         
         self.X = None
         self.Xi = None
+        self.sensitivity = None
         self.A = None
         self.invA = None
         
-        self.svd_UT, self.svd_S, self.svd_VT = None, None, None
-        self.svd_invA = None
-        
+        self.solver = solvers.LSQRSolver()
         
         self.use_sparse = True
         self.param_ids = []
+        self.param_columns = numpy.zeros(0, dtype=int)
+        self.data_map = []
+        self.data_index = None
+        self.data_phi = None
         self.num_dof = 0
         self.num_rows = 0
         
@@ -236,66 +285,144 @@ class Fit:
     def set_data(self, label, values):
         self.data.add(Data(label, values))
     
+    def generate_data_index(self):
+        '''
+        Groups the rows of the data vector by data label into index
+        arrays of rows bound with a data index, rows read from the
+        closest data of element points and rows read from the closest
+        data of nodes.
+        '''
+        index = {}
+        for row, (pid, field) in enumerate(self.data_map):
+            point = self.points[pid]
+            if point.data not in index:
+                index[point.data] = [[[], [], []], [[], []], [[], [], []]]
+            rows_index, rows_elem, rows_node = index[point.data]
+            if point.data_index is not None:
+                rows_index[0].append(row)
+                rows_index[1].append(point.data_index)
+                rows_index[2].append(field)
+            elif point._class_ == 'elem':
+                rows_elem[0].append(row)
+                if point.data_ids is None:
+                    rows_elem[1].append(field)
+                else:
+                    rows_elem[1].append(point.data_ids[field])
+            else:
+                rows_node[0].append(row)
+                rows_node[1].append(point.nid)
+                rows_node[2].append(field)
+        
+        self.data_index = {}
+        for label, rows in index.items():
+            self.data_index[label] = [
+                [numpy.array(r, dtype=int) for r in rows[0]],
+                [numpy.array(r, dtype=int) for r in rows[1]],
+                [numpy.array(rows[2][0], dtype=int), rows[2][1],
+                 numpy.array(rows[2][2], dtype=int)]]
+    
     def get_data(self, mesh):
-        Xd = scipy.zeros(self.num_rows)
-        for ind, dm in enumerate(self.data_map):
-            Xd[ind] = self.points[dm[0]].get_data(self.data, dm[1], mesh)
+        if self.data_index is None:
+            self.generate_data_index()
+        Xd = numpy.zeros(self.num_rows)
+        for label, (rows_index, rows_elem, rows_node) in \
+                self.data_index.items():
+            data = self.data[label]
+            rows, index, fields = rows_index
+            if rows.size > 0:
+                Xd[rows] = data.values[index, fields]
+            rows, index = rows_elem
+            if rows.size > 0:
+                Xd[rows] = data.xc[index]
+            rows, nids, fields = rows_node
+            if rows.size > 0:
+                if data.tree is None:
+                    Xd[rows] = data.values[fields]
+                else:
+                    x = numpy.array([mesh.nodes[nid].values[0] for nid in nids])
+                    ii = data.tree.query(x, workers=-1)[1]
+                    Xd[rows] = data.values[ii, fields]
         return Xd
     
     def delete_all_data(self):
         self.data.reset_object_list()
     
     def get_column_index(self, param_ids):
-        return [self.param_ids.index(pid) for pid in param_ids]
+        return self.param_columns[numpy.asarray(param_ids, dtype=int)]
     
     def update_from_mesh(self, mesh):
         for point in self.points:
             point.update_from_mesh(mesh)
         self.generate_matrix()
     
+    def _get_point_triplets(self, point):
+        '''
+        Returns the rows, parameter ids and weights of a bound point
+        relative to its first row. Rows are ordered by the point fields.
+        '''
+        if point._class_ == 'elem':
+            fields = list(point.fields)
+            param_ids = numpy.asarray(point.param_ids, dtype=int)[fields]
+            weights = point.get_param_weights(None)
+            rows = numpy.repeat(numpy.arange(len(fields)), param_ids.shape[1])
+            return fields, rows, param_ids.ravel(), numpy.tile(
+                weights, len(fields))
+        fields = [point.get_field_id(i) for i in range(point.num_fields)]
+        rows, param_ids, weights = [], [], []
+        for field_ind in range(point.num_fields):
+            pids = numpy.atleast_1d(point.get_param_ids(field_ind))
+            rows.append(field_ind * numpy.ones(pids.size, dtype=int))
+            param_ids.append(pids)
+            weights.append(point.get_param_weights(field_ind))
+        return fields, numpy.concatenate(rows), numpy.concatenate(
+            param_ids), numpy.concatenate(weights)
+    
     def generate_matrix(self):
-        param_ids = []
-        self.num_rows = 0
-        for point in self.points:
-            self.num_rows += point.num_fields
-            if isinstance(point.param_ids, int):
-                param_ids.extend([point.param_ids])
-            elif isinstance(point.param_ids[0], list):
-                param_ids.extend([item for sublist in point.param_ids
-                        for item in sublist])
-            else:
-                param_ids.extend([item for item in point.param_ids])
-        
-        self.param_ids = [pid for pid in set(param_ids)]
-        self.param_ids.sort()
-        self.num_dof = len(self.param_ids)
-        self.W = scipy.ones(self.num_rows)
+        '''
+        Assembles the fit matrix from COO triplets gathered for all the
+        bound points. Parameter ids are mapped to columns through the
+        ``param_columns`` array.
+        '''
+        rows, param_ids, weights, W = [], [], [], []
         self.data_map = []
+        self.data_index = None
+        self.num_rows = 0
+        for pid, point in enumerate(self.points):
+            fields, prows, ppids, pweights = self._get_point_triplets(point)
+            rows.append(prows + self.num_rows)
+            param_ids.append(ppids)
+            weights.append(pweights)
+            W.append(point.get_bind_weight() * numpy.ones(len(fields)))
+            self.data_map.extend([[pid, field] for field in fields])
+            self.num_rows += len(fields)
         
-        if self.use_sparse:
-            self.A = scipy.sparse.lil_matrix((self.num_rows, self.num_dof))
-        
+        if len(rows) > 0:
+            rows = numpy.concatenate(rows)
+            param_ids = numpy.concatenate(param_ids).astype(int)
+            weights = numpy.concatenate(weights).astype(float)
+            self.W = numpy.concatenate(W).astype(float)
         else:
-            self.A = scipy.zeros((self.num_rows, self.num_dof))
+            rows = param_ids = numpy.zeros(0, dtype=int)
+            weights = self.W = numpy.zeros(0)
         
-        row_ind = -1
-        for pid, point in enumerate(self.points):
-            bind_weight = point.get_bind_weight()
-            for field_ind in range(point.num_fields):
-                field = point.get_field_id(field_ind)
-                weights = point.get_param_weights(field_ind)
-                param_ids = point.get_param_ids(field_ind)
-                cols = self.get_column_index(param_ids)
-                row_ind += 1
-                self.data_map.append([pid, field])
-                for col, weight in zip(cols, weights):
-                    self.A[row_ind, col] += weight
-                    self.W[row_ind] = bind_weight
+        unique_ids, cols = numpy.unique(param_ids, return_inverse=True)
+        self.param_ids = unique_ids.tolist()
+        self.num_dof = len(self.param_ids)
+        self.param_columns = -numpy.ones(
+            unique_ids.max() + 1 if unique_ids.size > 0 else 0, dtype=int)
+        self.param_columns[unique_ids] = numpy.arange(self.num_dof)
         
+        self.solver.reset()
+        self.A = scipy.sparse.coo_matrix((weights, (rows, cols.ravel())),
+                shape=(self.num_rows, self.num_dof))
         if self.use_sparse:
             self.A = self.A.tocsc()
+        else:
+            self.A = self.A.toarray()
     
     def generate_fast_data(self):
+        self.data_index = None
+        self.data_phi = None
         num_rows = {}
         for point in self.points:
             if point._class_ == 'elem':
@@ -313,18 +440,85 @@ class Fit:
                     self.data[point.data].add_point(point)
         
         
-    def invert_matrix(self):
-        from sparsesvd import sparsesvd
-        self.svd_UT, self.svd_S, self.svd_VT = sparsesvd(self.A, self.A.shape[1])
-        self.svd_invA = scipy.dot(\
-            scipy.dot(self.svd_VT.T,scipy.linalg.inv(scipy.diag(self.svd_S))),self.svd_UT)
+    def update_point_data(self, params, tolerance=None):
+        '''
+        Updates the closest data of the element points of all the data
+        for the fit parameters ``params``. The element points of all the
+        data are evaluated with one sparse product and the closest data
+        are queried in parallel. If a ``tolerance`` is given, only the
+        element points that moved more than the tolerance are queried.
+        '''
+        if self.data_phi is None:
+            datas = [data for data in self.data
+                     if data.Phi is not None and data.tree is not None]
+            offsets = numpy.cumsum([0] + [data.Phi.shape[0] for data in datas])
+            Phi = None
+            if len(datas) > 0:
+                Phi = scipy.sparse.vstack([data.Phi for data in datas]).tocsr()
+            self.data_phi = [datas, offsets, Phi]
+        datas, offsets, Phi = self.data_phi
+        if Phi is None:
+            return
+        xd = Phi.dot(params)
+        for data, start, stop in zip(datas, offsets[:-1], offsets[1:]):
+            data.update_closest(xd[start:stop], tolerance=tolerance)
+    
+    def invert_matrix(self, solver='svd', **kwargs):
+        '''
+        Precomputes the solution operator of the fit matrix with the
+        ``solver`` backend, by default the SVD pseudo-inverse, which also
+        solves rank-deficient fits, e.g., with parameters that no data is
+        bound to. 'cholesky' is faster for full rank or regularised fits.
+        '''
+        self.set_solver(solver, **kwargs)
+        self.factorize()
     
+    def set_solver(self, solver='lsqr', **kwargs):
+        '''
+        Sets the linear solver used by ``solve``. ``solver`` is a
+        ``morphic.solvers.LinearSolver`` or the name of one, see
+        ``morphic.solvers.get_solver``, e.g., 'lsqr', 'cholesky'
+        (or 'factorized', with optional ``regularisation``), 'qr' or
+        'svd'. Factorizing solvers are factorized on the first solve and
+        again when the bindings or weights change.
+        '''
+        if isinstance(solver, str):
+            solver = solvers.get_solver(solver, **kwargs)
+        self.solver = solver
     
-    def solve(self, mesh, max_iterations=1000, drms=1e-9, output=False):
+    def factorize(self):
+        '''
+        Factorizes the fit matrix with the current solver.
+        '''
+        self.solver.factorize(self.A)
+    
+    def solve_linear(self, Xd):
+        '''
+        Solves the fit matrix for the weighted data ``Xd`` reusing the
+        solver factorization.
+        '''
+        if not self.solver.factorized:
+            self.factorize()
+        return self.solver.solve(Xd)
+    
+    def compile(self, mesh):
+        '''
+        Returns a ``CompiledFit`` to fit new data with the same bindings
+        and mesh topology without re-assembling the fit.
+        '''
+        return CompiledFit(self, mesh)
+    
+    def solve(self, mesh, max_iterations=1000, drms=1e-9, output=False,
+              tolerance=None):
+        '''
+        Fits the mesh to the data by iteratively solving the fit and
+        updating the closest data. If a ``tolerance`` is given, the
+        closest data is only queried again for the element points that
+        moved more than the tolerance.
+        '''
         td, ts = 0, 0
         
-        for data in self.data:
-            data.update_point_data(mesh._core.P[self.param_ids])
+        self.update_point_data(mesh._core.P[self.param_ids])
         
         rms_err0 = self.compute_rms_err()
         
@@ -338,20 +532,16 @@ class Fit:
             Xd = self.get_data(mesh) * self.W
             t1 = time.time()
             
-            if self.svd_invA==None:
-                self.lsqr_result = scipy.sparse.linalg.lsqr(self.A, Xd)
-                solved_x = self.lsqr_result[0]
-            else:
-                solved_x = scipy.dot(self.svd_invA, Xd)
+            solved_x = self.solve_linear(Xd)
                 
             mesh.update_parameters(self.param_ids, solved_x)
             t2 = time.time()
             
-            for data in self.data:
-                data.update_point_data(mesh._core.P[self.param_ids])
+            self.update_point_data(mesh._core.P[self.param_ids],
+                                   tolerance=tolerance)
             
             rms_err1 = self.compute_rms_err()
-            drms_iter = scipy.absolute(rms_err0 - rms_err1)
+            drms_iter = numpy.absolute(rms_err0 - rms_err1)
             rms_err0 = rms_err1
             t3 = time.time()
             
@@ -375,40 +565,83 @@ class Fit:
                 err_sqr_sum += data.err_sqr_sum
                 num_err += data.num_err
         if num_err > 0:
-            return scipy.sqrt(err_sqr_sum/num_err)
+            return numpy.sqrt(err_sqr_sum/num_err)
         else:
-            return scipy.sqrt(err_sqr_sum)
+            return numpy.sqrt(err_sqr_sum)
             
             
-    def optimize(self, mesh, Xd, ftol=1e-9, xtol=1e-9, maxiter=0, output=True):
-        
+    def optimize(self, mesh, Xd, ftol=1e-9, xtol=1e-9, maxiter=0, output=True,
+                 jac=True):
+        '''
+        Fits the mesh variables to the data ``Xd`` by nonlinear least
+        squares with ``scipy.optimize.least_squares``. The mesh is
+        updated for each evaluation, see ``Mesh.update``, so dependent
+        nodes, maps and PCA nodes follow the variables. The closest point
+        and surface objective functions use an analytic sparse Jacobian,
+        unless ``jac`` is False, and the other objective functions use
+        finite differences. The finite differences of the mesh to data
+        objective function use its sparsity, see ``get_jac_sparsity``.
+        '''
         mesh.generate()
         
         Td = cKDTree(Xd)
         
+        kwargs = {}
+        if self.Xi is not None:
+            self.generate_sensitivity(mesh)
+        if jac and self.jacfn is not None:
+            kwargs['jac'] = self.jacfn
+        elif self.objfn == self.objfn_mesh_to_data_closest:
+            kwargs['jac_sparsity'] = self.get_jac_sparsity(mesh)
+        
         x0 = mesh.get_variables()
         t0 = time.time()
-        x, success = scipy.optimize.leastsq(self.objfn, x0,
-                args=[mesh, Xd, Td], ftol=ftol, xtol=xtol,
-                maxfev=maxiter)
+        result = scipy.optimize.least_squares(self.objfn, x0,
+                args=([mesh, Xd, Td],), ftol=ftol, xtol=xtol,
+                max_nfev=maxiter if maxiter > 0 else None, **kwargs)
         if output: print('Fit Time: ', time.time()-t0)
-        mesh.set_variables(x)
+        self._set_variables(mesh, result.x)
         return mesh
     
-    def optimize2(self, mesh, data, ftol=1e-9, xtol=1e-9, epsfcn=None, maxiter=0, output=True):
-        
+    def optimize2(self, mesh, data, ftol=1e-9, xtol=1e-9, epsfcn=None,
+                  maxiter=0, output=True, jac='2-point', jac_sparsity=None):
+        '''
+        Fits the mesh variables with the user ``objective_function`` by
+        nonlinear least squares with ``scipy.optimize.least_squares``.
+        ``jac`` is a function returning the Jacobian of the objective
+        function, which can be sparse, or a finite difference scheme, in
+        which case a ``jac_sparsity`` structure of size
+        (num_residuals, num_variables) reduces the number of evaluations.
+        The Jacobian and sparsity can also be given with respect to the
+        mesh parameters, of size (num_residuals, num_params), and are
+        then composed with the variable map of the mesh, see
+        ``variable_jacobian``. ``epsfcn`` is the finite difference step
+        as in ``leastsq``.
+        '''
         mesh.generate()
         
         if self.on_start != None:
             mesh, data = self.on_start(mesh, data)
         
+        kwargs = {}
+        if epsfcn is not None:
+            kwargs['diff_step'] = numpy.sqrt(epsfcn)
+        if jac_sparsity is not None:
+            kwargs['jac_sparsity'] = self.variable_jacobian(
+                mesh, jac_sparsity, sparsity=True)
+        if callable(jac):
+            param_jac = jac
+            jac = lambda x, args: self.variable_jacobian(
+                mesh, param_jac(x, args))
+        
         x0 = mesh.get_variables()
         t0 = time.time()
-        x, success = scipy.optimize.leastsq(self.objective_function,
-                x0, args=[mesh, data], ftol=ftol, xtol=xtol, epsfcn=epsfcn, maxfev=maxiter)
+        result = scipy.optimize.least_squares(self.objective_function,
+                x0, jac=jac, args=([mesh, data],), ftol=ftol, xtol=xtol,
+                max_nfev=maxiter if maxiter > 0 else None, **kwargs)
                 
         if output: print('Fit Time: ', time.time()-t0)
-        mesh.set_variables(x)
+        mesh.set_variables(result.x)
         mesh.update()
         
         if self.on_stop != None:
@@ -439,50 +672,380 @@ class Fit:
 
     def objfn_mesh_to_data_closest(self, x0, args):
         mesh, Xd, Td = args[0], args[1], args[2]
-        mesh.set_variables(x0)
-        NXi = self.Xi.shape[0]
-        ind = 0
-        for element in mesh.elements:
-            self.X[ind:ind+NXi,:] = element.evaluate(self.Xi)
-            ind += NXi
-        err = Td.query(list(self.X))[0]
+        self._set_variables(mesh, x0)
+        mesh._core.evaluates(mesh.get_element_cids(), self.Xi, X=self.X)
+        err = Td.query(self.X, workers=-1)[0]
         return err*err
     
     def objfn_data_to_mesh_closest(self, x0, args):
         mesh, Xd, Td = args[0], args[1], args[2]
-        mesh.set_variables(x0)
-        NXi = self.Xi.shape[0]
-        ind = 0
-        for element in mesh.elements:
-            self.X[ind:ind+NXi,:] = element.evaluate(self.Xi)
-            ind += NXi
+        self._set_variables(mesh, x0)
+        mesh._core.evaluates(mesh.get_element_cids(), self.Xi, X=self.X)
         Tm = cKDTree(self.X)
-        err = Tm.query(list(Xd))[0]
+        err = Tm.query(Xd, workers=-1)[0]
         self.err = err
         return err*err
     
+    def _set_variables(self, mesh, x0):
+        '''
+        Sets the mesh variables and updates the dependent nodes, maps and
+        PCA nodes, see ``Mesh.update``.
+        '''
+        mesh.set_variables(x0)
+        mesh.update(force=True)
+    
+    def variable_jacobian(self, mesh, J, sparsity=False):
+        '''
+        Composes a Jacobian ``J`` with respect to the mesh parameters, of
+        size (num_residuals, num_params), with the variable map of the
+        mesh at the current parameters, see ``Core.get_variable_map``.
+        The result has size (num_residuals, num_variables). If
+        ``sparsity`` is True, ``J`` is a sparsity structure and the
+        sparsity structure of the composed Jacobian is returned. A
+        Jacobian that already has a column per variable is returned as
+        is.
+        '''
+        core = mesh._core
+        if J.shape[1] != core.P.size or \
+                J.shape[1] == core.variable_ids.size:
+            return J
+        M = core.get_variable_map()
+        if sparsity:
+            J = abs(scipy.sparse.csr_matrix(J, dtype=float))
+            return (J.dot(abs(M)) > 0).astype(int)
+        return scipy.sparse.csr_matrix(J).dot(M)
+    
+    def generate_sensitivity(self, mesh):
+        '''
+        Generates the sparse derivatives of the mesh points evaluated at
+        ``Xi`` in all the elements, as in the closest point objective
+        functions, with respect to the mesh parameters. The matrix has
+        a row per point and field, i.e., size
+        (num_points * num_fields, num_params), and is constant as the
+        mesh is linear in its parameters. The Jacobians compose it with
+        the variable map of the mesh, see ``variable_jacobian``.
+        '''
+        core = mesh._core
+        cids = numpy.array(mesh.get_element_cids(), dtype=int)
+        Xi = numpy.asarray(self.Xi, dtype=float)
+        num_fields = len(core.EMap[cids[0]])
+        num_points = cids.size * Xi.shape[0]
+        point_cids = numpy.repeat(cids, Xi.shape[0])
+        point_xi = numpy.tile(Xi, (cids.size, 1))
+        
+        rows, cols, weights = [], [], []
+        for field in range(num_fields):
+            points, pids, w = core.point_weights(point_cids, point_xi, field)
+            rows.append(points * num_fields + field)
+            cols.append(pids)
+            weights.append(w)
+        self.sensitivity = scipy.sparse.coo_matrix(
+            (numpy.concatenate(weights),
+             (numpy.concatenate(rows), numpy.concatenate(cols))),
+            shape=(num_points * num_fields, core.P.size)).tocsr()
+        return self.sensitivity
+    
+    def get_jac_sparsity(self, mesh):
+        '''
+        Returns the sparsity structure of the Jacobian of
+        ``objfn_mesh_to_data_closest``, of size
+        (num_points, num_variables). The squared distance of a mesh point
+        only depends on the variables that the point depends on, see
+        ``generate_sensitivity``.
+        '''
+        num_rows = self.sensitivity.shape[0]
+        num_fields = num_rows // (len(mesh.get_element_cids()) *
+                                  numpy.asarray(self.Xi).shape[0])
+        R = scipy.sparse.csr_matrix(
+            (numpy.ones(num_rows),
+             (numpy.arange(num_rows) // num_fields, numpy.arange(num_rows))),
+            shape=(num_rows // num_fields, num_rows))
+        return self.variable_jacobian(mesh, R.dot(self.sensitivity),
+                                      sparsity=True)
+    
+    def _jac_closest(self, mesh, points, dX):
+        '''
+        Returns the Jacobian of squared distances given the mesh
+        ``points`` that each residual depends on and the differences
+        ``dX`` between the mesh points and data of size
+        (num_residuals, num_fields).
+        '''
+        num_res, num_fields = dX.shape
+        rows = numpy.repeat(numpy.arange(num_res), num_fields)
+        cols = (num_fields * points[:, numpy.newaxis] +
+                numpy.arange(num_fields)).ravel()
+        D = scipy.sparse.csr_matrix((2 * dX.ravel(), (rows, cols)),
+                shape=(num_res, self.sensitivity.shape[0]))
+        return self.variable_jacobian(mesh, D.dot(self.sensitivity))
+    
+    def jac_mesh_to_data_closest(self, x0, args):
+        '''
+        Sparse Jacobian of ``objfn_mesh_to_data_closest``, see
+        ``generate_sensitivity``.
+        '''
+        mesh, Xd, Td = args[0], args[1], args[2]
+        self._set_variables(mesh, x0)
+        X = mesh._core.evaluates(mesh.get_element_cids(), self.Xi)
+        ii = Td.query(X, workers=-1)[1]
+        return self._jac_closest(mesh, numpy.arange(X.shape[0]),
+                                 X - Xd[ii])
+    
+    def jac_data_to_mesh_closest(self, x0, args):
+        '''
+        Sparse Jacobian of ``objfn_data_to_mesh_closest``, see
+        ``generate_sensitivity``.
+        '''
+        mesh, Xd, Td = args[0], args[1], args[2]
+        self._set_variables(mesh, x0)
+        X = mesh._core.evaluates(mesh.get_element_cids(), self.Xi)
+        ii = cKDTree(X).query(Xd, workers=-1)[1]
+        return self._jac_closest(mesh, ii, X[ii] - Xd)
+    
+    def objfn_data_to_mesh_surface(self, x0, args):
+        '''
+        Squared distances of the data to the closest points on the mesh
+        elements, found with the element tree of the mesh, see
+        ``Mesh.get_element_tree``.
+        '''
+        mesh, Xd, Td = args[0], args[1], args[2]
+        self._set_variables(mesh, x0)
+        err = mesh.get_element_tree().query(Xd)[2]
+        return err * err
+    
+    def jac_data_to_mesh_surface(self, x0, args):
+        '''
+        Sparse Jacobian of ``objfn_data_to_mesh_surface``. The closest
+        points are stationary in xi so only the mesh derivatives at the
+        closest xi locations are needed.
+        '''
+        mesh, Xd, Td = args[0], args[1], args[2]
+        self._set_variables(mesh, x0)
+        core = mesh._core
+        eids, xi, dist = mesh.get_element_tree().query(Xd)
+        cids = numpy.array([mesh.elements[eid].cid for eid in eids],
+                           dtype=int)
+        dX = core.evaluate_points(cids, xi) - Xd
+        rows, cols, values = [], [], []
+        for field in range(dX.shape[1]):
+            points, pids, weights = core.point_weights(cids, xi, field)
+            rows.append(points)
+            cols.append(pids)
+            values.append(2 * dX[points, field] * weights)
+        J = scipy.sparse.coo_matrix(
+            (numpy.concatenate(values),
+             (numpy.concatenate(rows), numpy.concatenate(cols))),
+            shape=(Xd.shape[0], core.P.size)).tocsr()
+        return self.variable_jacobian(mesh, J)
+    
     def objfn_data_to_mesh_project(self, x0, args):
         mesh, Xd, Td = args[0], args[1], args[2]
-        mesh.set_variables(x0)
-        err = scipy.zeros(Xd.shape[0])
-        ind = 0
-        for xd in Xd:
-            xi1 = mesh.elements[1].project(xd)
-            xi2 = mesh.elements[2].project(xd)
-            if 0<=xi1<=1:
-                xi = xi1
-            elif 0<=xi2<=1:
-                xi = xi2
+        self._set_variables(mesh, x0)
+        err = mesh.project(Xd)[2]
+        return err * err
+
+
+class _CompiledData(object):
+    '''
+    Index arrays to build the rows of the data vector bound to one data
+    label. Rows bound with a data index read ``values[index, field]``,
+    the other rows read the field of the data point closest to an
+    element point or node.
+    '''
+    
+    def __init__(self):
+        self.index_rows, self.index, self.index_fields = [], [], []
+        self.elem_rows, self.elem_points, self.elem_fields = [], [], []
+        self.node_rows, self.node_points, self.node_fields = [], [], []
+        self.node_pids = []
+        self.phi = [[], [], []]
+        self.phi_points, self.node_index_map = {}, {}
+        self.num_elem_fields = 0
+        self.num_elem_points = 0
+    
+    def add_element_point(self, row, field, point):
+        if point.data_index is not None:
+            self._add_index(row, point.data_index, field)
+            return
+        if point not in self.phi_points:
+            self.phi_points[point] = self.num_elem_points
+            nef = len(point.param_ids)
+            self.num_elem_fields = nef
+            for ef, pids in enumerate(point.param_ids):
+                self.phi[0].extend([self.num_elem_points * nef + ef] * len(pids))
+                self.phi[1].extend(pids)
+                self.phi[2].extend(point.param_weights)
+            self.num_elem_points += 1
+        self.elem_rows.append(row)
+        self.elem_points.append(self.phi_points[point])
+        self.elem_fields.append(field)
+    
+    def add_node_value(self, row, field, point, mesh):
+        if point.data_index is not None:
+            self._add_index(row, point.data_index, field)
+            return
+        if point not in self.node_index_map:
+            self.node_index_map[point] = len(self.node_pids)
+            self.node_pids.append(mesh.nodes[point.nid]._get_param_indicies()[0])
+        self.node_rows.append(row)
+        self.node_points.append(self.node_index_map[point])
+        self.node_fields.append(field)
+    
+    def _add_index(self, row, index, field):
+        self.index_rows.append(row)
+        self.index.append(index)
+        self.index_fields.append(field)
+    
+    def compile(self, num_params):
+        for attr in ['index_rows', 'index', 'index_fields', 'elem_rows',
+                     'elem_points', 'elem_fields', 'node_rows', 'node_points',
+                     'node_fields', 'node_pids']:
+            setattr(self, attr, numpy.array(getattr(self, attr), dtype=int))
+        self.closest_rows = numpy.append(self.elem_rows, self.node_rows)
+        self.closest_fields = numpy.append(self.elem_fields, self.node_fields)
+        self.Phi = scipy.sparse.csr_matrix(
+            (self.phi[2], (self.phi[0], self.phi[1])),
+            shape=(self.num_elem_points * self.num_elem_fields, num_params))
+        del self.phi, self.phi_points, self.node_index_map
+    
+    def get_data(self, Xd, P, values, tree):
+        '''
+        Writes the rows of the data vector ``Xd`` for the mesh
+        parameters ``P``. Returns the sum of the squared closest point
+        distances of the element points and their number.
+        '''
+        if self.index_rows.size > 0:
+            Xd[self.index_rows] = values[self.index, self.index_fields]
+        if tree is None:
+            # Single valued data is shared by all the fields
+            flat = values.ravel()
+            Xd[self.closest_rows] = flat[self.closest_fields % flat.size]
+            return 0, 0
+        err_sqr_sum, num_err = 0, 0
+        if self.elem_rows.size > 0:
+            x = self.Phi.dot(P).reshape((-1, self.num_elem_fields))
+            rr, ii = tree.query(x, workers=-1)
+            Xd[self.elem_rows] = values[ii[self.elem_points], self.elem_fields]
+            err_sqr_sum, num_err = (rr * rr).sum(), rr.size
+        if self.node_rows.size > 0:
+            ii = tree.query(P[self.node_pids], workers=-1)[1]
+            Xd[self.node_rows] = values[ii[self.node_points], self.node_fields]
+        return err_sqr_sum, num_err
+
+
+class CompiledFit(object):
+    '''
+    A fit compiled once for a mesh topology and a set of bindings. The
+    fit matrix, data maps and solver factorization are captured so new
+    subjects, i.e., new data values and optionally new initial mesh
+    parameters, are solved without any assembly. Several subjects can
+    be solved together with one multiple right-hand side solve per
+    iteration.
+    
+    Data values are given as a dict of data label to values, or as an
+    array if the fit has a single data label. Labels that are not given
+    use the data set on the fit when it was compiled.
+    '''
+    
+    def __init__(self, fit, mesh):
+        mesh.generate()
+        if fit.A is None:
+            fit.update_from_mesh(mesh)
+        if not fit.solver.factorized:
+            fit.factorize()
+        # A copy so that regenerating the fit does not reset it
+        self.solver = fit.solver.copy()
+        self.W = numpy.array(fit.W, dtype=float)
+        self.param_ids = numpy.array(fit.param_ids, dtype=int)
+        self.num_rows = fit.num_rows
+        self.P = mesh._core.P.copy()
+        self.data = {}
+        for data in fit.data:
+            self.data[data.id] = data.values
+        self._compile_data_map(fit, mesh)
+    
+    def _compile_data_map(self, fit, mesh):
+        self.compiled_data = {}
+        for row, (pid, field) in enumerate(fit.data_map):
+            point = fit.points[pid]
+            if point.data not in self.compiled_data:
+                self.compiled_data[point.data] = _CompiledData()
+            compiled = self.compiled_data[point.data]
+            if point._class_ == 'elem':
+                compiled.add_element_point(row, field, point)
             else:
-                Xi = scipy.array([xi1, xi1-1, xi2, xi2-1])
-                Xi2 = Xi*Xi
-                ii = Xi2.argmin()
-                xi = Xi[ii]
-                if ii < 2:
-                    elem = 1
-                else:
-                    elem = 2
-            dx = mesh.elements[elem].evaluate(scipy.array([xi]))[0] - xd
-            err[ind] = scipy.sum(dx * dx)
-            ind += 1
-        return err
+                compiled.add_node_value(row, field, point, mesh)
+        for compiled in self.compiled_data.values():
+            compiled.compile(self.P.size)
+    
+    def _get_subject(self, data):
+        if data is None:
+            data = {}
+        elif not isinstance(data, dict):
+            if len(self.compiled_data) != 1:
+                raise ValueError('Data must be a dict of data labels to '
+                                 'values for fits with several data labels')
+            data = {list(self.compiled_data.keys())[0]: data}
+        subject = {}
+        for label in self.compiled_data.keys():
+            values = numpy.asarray(data.get(label, self.data.get(label)),
+                                   dtype=float)
+            tree = None
+            if values.ndim == 2 and values.shape[0] > 1:
+                tree = cKDTree(values)
+            subject[label] = [values, tree]
+        return subject
+    
+    def get_data(self, P, subject):
+        '''
+        Returns the data vector for the mesh parameters ``P`` and the
+        RMS error of the closest element points.
+        '''
+        Xd = numpy.zeros(self.num_rows)
+        err_sqr_sum, num_err = 0, 0
+        for label, compiled in self.compiled_data.items():
+            values, tree = subject[label]
+            err = compiled.get_data(Xd, P, values, tree)
+            err_sqr_sum += err[0]
+            num_err += err[1]
+        return Xd, numpy.sqrt(err_sqr_sum / max(num_err, 1))
+    
+    def solve(self, data=None, P=None, max_iterations=1000, drms=1e-9):
+        '''
+        Fits one subject. Returns the fitted mesh parameters and the RMS
+        error.
+        '''
+        Ps = None if P is None else [P]
+        Ps, rms = self.solve_batch([data], Ps=Ps,
+                max_iterations=max_iterations, drms=drms)
+        return Ps[0], rms[0]
+    
+    def solve_batch(self, datas, Ps=None, max_iterations=1000, drms=1e-9):
+        '''
+        Fits several subjects, ``datas`` is a list of data for each
+        subject and ``Ps`` optional initial mesh parameters of size
+        (num_subjects, num_params). The data vectors of the subjects
+        that have not converged are solved together each iteration.
+        Returns the fitted parameters and the RMS error of each subject.
+        '''
+        subjects = [self._get_subject(data) for data in datas]
+        if Ps is None:
+            Ps = numpy.tile(self.P, (len(subjects), 1))
+        else:
+            Ps = numpy.array(Ps, dtype=float)
+        Xd = numpy.zeros((self.num_rows, len(subjects)))
+        rms = numpy.zeros(len(subjects))
+        for i, subject in enumerate(subjects):
+            Xd[:, i], rms[i] = self.get_data(Ps[i], subject)
+        
+        active = numpy.ones(len(subjects), dtype=bool)
+        niter = 0
+        while active.any() and niter < max_iterations:
+            niter += 1
+            idx = numpy.nonzero(active)[0]
+            X = self.solver.solve(Xd[:, idx] * self.W[:, numpy.newaxis])
+            Ps[numpy.ix_(idx, self.param_ids)] = X.T
+            for i in idx:
+                Xd[:, i], rms1 = self.get_data(Ps[i], subjects[i])
+                active[i] = numpy.absolute(rms[i] - rms1) > drms
+                rms[i] = rms1
+        return Ps, rms
@@ -1,3 +1,4 @@
+import numpy
 import scipy
 import scipy.sparse as sparse
 import scipy.sparse.linalg as linalg
@@ -6,6 +7,8 @@ from scipy.spatial import cKDTree
 import sys
 import pickle
 
+from morphic import solvers
+
 def normalise(v):
     return v/scipy.sqrt(scipy.sum(v*v))
 
@@ -442,10 +445,7 @@ class Fit():
         self.ndp = 1
         self.XdKDTree = None
         
-        self.svd_UT = None
-        self.svd_S = None
-        self.svd_VT = None
-        self.svd_invA = None
+        self.solver = solvers.LSQRSolver()
         
         if filepath!=None:
             self.load(filepath)
@@ -464,8 +464,9 @@ class Fit():
         h5Nodes[:] = self.Nodes
         h5Weights = h5f.createCArray(h5f.root, 'Weights', atom1, self.Weights.shape, filters=filters)
         h5Weights[:] = self.Weights
-        invA = h5f.createCArray(h5f.root, 'invA', atom1, self.svd_invA.shape, filters=filters)
-        invA[:,:] = self.svd_invA
+        solver = numpy.frombuffer(pickle.dumps(self.solver), dtype='uint8')
+        h5solver = h5f.createCArray(h5f.root, 'solver', tables.UInt8Atom(), solver.shape, filters=filters)
+        h5solver[:] = solver
         b = h5f.createCArray(h5f.root, 'b', atom1, self.b.shape, filters=filters)
         b[:] = self.b
         fixed = h5f.createCArray(h5f.root, 'fixed', atom1, self.fixed.shape, filters=filters)
@@ -481,7 +482,11 @@ class Fit():
         self.NWMap = h5f.root.NWMap[:,:]
         self.Nodes = h5f.root.Nodes[:]
         self.Weights = h5f.root.Weights[:]
-        self.svd_invA = h5f.root.invA[:,:]
+        if hasattr(h5f.root, 'solver'):
+            self.solver = pickle.loads(h5f.root.solver[:].tobytes())
+        else:
+            # Fits saved before the solvers store the dense inverse
+            self.solver = solvers.InverseSolver(h5f.root.invA[:,:])
         self.b = h5f.root.b[:]
         self.fixed = h5f.root.fixed[:]
         self.NPoints = h5f.root.npbs[0]
@@ -489,7 +494,7 @@ class Fit():
         self.NFix = h5f.root.npbs[2]
         self.NSmooth = h5f.root.npbs[3]
         h5f.close()
-        self._NDoF = self.svd_invA.shape[0]
+        self._NDoF = self.solver.shape[1]
         
     
     def add_element_points(self, Elements, Xi):
@@ -567,11 +572,11 @@ class Fit():
         self.Nodes = scipy.array([n for n in Nodes])
         self.Weights = scipy.array([w for w in Weights])            
         
-    def invert_matrix(self):
-        from sparsesvd import sparsesvd
-        self.svd_UT, self.svd_S, self.svd_VT = sparsesvd(self.A, self.A.shape[1])
-        self.svd_invA = scipy.dot(\
-            scipy.dot(self.svd_VT.T,scipy.linalg.inv(scipy.diag(self.svd_S))),self.svd_UT)
+    def invert_matrix(self, solver='svd', **kwargs):
+        if isinstance(solver, str):
+            solver = solvers.get_solver(solver, **kwargs)
+        self.solver = solver
+        self.solver.factorize(self.A)
 
         
     def update_element_xi(self):
@@ -634,6 +639,7 @@ class Fit():
                             self.fixed[NR] = 1
         
         self.A = A.tocsc()
+        self.solver.reset()
         
     def set_data(self, Xd, mode='one-to-one', ndp=1):
         self.Xd = Xd
@@ -683,12 +689,10 @@ class Fit():
         
         
     def solve_iteration(self, Xdr):
-        if self.svd_invA==None:
-            self.lsqr_result = linalg.lsqr(self.A, Xdr)
-            self.x = self.lsqr_result[0].reshape((self.NDoF()/3,3))
-        else:
-            svd_x = scipy.dot(self.svd_invA, Xdr)
-            self.x = svd_x.reshape((self.NDoF()/3,3))
+        if not self.solver.factorized:
+            self.solver.factorize(self.A)
+        x = self.solver.solve(Xdr)
+        self.x = x.reshape((self.NDoF()/3,3))
         
         
     def solve(self, X=None, maxiter=1, drms=1e-9, Nd=1, output=False):
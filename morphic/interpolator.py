@@ -1,6 +1,11 @@
+import functools
+
 import numpy
 import numpy.linalg
 
+# Maximum number of compiled basis kernels kept by get_kernel
+KERNEL_CACHE_SIZE = 128
+
 def weights(basis, X, deriv=None):
     """
     Calculates the interpolant value or derivative weights for points X.
@@ -35,30 +40,93 @@ def weights(basis, X, deriv=None):
                         WW[i + 1] = 1
         return WW
 
-    basis_functions, dimensions = _get_basis_functions(basis, deriv)
-    X = _process_x(X, dimensions)
+    return get_kernel(basis, deriv)(X)
+
+
+def get_kernel(basis, deriv=None):
+    """
+    Returns the compiled weights kernel for a basis and derivative
+    combination. Kernels are built once and kept in a bounded LRU cache
+    so repeated calls to :func:`weights` skip the basis function lookup
+    and the product index generation.
     
-    W = []
-    for bf in basis_functions:
-        if bf[0].__name__[0] == 'T':
-            W.append(bf[0](X[:, bf[1]]))
-        else:
-            W.append(bf[0](X[:, bf[1]])[0])
+    :param basis: interpolation function in each direction, eg,
+        ``['L1', 'L1']`` for bilinear.
+    :type basis: list of strings
+    :param deriv: derivative in each dimension, e.g., ``deriv=[1, 1]``
+    :type deriv: list of integers
+    :return: weights kernel
+    :rtype: BasisKernel
+    
+    >>> kernel = get_kernel(['L1', 'L1'], deriv=[1, 0])
+    >>> kernel is get_kernel(['L1', 'L1'], deriv=[1, 0])
+    True
+    >>> kernel.num_weights
+    4
+    
+    """
+    if deriv is not None:
+        deriv = tuple(int(d) for d in deriv)
+    return _get_cached_kernel(tuple(basis), deriv)
+
+
+@functools.lru_cache(maxsize=KERNEL_CACHE_SIZE)
+def _get_cached_kernel(basis, deriv):
+    return BasisKernel(basis, deriv)
+
+
+def clear_kernel_cache():
+    """
+    Removes all the compiled weights kernels from the cache.
+    """
+    _get_cached_kernel.cache_clear()
+
+
+class BasisKernel(object):
+    """
+    Evaluates the interpolant weights for a fixed basis and derivative.
     
-    BPInd = _get_basis_product_indices(basis, dimensions, W)             
+    The basis functions and the tensor-product indices are resolved
+    when the kernel is created. The product indices are stored as an
+    integer array of size (ndims, nweights) so that all the weight
+    columns are computed with one fancy-indexed multiply per dimension.
+    """
     
-    if BPInd is None:
-        return W[0]
+    def __init__(self, basis, deriv=None):
+        self.basis = list(basis)
+        self.deriv = None if deriv is None else list(deriv)
+        self.basis_functions, self.dimensions = _get_basis_functions(
+            self.basis, self.deriv)
         
-    WW = numpy.zeros((X.shape[0], len(BPInd)))
-    if dimensions == 3:
-        for ind, ii in enumerate(BPInd):
-            WW[:, ind] = W[0][:, ii[0]] * W[1][:, ii[1]] * W[2][:, ii[2]]
-    else:
-        for ind, ii in enumerate(BPInd):
-            WW[:, ind] = W[0][:, ii[0]] * W[1][:, ii[1]]
+        W = self._basis_weights(numpy.zeros((1, self.dimensions)))
+        BPInd = _get_basis_product_indices(self.basis, self.dimensions, W)
+        if BPInd is None:
+            self.product_indices = None
+            self.num_weights = W[0].shape[-1]
+        else:
+            self.product_indices = numpy.array(BPInd, dtype=int).T
+            self.num_weights = self.product_indices.shape[1]
+    
+    def _basis_weights(self, X):
+        W = []
+        for bf in self.basis_functions:
+            if bf[0].__name__[0] == 'T':
+                W.append(bf[0](X[:, bf[1]]))
+            else:
+                W.append(bf[0](X[:, bf[1]])[0])
+        return W
     
-    return WW
+    def __call__(self, X):
+        X = _process_x(X, self.dimensions)
+        W = self._basis_weights(X)
+        
+        if self.product_indices is None:
+            return W[0]
+        
+        WW = W[0][:, self.product_indices[0]]
+        for w, ii in zip(W[1:], self.product_indices[1:]):
+            WW = WW * w[:, ii]
+        return WW
 
 
 def _get_basis_product_indices(basis, dimensions, W):
@@ -137,8 +205,8 @@ def _get_basis_functions(basis, deriv):
         'L3': [L3, L3d1],
         'L4': [L4, L4d1],
         'H3': [H3, H3d1, H3d1d1],
-        'T11': [T11],
-        'T22': [T22],
+        'T11': [T11, T11d1, T11d2],
+        'T22': [T22, T22d1, T22d2],
         'T33': [T33, T33d1, T33d2],
         'T44': [T44, T44d1, T44d2]}
     
@@ -418,6 +486,32 @@ def T11(x): # Linear-Linear
     return numpy.array([L1, L2, L3]).T
 
 
+def T11d1(x): # Linear-Linear
+    """
+    First derivative in dimension 1 for the linear lagrange triangle
+    element.
+    
+    :param x: points to interpolate 0<=x<=1, x1+x2<=1
+    :type x: numpy array (npoints, 2)
+    :return: basis weights
+    :rtype: numpy array(npoints, 3)
+    """
+    return numpy.array([[-1., 1., 0.]]).repeat(x.shape[0], axis=0)
+
+
+def T11d2(x): # Linear-Linear
+    """
+    First derivative in dimension 2 for the linear lagrange triangle
+    element.
+    
+    :param x: points to interpolate 0<=x<=1, x1+x2<=1
+    :type x: numpy array (npoints, 2)
+    :return: basis weights
+    :rtype: numpy array(npoints, 3)
+    """
+    return numpy.array([[-1., 0., 1.]]).repeat(x.shape[0], axis=0)
+
+
 def T22(x): # Quadratic-Quadratic
     """
     Quadratic lagrange triangle element.
@@ -434,6 +528,40 @@ def T22(x): # Quadratic-Quadratic
     return Phi.T
 
 
+def T22d1(x): # Quadratic-Quadratic
+    """
+    First derivative in dimension 1 for the quadratic lagrange triangle
+    element.
+    
+    :param x: points to interpolate 0<=x<=1, x1+x2<=1
+    :type x: numpy array (npoints, 2)
+    :return: basis weights
+    :rtype: numpy array(npoints, 6)
+    """
+    L1, L2, L3 = 1-x[:, 0]-x[:, 1], x[:, 0], x[:, 1]
+    Phi = numpy.array([ \
+        1.0-4.0*L1, 4.0*(L1-L2), 4.0*L2-1.0, \
+        -4.0*L3, 4.0*L3, 0.0*L3])
+    return Phi.T
+
+
+def T22d2(x): # Quadratic-Quadratic
+    """
+    First derivative in dimension 2 for the quadratic lagrange triangle
+    element.
+    
+    :param x: points to interpolate 0<=x<=1, x1+x2<=1
+    :type x: numpy array (npoints, 2)
+    :return: basis weights
+    :rtype: numpy array(npoints, 6)
+    """
+    L1, L2, L3 = 1-x[:, 0]-x[:, 1], x[:, 0], x[:, 1]
+    Phi = numpy.array([ \
+        1.0-4.0*L1, -4.0*L2, 0.0*L2, \
+        4.0*(L1-L3), 4.0*L2, 4.0*L3-1.0])
+    return Phi.T
+
+
 def T33(x): # Cubic-Cubic
     """
     Cubic lagrange triangle element.
@@ -28,11 +28,12 @@ interpolation.
 import datetime
 import os
 import sys
+import warnings
 import numpy
 
 from scipy import linalg
 
-from morphic import core, discretizer, metadata, utils
+from morphic import core, discretizer, metadata, proximity, utils
 
 
 class Values(numpy.ndarray):
@@ -67,7 +68,7 @@ class NodeValues(object):
         if values.shape != instance.shape:
             raise IndexError('Cannot set values with a different shaped'
                              + ' array. User node.set_values(values) instead')
-        instance.mesh._core.P[instance.cids] = values.flatten()
+        instance.mesh._core.update_params(instance.cids, values.flatten())
 
 
 class Node(object):
@@ -137,7 +138,7 @@ class Node(object):
         self._added = True
 
     def _set_values(self, pids, values):
-        self.mesh._core.P[pids] = values
+        self.mesh._core.update_params(pids, values)
 
     def add_to_group(self, groups):
         if not isinstance(groups, list):
@@ -403,6 +404,44 @@ class PCANode(Node):
         self._initialise(True)
 
 
+def _length_fields(num_fields):
+    return [[i, 1] for i in range(num_fields)]
+
+
+def _area_fields(num_fields):
+    fields = []
+    for i in range(num_fields):
+        fields.append([i, 1, 0])
+        fields.append([i, 0, 1])
+    return fields
+
+
+def _volume_fields(num_fields):
+    fields = []
+    for i in range(num_fields):
+        fields.append([i, 1, 0, 0])
+        fields.append([i, 0, 1, 0])
+        fields.append([i, 0, 0, 1])
+    return fields
+
+
+def _length_integrand(X):
+    return numpy.sqrt((X ** 2).sum(1))
+
+
+def _area_integrand(X):
+    # sqrt(det(J^T J)) with the rows of J the field derivatives
+    J = X.reshape((X.shape[0], -1, 2))
+    a11 = (J[:, :, 0] ** 2).sum(1)
+    a22 = (J[:, :, 1] ** 2).sum(1)
+    a12 = (J[:, :, 0] * J[:, :, 1]).sum(1)
+    return numpy.sqrt(a11 * a22 - a12 * a12)
+
+
+def _volume_integrand(X):
+    return numpy.linalg.det(X.reshape((X.shape[0], 3, 3)))
+
+
 class Element(object):
     def __init__(self, mesh, uid, basis, node_ids):
         self._type = 'element'
@@ -528,8 +567,13 @@ class Element(object):
     #             self.mesh.add_face(self.id, face_index, face_nodes[face_index])
 
     def grid(self, res=[8, 8]):
+        """
+        Returns a grid of xi locations on the element. The array is a
+        copy of the cached grid of ``discretizer.xi_grid`` and can be
+        modified.
+        """
         return discretizer.xi_grid(
-            shape=self.shape, res=res, units='div')[0]
+            shape=self.shape, res=res, units='div')[0].copy()
 
     def get_field_cids(self, field_index):
         return self.core.EMap[self.cid][field_index]
@@ -587,8 +631,8 @@ class Element(object):
         '''
         Integration using gaussian quadrature.
         
-        Only supports up to two dimensions. The generation of the gauss
-        points for 3 dimensions and up is required to extend this.
+        Line, quad and hexagonal elements use tensor-product
+        Gauss-Legendre points and triangles use a triangle rule.
         
         Input:
           - fields is a list of fields to integrate. The format is
@@ -597,84 +641,35 @@ class Element(object):
             the integral of Field0, dField2/dx1, and d^2Field1/dx2^2.
           - func is a function that will take the field values process them
             and return the processed values for the fields
-          - ng is the number of gauss point. Default is 4. Max is 6.
-            For 2D, the number of gauss points in each direction is
-            given using [ng1, ng2, ...].
+          - ng is the number of gauss point in each dimension. Default
+            is 4. The number of gauss points in each direction can
+            also be given using [ng1, ng2, ...].
         
         Returns:
           - integral of the fields or processed fields by 'func'
         '''
-        if self.shape == 'line':
-            Xi, W = self.core.get_gauss_points(ng)
-            X = self.mesh._core.evaluate_fields(self.cid, Xi, fields)
-            if func is not None:
-                X = func(X)
-            integral = numpy.dot(W, X)
-        elif self.shape in ['quad', 'tri']:
-            Xi, W = self.core.get_gauss_points([ng, ng])
-            X = self.mesh._core.evaluate_fields(self.cid, Xi, fields)
-            if func is not None:
-                X = func(X)
-            integral = numpy.dot(W, X)
-        elif self.shape == 'hexagonal':
-            Xi, W = self.core.get_gauss_points([ng, ng, ng])
-            X = self.mesh._core.evaluate_fields(self.cid, Xi, fields)
-            if func is not None:
-                X = func(X)
-            integral = numpy.dot(W, X)
-        else:
-            raise ValueError('Unknown element shape for integral.')
-
-        return integral
+        return self.core.integrates([self.cid], fields, func=func, ng=ng)[0]
 
     def length(self, ng=3):
-
-        def _length_integral(X):
-            return numpy.sqrt((X ** 2).sum(1))
-
         if self.shape == 'line':
-            fields = []
-            for i in range(self.num_fields):
-                fields.append([i, 1])
-            return self.integrate(fields, func=_length_integral, ng=ng)
+            return self.integrate(_length_fields(self.num_fields),
+                                  func=_length_integrand, ng=ng)
         else:
             raise TypeError('You can only calculate the length '
                             + 'of a 1D element.')
 
     def area(self, ng=3):
-
-        def _area_integral(X):
-            A = []
-            for x in X:
-                x = x.reshape((2, x.size / 2))
-                c = numpy.cross(x[0], x[1])
-                A.append(numpy.sqrt((c * c).sum()))
-            return A
-
         if self.shape == 'quad':
-            fields = []
-            for i in range(self.num_fields):
-                fields.append([i, 1, 0])
-                fields.append([i, 0, 1])
-            return self.integrate(fields, func=_area_integral, ng=ng)
+            return self.integrate(_area_fields(self.num_fields),
+                                  func=_area_integrand, ng=ng)
         else:
             raise TypeError('You can only calculate the area '
                             + 'of a 2D quad element. Triangles not implemented.')
 
     def volume(self, ng=3):
-
-        def _volume_integral(X):
-            V = X[:, 0] * (X[:, 4] * X[:, 8] - X[:, 5] * X[:, 7]) - X[:, 1] * (X[:, 3] * X[:, 8]
-                - X[:, 5] * X[:, 6]) + X[:, 2] * (X[:, 3] * X[:, 7] - X[:, 4] * X[:, 6])
-            return V
-
         if self.shape == 'hexagonal':
-            fields = []
-            for i in range(self.num_fields):
-                fields.append([i, 1, 0, 0])
-                fields.append([i, 0, 1, 0])
-                fields.append([i, 0, 0, 1])
-            return abs(self.integrate(fields, func=_volume_integral, ng=ng))
+            return abs(self.integrate(_volume_fields(self.num_fields),
+                                      func=_volume_integrand, ng=ng))
         else:
             raise TypeError('You can only calculate the volume '
                             + 'of a 3D hexagonal element. Triangles not implemented.')
@@ -697,23 +692,26 @@ class Element(object):
         dx2 = self.mesh.core.evaluate(self.cid, Xi, deriv=[0, 1])
         return numpy.cross(dx1, dx2)
 
-    def _project_objfn(self, xi, *args):
-        x = args[0]
-        xe = self.evaluate(xi)
-        dx = xe - x
-        return numpy.sum(dx * dx)
-
-    def project(self, x, xi=None, xtol=1e-4, ftol=1e-4):
-        from scipy.optimize import fmin
-
-        if xi == None:
-            if self.shape == 'line':
-                xi = 0.5
-            else:
-                xi = [0.5, 0.5]
-        xi_opt = fmin(self._project_objfn, xi, args=(x),
-                      xtol=xtol, ftol=ftol, disp=False)
-        return xi_opt
+    def project(self, x, xi=None, xtol=1e-8, ftol=None, max_iterations=50):
+        '''
+        Returns the xi location on the element closest to the point
+        ``x``. The projection starts from ``xi`` if given, otherwise
+        from several starts on a grid over the element, see
+        ``Core.closest_points``. ``ftol`` is deprecated and ignored, the
+        projection stops when the xi step is smaller than ``xtol``.
+        '''
+        if ftol is not None:
+            warnings.warn('Element.project ftol is deprecated and ignored, '
+                          'use xtol', DeprecationWarning, stacklevel=2)
+        x = numpy.array([x], dtype=float)
+        if xi is None:
+            xi, dist = self.mesh._core.closest_points(
+                [self.cid], x, max_iterations=max_iterations, xtol=xtol)
+        else:
+            xi, dist = self.mesh._core.project_points(
+                [self.cid], x, numpy.array([xi], dtype=float).reshape((1, -1)),
+                max_iterations=max_iterations, xtol=xtol)
+        return xi[0]
 
     def __iter__(self):
         return self.nodes.__iter__()
@@ -879,6 +877,8 @@ class Mesh(object):
         self.core = self._core
         self._regenerate = True
         self._reupdate = True
+        self._element_trees = {}
+        self._tessellations = {}
 
         self.auto_add_faces = True
         self.auto_add_lines = True
@@ -1382,6 +1382,7 @@ class Mesh(object):
                 self.nodes.add(node)
 
         self._core.P = h5f.root.params.read()
+        self._core.touch_params()
         elem_node = h5f.root.element_nodes.read()
 
         for ne, h5elem in enumerate(h5f.root.elements.iterrows()):
@@ -1543,6 +1544,7 @@ class Mesh(object):
                 self.nodes.add(node)
 
         self.core.P = numpy.array(h5mesh['params'][...])
+        self.core.touch_params()
 
         # Load elements
         h5elems = h5mesh['elements']
@@ -1599,6 +1601,7 @@ class Mesh(object):
             elem = self.add_element(elem_dict['id'], None, None)
             elem._load_dict(elem_dict)
         self._core.P = mesh_dict['values']
+        self._core.touch_params()
 
         if 'node_objlist' in mesh_dict.keys():
             self.nodes._load_dict(mesh_dict['node_objlist'])
@@ -1614,6 +1617,9 @@ class Mesh(object):
             self._update_dependent_nodes()
             self._core.generate_element_map(self)
             self._core.generate_dependent_node_map(self)
+            self._core.generate_pca_plan()
+            self._element_trees = {}
+            self._tessellations = {}
             self._regenerate = False
             self._reupdate = True
 
@@ -1657,6 +1663,54 @@ class Mesh(object):
     def update_maps(self):
         self.core.update_maps()
 
+    def get_element_tree(self, elements=None, res=4):
+        '''
+        Returns a ``proximity.ElementTree`` of all the elements, or the
+        given element ids. The tree is kept with the mesh and refitted
+        only when the mesh parameters change, so repeated queries reuse
+        it. It is rebuilt when the mesh is regenerated.
+        '''
+        self.generate()
+        key = (None if elements is None else tuple(elements), res)
+        if key not in self._element_trees:
+            self._element_trees[key] = proximity.ElementTree(
+                self, elements=elements, res=res)
+        return self._element_trees[key]
+
+    def project(self, X, elements=None, res=4, num_starts=3,
+                max_iterations=50, xtol=1e-8):
+        '''
+        Projects the points ``X`` of size (num_points, num_fields) onto
+        the closest location on the mesh elements, all the elements or
+        the given element ids. The candidate elements of each point are
+        found with the element tree of the mesh, see
+        ``get_element_tree``, and projected together from up to
+        ``num_starts`` starts per element, see ``Core.closest_points``.
+
+        >>> mesh = Mesh()
+        >>> n = mesh.add_stdnode(1, [0, 0])
+        >>> n = mesh.add_stdnode(2, [1, 0])
+        >>> n = mesh.add_stdnode(3, [1, 1])
+        >>> e = mesh.add_element(1, ['L1'], [1, 2])
+        >>> e = mesh.add_element(2, ['L1'], [2, 3])
+        >>> eids, xi, dist = mesh.project([[0.3, 0.2], [1.5, 0.6]])
+        >>> eids
+        [1, 2]
+        >>> xi
+        array([[0.3],
+               [0.6]])
+        >>> dist
+        array([0.2, 0.5])
+
+        :param X: points to project (num_points, num_fields)
+        :param elements: element ids to project onto
+        :return: element ids, xi locations (num_points, num_xi) and
+            distances of the projected points
+        '''
+        tree = self.get_element_tree(elements=elements, res=res)
+        return tree.query(X, num_starts=num_starts,
+                          max_iterations=max_iterations, xtol=xtol)
+
     def get_variables(self):
         return self._core.get_variables()
 
@@ -1703,18 +1757,39 @@ class Mesh(object):
         if not isinstance(element_ids, list):
             element_ids = [element_ids]
 
-        node0 = self.elements[element_ids[0]].nodes[0]
-        num_fields = node0.num_fields
-        num_elements = len(element_ids)
-        num_xi = xi.shape[0]
-        X = numpy.zeros((num_xi * num_elements, num_fields))
+        cids = [element.cid for element in self.elements[element_ids]]
+        return self._core.evaluates(cids, xi, deriv=deriv)
 
-        ind = 0
-        for element in self.elements[element_ids]:
-            X[ind:ind + num_xi, :] = element.evaluate(xi, deriv=deriv)
-            ind += num_xi
+    def evaluate_points(self, element_ids, xi, deriv=None):
+        """
+        Evaluates scattered points where each point has its own element
+        and xi location, e.g., embedded data points or closest point
+        results.
 
-        return X
+        >>> mesh = Mesh()
+        >>> n = mesh.add_stdnode(1, [0, 0])
+        >>> n = mesh.add_stdnode(2, [1, 0.5])
+        >>> n = mesh.add_stdnode(3, [2, 0.3])
+        >>> e = mesh.add_element(1, ['L1'], [1, 2])
+        >>> e = mesh.add_element(2, ['L1'], [2, 3])
+        >>> mesh.evaluate_points([2, 1, 2], [[0.5], [0.5], [1.0]])
+        array([[1.5 , 0.4 ],
+               [0.5 , 0.25],
+               [2.  , 0.3 ]])
+
+        :param element_ids: element id for each point
+        :param xi: element location of each point (num_points, num_xi)
+        :param deriv: derivative in each dimension
+        :return: values for each point (num_points, num_fields)
+        """
+        self.generate()
+        cid_map = {}
+        cids = numpy.zeros(len(element_ids), dtype=int)
+        for idx, eid in enumerate(element_ids):
+            if eid not in cid_map:
+                cid_map[eid] = self.elements[eid].cid
+            cids[idx] = cid_map[eid]
+        return self._core.evaluate_points(cids, xi, deriv=deriv)
 
     def translate(self, translation_node_id, groups=None, update=True):
         dx = self.nodes[translation_node_id].values
@@ -1781,8 +1856,13 @@ class Mesh(object):
         return F, invF
 
     def grid(self, res=[8, 8], shape='quad', method='fit'):
+        """
+        Returns a grid of xi locations for an element ``shape``. The
+        array is a copy of the cached grid of ``discretizer.xi_grid`` and
+        can be modified.
+        """
         return discretizer.xi_grid(
-            shape=shape, res=res, units='div', method=method)[0]
+            shape=shape, res=res, units='div', method=method)[0].copy()
 
     def get_nodes(self, nodes=None, group='_default'):
         self.generate()
@@ -1826,8 +1906,46 @@ class Mesh(object):
             Xl.append(self._core.evaluate(elem.cid, xi))
         return Xl
 
-    def get_surfaces(self, res=8, elements=None, groups=None, include_xi=False):
+    def get_surfaces(self, res=8, elements=None, groups=None, include_xi=False, params=None, out=None, shared=False):
+        """
+        Tessellates the 2D elements of the mesh into triangles. If
+        ``shared`` is True, the points on the edges and corners shared by
+        elements are merged so the surface is connected, see
+        ``get_surface_tessellation``.
+
+        A batch of parameter vectors (num_samples, num_params) can be
+        given with ``params`` to evaluate the same tessellation for many
+        meshes, in which case X has size (num_samples, num_points,
+        num_fields). X is written into ``out`` if given.
+
+        The tessellation is cached, see ``get_surface_tessellation``, so
+        repeated calls only evaluate the points. T and Xi are shared
+        between calls and are read-only.
+        """
         # self.generate() // Cannot use because it'll regenerate the pca nodes after they might've been translated.
+        tess = self.get_surface_tessellation(
+            res=res, elements=elements, groups=groups, shared=shared)
+        X = tess.evaluate(P=params, out=out)
+        if include_xi:
+            return X, tess.T, tess.Xi
+        return X, tess.T
+
+    def get_surface_tessellation(self, res=8, elements=None, groups=None, shared=False):
+        """
+        Returns the ``core.Tessellation`` of the 2D elements used by
+        ``get_surfaces``. It is computed once for the elements, groups
+        and resolution, and recomputed when the mesh is regenerated.
+
+        If ``shared`` is True, points are identified by the corner nodes
+        of the element edge or corner they lie on, see
+        ``_shared_point_index``, and the points of elements sharing
+        these nodes are merged.
+        """
+        key = ('surfaces', res, shared,
+               None if elements is None else tuple(elements),
+               None if groups is None else tuple(numpy.atleast_1d(groups)))
+        if key in self._tessellations and not self._regenerate:
+            return self._tessellations[key]
 
         if elements == None:
             if groups == None:
@@ -1837,46 +1955,83 @@ class Mesh(object):
         else:
             Elements = self.elements[elements]
 
-        XiT, TT = discretizer.xi_grid(shape='tri', res=res)
-        XiQ, TQ = discretizer.xi_grid(shape='quad', res=res)
-        NPT, NTT = XiT.shape[0], TT.shape[0]
-        NPQ, NTQ = XiQ.shape[0], TQ.shape[0]
+        grids = {
+            'tri': discretizer.xi_grid(shape='tri', res=res),
+            'quad': discretizer.xi_grid(shape='quad', res=res)}
 
+        # Offsets of each element's points and triangles in X and T
+        cids = {'tri': [], 'quad': []}
+        shape_elements = {'tri': [], 'quad': []}
+        point_offsets = {'tri': [], 'quad': []}
+        tri_offsets = {'tri': [], 'quad': []}
         NP, NT = 0, 0
+        num_fields = 0
         for elem in Elements:
-            if elem.shape == 'tri':
-                NP += NPT
-                NT += NTT
-            elif elem.shape == 'quad':
-                NP += NPQ
-                NT += NTQ
+            if elem.shape in grids:
+                cids[elem.shape].append(elem.cid)
+                shape_elements[elem.shape].append(elem)
+                point_offsets[elem.shape].append(NP)
+                tri_offsets[elem.shape].append(NT)
+                NP += grids[elem.shape][0].shape[0]
+                NT += grids[elem.shape][1].shape[0]
+                num_fields = elem.nodes[0].num_fields
 
-        X = numpy.zeros((NP, elem.nodes[0].num_fields))
         T = numpy.zeros((NT, 3), dtype='uint32')
+        Xi = numpy.zeros((NP, 2))
+        for shape, (XiS, TS) in grids.items():
+            if len(cids[shape]) == 0:
+                continue
+            p0 = numpy.array(point_offsets[shape])
+            t0 = numpy.array(tri_offsets[shape])
+            prows = (p0[:, None] + numpy.arange(XiS.shape[0])).flatten()
+            trows = (t0[:, None] + numpy.arange(TS.shape[0])).flatten()
+            T[trows, :] = (TS[None, :, :] + p0[:, None, None]).reshape((-1, 3))
+            Xi[prows, :] = numpy.tile(XiS, (p0.size, 1))
+
+        tess = core.Tessellation(self._core, NP, num_fields, T, Xi=Xi)
+        for shape, (XiS, TS) in grids.items():
+            if len(cids[shape]) > 0:
+                tess.add_points(cids[shape], XiS, point_offsets[shape])
+        if shared:
+            tess.merge_points(self._shared_point_index(NP, [
+                [elem, XiS, offset] for shape, (XiS, TS) in grids.items()
+                for elem, offset in zip(shape_elements[shape],
+                                        point_offsets[shape])]))
+        self._tessellations[key] = tess
+        return tess
+
+    def get_faces(self, res=8, exterior_only=True, include_xi=False, elements=None, out=None, shared=False):
+        """
+        Tessellates the faces of the 3D elements into triangles. X is
+        written into ``out`` if given. If ``shared`` is True, the points
+        on the edges and corners shared by faces are merged so the
+        surface is connected.
+
+        The tessellation is cached, see ``get_face_tessellation``, so
+        repeated calls only evaluate the points. T and Xi are shared
+        between calls and are read-only.
+        """
+        self.generate()
+        tess = self.get_face_tessellation(
+            res=res, exterior_only=exterior_only, elements=elements,
+            shared=shared)
+        X = tess.evaluate(out=out)
         if include_xi:
-            Xi = numpy.zeros((NP, 2))
-        np, nt = 0, 0
-        for elem in Elements:
-            if elem.shape == 'tri':
-                X[np:np + NPT, :] = self._core.evaluate(elem.cid, XiT)
-                if include_xi:
-                    Xi[np:np + NPT, :] = XiT
-                T[nt:nt + NTT, :] = TT + np
-                np += NPT
-                nt += NTT
-            elif elem.shape == 'quad':
-                X[np:np + NPQ, :] = self._core.evaluate(elem.cid, XiQ)
-                T[nt:nt + NTQ, :] = TQ + np
-                if include_xi:
-                    Xi[np:np + NPQ, :] = XiQ
-                np += NPQ
-                nt += NTQ
-        if include_xi:
-            return X, T, Xi
-        return X, T
+            return X, tess.T, tess.Xi
+        return X, tess.T
 
-    def get_faces(self, res=8, exterior_only=True, include_xi=False, elements=None):
+    def get_face_tessellation(self, res=8, exterior_only=True, elements=None, shared=False):
+        """
+        Returns the ``core.Tessellation`` of the element faces used by
+        ``get_faces``. It is computed once for the elements and
+        resolution, and recomputed when the mesh is regenerated. Shared
+        points are merged as in ``get_surface_tessellation``.
+        """
         self.generate()
+        key = ('faces', res, exterior_only, shared,
+               None if elements is None else tuple(elements))
+        if key in self._tessellations:
+            return self._tessellations[key]
 
         if elements == None:
             Faces = self.faces
@@ -1908,49 +2063,100 @@ class Mesh(object):
                 NP += NPQ
                 NT += NTQ
 
-        X = numpy.zeros((NP, 3))  #######TODO#####face.nodes[0].num_fields))
         T = numpy.zeros((NT, 3), dtype='uint32')
-        if include_xi:
-            Xi = numpy.zeros((NP, 2))
+        Xi = numpy.zeros((NP, 2))
+
+        # Element xi on each of the six hexagonal element faces
+        face_xi = [
+            numpy.array([XiQ[:, 0], XiQ[:, 1], XiQ0]).T,
+            numpy.array([XiQ[:, 0], XiQ[:, 1], XiQ1]).T,
+            numpy.array([XiQ[:, 0], XiQ0, XiQ[:, 1]]).T,
+            numpy.array([XiQ[:, 0], XiQ1, XiQ[:, 1]]).T,
+            numpy.array([XiQ0, XiQ[:, 0], XiQ[:, 1]]).T,
+            numpy.array([XiQ1, XiQ[:, 0], XiQ[:, 1]]).T]
+        face_cids = [[] for xi in face_xi]
+        face_offsets = [[] for xi in face_xi]
+        face_points = []
+        tri_cids, tri_offsets = [], []
+
         np, nt = 0, 0
         for face in Faces:
             if face.shape == 'tri':
-                X[np:np + NPT, :] = self._core.evaluate(face.cid, XiT)
-                if include_xi:
-                    Xi[np:np + NPT, :] = XiT
+                tri_cids.append(face.cid)
+                tri_offsets.append(np)
+                Xi[np:np + NPT, :] = XiT
                 T[nt:nt + NTT, :] = TT + np
                 np += NPT
                 nt += NTT
             elif face.shape == 'quad':
                 elem = self.elements[face.element_faces[0][0]]
                 face_index = face.element_faces[0][1]
-                if face_index == 0:
-                    X[np:np + NPQ, :] = self._core.evaluate(elem.cid,
-                                                            numpy.array([XiQ[:, 0], XiQ[:, 1], XiQ0]).T)
-                elif face_index == 1:
-                    X[np:np + NPQ, :] = self._core.evaluate(elem.cid,
-                                                            numpy.array([XiQ[:, 0], XiQ[:, 1], XiQ1]).T)
-                elif face_index == 2:
-                    X[np:np + NPQ, :] = self._core.evaluate(elem.cid,
-                                                            numpy.array([XiQ[:, 0], XiQ0, XiQ[:, 1]]).T)
-                elif face_index == 3:
-                    X[np:np + NPQ, :] = self._core.evaluate(elem.cid,
-                                                            numpy.array([XiQ[:, 0], XiQ1, XiQ[:, 1]]).T)
-                elif face_index == 4:
-                    X[np:np + NPQ, :] = self._core.evaluate(elem.cid,
-                                                            numpy.array([XiQ0, XiQ[:, 0], XiQ[:, 1]]).T)
-                elif face_index == 5:
-                    X[np:np + NPQ, :] = self._core.evaluate(elem.cid,
-                                                            numpy.array([XiQ1, XiQ[:, 0], XiQ[:, 1]]).T)
-
+                face_cids[face_index].append(elem.cid)
+                face_offsets[face_index].append(np)
+                face_points.append([elem, face_xi[face_index], np])
                 T[nt:nt + NTQ, :] = TQ + np
-                if include_xi:
-                    Xi[np:np + NPQ, :] = XiQ
+                Xi[np:np + NPQ, :] = XiQ
                 np += NPQ
                 nt += NTQ
-        if include_xi:
-            return X, T, Xi
-        return X, T
+
+        tess = core.Tessellation(self._core, NP, 3, T, Xi=Xi)  #######TODO#####face.nodes[0].num_fields))
+        if len(tri_cids) > 0:
+            tess.add_points(tri_cids, XiT, tri_offsets)
+        for face_index, cids in enumerate(face_cids):
+            if len(cids) > 0:
+                tess.add_points(cids, face_xi[face_index],
+                                face_offsets[face_index])
+        if shared:
+            tess.merge_points(self._shared_point_index(NP, face_points))
+        self._tessellations[key] = tess
+        return tess
+
+    def _shared_point_index(self, num_points, element_points):
+        """
+        Returns the merged point index of the points of a tessellation.
+        ``element_points`` is a list of ``[element, xi, offset]`` for the
+        points at the ``xi`` locations of an element starting at row
+        ``offset``. A point is identified by the corner nodes of the
+        element with a nonzero linear weight and these weights, so points
+        on a shared edge or corner of two elements are merged while the
+        other points, and points not in ``element_points``, are kept.
+        Merged points are numbered in the order of their first point.
+        """
+        num_corners = 8
+        node_index = {}
+        keys = numpy.zeros((num_points, 2 * num_corners), dtype=numpy.int64)
+        keys[:, :num_corners] = numpy.iinfo(numpy.int64).max
+        keys[:, 0] = -1 - numpy.arange(num_points)
+
+        groups = {}
+        for elem, xi, offset in element_points:
+            group = groups.setdefault((tuple(elem.basis), id(xi)), [xi, [], []])
+            group[1].append(elem.node_ids)
+            group[2].append(offset)
+        for (basis, xi_id), (xi, node_ids, offsets) in groups.items():
+            corners = core.basis_corners(basis)
+            nodes = numpy.array([
+                [node_index.setdefault(nids[c], len(node_index))
+                 for c in corners] for nids in node_ids])
+            W = numpy.rint(1e8 * core.basis_corner_weights(
+                basis, xi)).astype(numpy.int64)
+            W = numpy.broadcast_to(W, (nodes.shape[0],) + W.shape)
+            N = numpy.where(W > 0, nodes[:, None, :],
+                            numpy.iinfo(numpy.int64).max)
+            order = numpy.argsort(N, axis=2)
+            rows = (numpy.array(offsets)[:, None] +
+                    numpy.arange(xi.shape[0])).ravel()
+            keys[rows, :len(corners)] = numpy.take_along_axis(
+                N, order, axis=2).reshape((rows.size, -1))
+            keys[rows, num_corners:num_corners + len(corners)] = \
+                numpy.take_along_axis(W, order, axis=2).reshape(
+                    (rows.size, -1))
+
+        first, inverse = numpy.unique(
+            keys, axis=0, return_index=True, return_inverse=True)[1:]
+        rank = numpy.zeros(first.size, dtype=int)
+        rank[numpy.argsort(first)] = numpy.arange(first.size)
+        return rank[inverse.ravel()]
 
     def get_lines(self, res=8, elements='all', internal_lines=False):
         lines = []
@@ -2184,11 +2390,98 @@ class Mesh(object):
 
         return mesh
 
-    def volume(self):
-        V = 0
-        for element in self.elements:
-            V += element.volume()
-        return V
+    def integrate(self, fields, func=None, ng=4, elements=None):
+        """
+        Integrates fields over the mesh elements using gaussian
+        quadrature. The gauss points of all the elements with the same
+        basis are evaluated together, see
+        ``Element.integrate`` for the format of ``fields``.
+
+        ``func`` is called with the field values at the gauss points of
+        many elements at once as a (num_points, len(fields)) array and
+        must return the processed values row-wise.
+
+        >>> mesh = Mesh()
+        >>> n = mesh.add_stdnode(1, [0, 0])
+        >>> n = mesh.add_stdnode(2, [1, 0.5])
+        >>> n = mesh.add_stdnode(3, [2, 0.3])
+        >>> e = mesh.add_element(1, ['L1'], [1, 2])
+        >>> e = mesh.add_element(2, ['L1'], [2, 3])
+        >>> integrals, total = mesh.integrate([[0, 0], [1, 0]])
+        >>> integrals
+        array([[0.5 , 0.25],
+               [1.5 , 0.4 ]])
+        >>> total
+        array([2.  , 0.65])
+
+        :param fields: list of fields and derivatives to integrate
+        :param func: function to process the field values
+        :param ng: number of gauss points in each dimension
+        :param elements: element ids to integrate, default is all
+        :return: the per-element integrals and their total
+        """
+        self.generate()
+        if elements is None:
+            elements = list(self.elements)
+        else:
+            elements = self.elements[list(elements)]
+
+        if len(elements) == 0:
+            integrals = numpy.zeros((0,))
+        else:
+            cids = [element.cid for element in elements]
+            integrals = self._core.integrates(cids, fields, func=func, ng=ng)
+        return integrals, integrals.sum(0)
+
+    def _integrate_metric(self, shape, get_fields, integrand, ng, elements):
+        self.generate()
+        if elements is None:
+            elements = [elem.id for elem in self.elements
+                        if elem.shape == shape]
+        if len(elements) == 0:
+            return numpy.zeros(0)
+        wrong = [elem.id for elem in self.elements[list(elements)]
+                 if elem.shape != shape]
+        if len(wrong) > 0:
+            raise ValueError('Elements %s are not %s elements' % (
+                wrong, shape))
+        fields = get_fields(self.elements[elements[0]].num_fields)
+        return self.integrate(fields, func=integrand, ng=ng,
+                              elements=elements)[0]
+
+    def lengths(self, ng=3, elements=None):
+        """
+        Returns the length of each line element, or of the line
+        ``elements`` given. Raises a ValueError for other elements.
+        """
+        return self._integrate_metric(
+            'line', _length_fields, _length_integrand, ng, elements)
+
+    def areas(self, ng=3, elements=None):
+        """
+        Returns the area of each quad element, or of the quad
+        ``elements`` given. Raises a ValueError for other elements.
+        """
+        return self._integrate_metric(
+            'quad', _area_fields, _area_integrand, ng, elements)
+
+    def volumes(self, ng=3, elements=None):
+        """
+        Returns the volume of each hexagonal element, or of the
+        hexagonal ``elements`` given. Raises a ValueError for other
+        elements.
+        """
+        return numpy.abs(self._integrate_metric(
+            'hexagonal', _volume_fields, _volume_integrand, ng, elements))
+
+    def length(self, ng=3, elements=None):
+        return self.lengths(ng=ng, elements=elements).sum()
+
+    def area(self, ng=3, elements=None):
+        return self.areas(ng=ng, elements=elements).sum()
+
+    def volume(self, ng=3, elements=None):
+        return self.volumes(ng=ng, elements=elements).sum()
 
 
     def export(self, filepath, element_ids='all', node_ids=[], precision='%0.6f', format='json'):
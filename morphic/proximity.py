@@ -0,0 +1,253 @@
+"""
+Closest point queries on a mesh. An ``ElementTree`` is a bounding
+volume hierarchy of axis aligned bounding boxes around the mesh
+elements. The tree topology is built once and the boxes are refitted
+when the mesh parameters change, e.g., during a fit. Queries find the
+candidate elements of all the points by traversing the tree level by
+level and find the closest xi location on the candidate elements with
+``Core.closest_points``.
+
+>>> from morphic import mesher
+>>> mesh = mesher.Mesh()
+>>> n = mesh.add_stdnode(1, [0, 0])
+>>> n = mesh.add_stdnode(2, [1, 0])
+>>> n = mesh.add_stdnode(3, [1, 1])
+>>> e = mesh.add_element(1, ['L1'], [1, 2])
+>>> e = mesh.add_element(2, ['L1'], [2, 3])
+>>> tree = ElementTree(mesh)
+>>> eids, xi, dist = tree.query([[0.3, 0.2], [1.5, 0.6]])
+>>> eids
+[1, 2]
+>>> xi
+array([[0.3],
+       [0.6]])
+"""
+import numpy
+
+from morphic import core
+
+
+class ElementTree(object):
+    """
+    Bounding volume hierarchy of the elements of a mesh, or of the
+    ``elements`` ids given. The box of an element bounds its values
+    evaluated on a grid with ``res`` divisions, padded by ``margin``
+    times the box size to cover the element between the grid points.
+
+    The tree is refitted when the ``param_version`` of the mesh core
+    changes, see ``Core.touch_params``. Use ``Mesh.get_element_tree``
+    to share a tree between queries on a mesh.
+    """
+
+    def __init__(self, mesh, elements=None, res=4, margin=None):
+        mesh.generate()
+        self.mesh = mesh
+        self.core = mesh._core
+        if elements is None:
+            elements = mesh.elements
+        else:
+            elements = mesh.elements[list(elements)]
+        self.element_ids = numpy.array(
+            [element.id for element in elements], dtype=object)
+        self.cids = numpy.array(mesh.get_element_cids(elements), dtype=int)
+        self.res = res
+        self.margin = 0.5 / res if margin is None else margin
+        self.num_xi = max(core.dimensions(self.core.EFn[cid])
+                          for cid in self.cids)
+        self.groups = []
+        self.group_index = numpy.zeros(self.cids.size, dtype=int)
+        self.group_local = numpy.zeros(self.cids.size, dtype=int)
+        for basis, idx in self.core.group_elements_by_basis(
+                self.cids.tolist()):
+            self.group_index[idx] = len(self.groups)
+            self.group_local[idx] = numpy.arange(idx.size)
+            self.groups.append([basis, idx, core.basis_xi_grid(basis, res)])
+        self.param_version = None
+        self._last_query = None
+        self.refit()
+        self._build()
+        self._refit_nodes()
+
+    def _evaluate_grids(self):
+        """
+        Evaluates the grid of each element, returns a list per basis
+        group of arrays of size (num_elements, num_grid, num_fields).
+        """
+        grids = []
+        for basis, idx, Xi in self.groups:
+            X = self.core.evaluates(self.cids[idx], Xi)
+            grids.append(X.reshape((idx.size, Xi.shape[0], -1)))
+        return grids
+
+    def refit(self):
+        """
+        Recomputes the element boxes, and the boxes of the tree if it
+        is built, from the current mesh parameters.
+        """
+        grids = self._evaluate_grids()
+        num_fields = grids[0].shape[2]
+        self.lower = numpy.zeros((self.cids.size, num_fields))
+        self.upper = numpy.zeros((self.cids.size, num_fields))
+        for (basis, idx, Xi), X in zip(self.groups, grids):
+            lower, upper = X.min(1), X.max(1)
+            pad = self.margin * (upper - lower).max(1)[:, None]
+            self.lower[idx] = lower - pad
+            self.upper[idx] = upper + pad
+        self.grids = grids
+        self.param_version = self.core.param_version
+        if hasattr(self, 'levels'):
+            self._refit_nodes()
+
+    def _build(self):
+        """
+        Builds the tree topology by splitting the elements at the median
+        of their box centres along the longest axis. Leaves hold one
+        element. Nodes are numbered depth first and stored in arrays,
+        ``children`` is -1 and ``node_element`` is set for the leaves,
+        and ``levels`` lists the nodes at each depth.
+        """
+        centres = 0.5 * (self.lower + self.upper)
+        node_element, levels = [], []
+        stack = [[numpy.arange(self.cids.size), 0]]
+        while len(stack) > 0:
+            elements, depth = stack.pop()
+            node = len(node_element)
+            node_element.append(-1)
+            if depth == len(levels):
+                levels.append([])
+            levels[depth].append(node)
+            if elements.size == 1:
+                node_element[node] = elements[0]
+                continue
+            c = centres[elements]
+            axis = (c.max(0) - c.min(0)).argmax()
+            order = elements[numpy.argsort(c[:, axis], kind='stable')]
+            half = order.size // 2
+            stack.append([order[half:], depth + 1])
+            stack.append([order[:half], depth + 1])
+        self.node_element = numpy.array(node_element, dtype=int)
+        self.levels = [numpy.array(level, dtype=int) for level in levels]
+
+        # The left child of a node is the next node and the right child
+        # follows the left subtree
+        num_nodes = self.node_element.size
+        self.children = -numpy.ones((num_nodes, 2), dtype=int)
+        size = numpy.ones(num_nodes, dtype=int)
+        for level in self.levels[::-1]:
+            nodes = level[self.node_element[level] < 0]
+            left = nodes + 1
+            right = left + size[left]
+            self.children[nodes, 0], self.children[nodes, 1] = left, right
+            size[nodes] = 1 + size[left] + size[right]
+
+    def _refit_nodes(self):
+        num_nodes = self.children.shape[0]
+        num_fields = self.lower.shape[1]
+        self.node_lower = numpy.zeros((num_nodes, num_fields))
+        self.node_upper = numpy.zeros((num_nodes, num_fields))
+        leaves = self.node_element >= 0
+        self.node_lower[leaves] = self.lower[self.node_element[leaves]]
+        self.node_upper[leaves] = self.upper[self.node_element[leaves]]
+        for level in self.levels[::-1]:
+            nodes = level[self.node_element[level] < 0]
+            left, right = self.children[nodes, 0], self.children[nodes, 1]
+            self.node_lower[nodes] = numpy.minimum(
+                self.node_lower[left], self.node_lower[right])
+            self.node_upper[nodes] = numpy.maximum(
+                self.node_upper[left], self.node_upper[right])
+
+    def _closest_grid(self, X, points, elements):
+        """
+        Returns the squared distance and index of the closest grid point
+        of the ``elements``, indices into ``cids``, to the ``points``.
+        """
+        dist = numpy.zeros(points.size)
+        index = numpy.zeros(points.size, dtype=int)
+        for g, grid in enumerate(self.grids):
+            pairs = numpy.nonzero(self.group_index[elements] == g)[0]
+            if pairs.size == 0:
+                continue
+            dX = grid[self.group_local[elements[pairs]]] - \
+                X[points[pairs]][:, None, :]
+            d = (dX * dX).sum(2)
+            index[pairs] = d.argmin(1)
+            dist[pairs] = d[numpy.arange(pairs.size), index[pairs]]
+        return dist, index
+
+    def candidates(self, X):
+        """
+        Returns the candidate ``[points, elements]`` pairs, i.e., the
+        elements whose box is closer to a point than the closest grid
+        point found or the farthest corner of any box. Elements are
+        indices into ``cids``.
+        """
+        X = numpy.asarray(X, dtype=float)
+        upper_bound = numpy.inf * numpy.ones(X.shape[0])
+        points = numpy.arange(X.shape[0])
+        nodes = numpy.zeros(X.shape[0], dtype=int)
+        found_points, found_elements, found_lower = [], [], []
+        while points.size > 0:
+            x = X[points]
+            lower, upper = self.node_lower[nodes], self.node_upper[nodes]
+            dmin = numpy.maximum(numpy.maximum(lower - x, x - upper), 0)
+            dmin = (dmin * dmin).sum(1)
+            dmax = numpy.maximum(numpy.absolute(x - lower),
+                                 numpy.absolute(x - upper))
+            dmax = (dmax * dmax).sum(1)
+            numpy.minimum.at(upper_bound, points, dmax)
+            keep = dmin <= upper_bound[points]
+            points, nodes, dmin = points[keep], nodes[keep], dmin[keep]
+            leaves = numpy.nonzero(self.node_element[nodes] >= 0)[0]
+            elements = self.node_element[nodes[leaves]]
+            numpy.minimum.at(upper_bound, points[leaves], self._closest_grid(
+                X, points[leaves], elements)[0])
+            found_points.append(points[leaves])
+            found_elements.append(elements)
+            found_lower.append(dmin[leaves])
+            internal = self.node_element[nodes] < 0
+            points = numpy.repeat(points[internal], 2)
+            nodes = self.children[nodes[internal]].ravel()
+        points = numpy.concatenate(found_points)
+        elements = numpy.concatenate(found_elements)
+        keep = numpy.concatenate(found_lower) <= upper_bound[points]
+        return points[keep], elements[keep]
+
+    def query(self, X, num_starts=3, res=8, max_iterations=50, xtol=1e-8):
+        """
+        Returns the element ids, xi locations and distances of the
+        closest points on the elements to the points ``X`` of size
+        (num_points, num_fields). The closest point on each candidate
+        element is found by ``Core.closest_points`` from ``num_starts``
+        starts on a grid with ``res`` divisions. The tree is refitted
+        first if the mesh parameters have changed. The result of the
+        last query is reused if the points and the mesh parameters are
+        the same.
+        """
+        self.mesh.generate()
+        if self.param_version != self.core.param_version:
+            self.refit()
+        X = numpy.asarray(X, dtype=float)
+        query = [self.param_version, X, num_starts, res, max_iterations,
+                 xtol]
+        if self._last_query is not None and \
+                self._last_query[0][0] == query[0] and \
+                numpy.array_equal(self._last_query[0][1], X) and \
+                self._last_query[0][2:] == query[2:]:
+            return self._last_query[1]
+        points, elements = self.candidates(X)
+        xi, dist = self.core.closest_points(
+            self.cids[elements], X[points], num_starts=num_starts, res=res,
+            max_iterations=max_iterations, xtol=xtol)
+        xi = numpy.hstack([xi, numpy.zeros(
+            (points.size, self.num_xi - xi.shape[1]))])
+
+        # Keep the closest candidate of each point
+        order = numpy.lexsort((dist, points))
+        first = numpy.ones(order.size, dtype=bool)
+        first[1:] = points[order[1:]] != points[order[:-1]]
+        best = order[first]
+        result = (self.element_ids[elements[best]].tolist(), xi[best],
+                  dist[best])
+        query[1] = X.copy()
+        self._last_query = [query, result]
+        return result
@@ -0,0 +1,341 @@
+"""
+Linear least-squares solvers for fitting. A solver is factorized once
+for a fit matrix ``A`` and then reused to solve ``A x = b`` in the
+least-squares sense for many data vectors ``b``. Solvers can be pickled,
+or saved and loaded, so that a precomputed fit operator can be reused
+across fits with the same topology.
+
+>>> import numpy
+>>> A = numpy.array([[1., 0.], [1., 1.], [0., 2.]])
+>>> solver = get_solver('cholesky')
+>>> solver.factorize(A)
+>>> solver.solve(numpy.array([1., 3., 4.]))
+array([1., 2.])
+"""
+import copy
+import pickle
+
+import numpy
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
+
+# Number of rows of the fit matrix densified at a time by ``sparse_qr_r``
+QR_CHUNK_ROWS = 4096
+
+
+def sparse_qr_r(A, chunk_rows=None):
+    """
+    Returns the R factor of a QR decomposition of the sparse matrix
+    ``A`` of size (num_rows, num_dof). The rows are densified and
+    reduced ``chunk_rows`` at a time, by default at least ``QR_CHUNK_ROWS``
+    or twice the number of columns, so the memory used is of the order
+    of (chunk_rows + num_dof) * num_dof rather than the size of the dense
+    ``A``.
+    """
+    A = scipy.sparse.csr_matrix(A)
+    if chunk_rows is None:
+        chunk_rows = max(QR_CHUNK_ROWS, 2 * A.shape[1])
+    R = numpy.zeros((0, A.shape[1]))
+    for start in range(0, A.shape[0], chunk_rows):
+        R = numpy.linalg.qr(numpy.vstack(
+            [R, A[start:start + chunk_rows].toarray()]), mode='r')
+    return R
+
+
+class LinearSolver(object):
+    """
+    Base class of the least-squares solvers. Subclasses implement
+    ``_factorize`` and ``_solve``.
+    """
+
+    name = None
+    # Attributes shared, not copied, by ``copy``
+    _shared = ()
+
+    def __init__(self):
+        self.shape = None
+
+    @property
+    def factorized(self):
+        return self.shape is not None
+
+    def factorize(self, A):
+        """
+        Factorizes the fit matrix ``A`` of size (num_rows, num_dof).
+        """
+        A = scipy.sparse.csc_matrix(A)
+        self.shape = A.shape
+        self._factorize(A)
+
+    def reset(self):
+        """
+        Removes the factorization, e.g., when the fit matrix changes.
+        """
+        self.shape = None
+        self._reset()
+
+    def solve(self, b):
+        """
+        Solves for the data ``b`` of size (num_rows,) or, for several
+        right-hand sides, (num_rows, num_rhs).
+        """
+        if not self.factorized:
+            raise RuntimeError('Solver has not been factorized')
+        b = numpy.asarray(b, dtype=float)
+        if b.shape[0] != self.shape[0]:
+            raise ValueError('Expected %d rows, got %d' % (
+                self.shape[0], b.shape[0]))
+        return self._solve(b)
+
+    def copy(self):
+        """
+        Returns an independent copy of the solver and its factorization,
+        e.g., to keep a factorization when the original solver is reset.
+        """
+        state = dict((key, value) for key, value in self.__dict__.items()
+                     if key not in self._shared)
+        solver = self.__class__.__new__(self.__class__)
+        solver.__dict__.update(copy.deepcopy(state))
+        for key in self._shared:
+            setattr(solver, key, getattr(self, key))
+        return solver
+
+    def save(self, filepath):
+        with open(filepath, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _factorize(self, A):
+        raise NotImplementedError()
+
+    def _reset(self):
+        pass
+
+    def _solve(self, b):
+        raise NotImplementedError()
+
+
+class LSQRSolver(LinearSolver):
+    """
+    Iterative least-squares using ``scipy.sparse.linalg.lsqr``. Nothing
+    is precomputed, each right-hand side is solved from scratch.
+    """
+
+    name = 'lsqr'
+
+    def __init__(self, **kwargs):
+        LinearSolver.__init__(self)
+        self.options = kwargs
+        self.A = None
+
+    def _factorize(self, A):
+        self.A = A
+
+    def _reset(self):
+        self.A = None
+
+    def _solve(self, b):
+        if b.ndim == 1:
+            return scipy.sparse.linalg.lsqr(self.A, b, **self.options)[0]
+        return numpy.array([
+            scipy.sparse.linalg.lsqr(self.A, rhs, **self.options)[0]
+            for rhs in b.T]).T
+
+
+class CholeskySolver(LinearSolver):
+    """
+    Solves the normal equations ``(A^T A + regularisation * I) x = A^T b``
+    using a sparse symmetric factorization (``scipy.sparse.linalg.splu``
+    with a symmetric ordering and no pivoting). The triangular factors
+    are kept so the solver can be pickled.
+    """
+
+    name = 'cholesky'
+    # The SuperLU factorization cannot be copied and is never modified
+    _shared = ('_lu',)
+
+    def __init__(self, regularisation=0):
+        LinearSolver.__init__(self)
+        self.regularisation = regularisation
+        self.At = None
+        self.L, self.U = None, None
+        self.perm_r, self.perm_c = None, None
+        self._lu = None
+
+    def _factorize(self, A):
+        self.At = A.T.tocsr()
+        N = self.At.dot(A) + self.regularisation * scipy.sparse.identity(
+            A.shape[1], format='csc')
+        try:
+            self._lu = scipy.sparse.linalg.splu(
+                N.tocsc(), permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0.,
+                options=dict(SymmetricMode=True))
+        except RuntimeError as error:
+            raise RuntimeError(
+                'The fit matrix is rank-deficient (%s), e.g., parameters '
+                'have no data bound to them. Use a regularisation or the '
+                "'svd' solver" % error)
+        self.L, self.U = self._lu.L.tocsr(), self._lu.U.tocsr()
+        self.perm_r, self.perm_c = self._lu.perm_r, self._lu.perm_c
+
+    def _reset(self):
+        self.At = None
+        self.L, self.U = None, None
+        self.perm_r, self.perm_c = None, None
+        self._lu = None
+
+    def _solve(self, b):
+        rhs = self.At.dot(b)
+        if self._lu is not None:
+            return self._lu.solve(rhs)
+        z = numpy.empty_like(rhs)
+        z[self.perm_r] = rhs
+        z = scipy.sparse.linalg.spsolve_triangular(
+            self.L, z, lower=True, unit_diagonal=True)
+        z = scipy.sparse.linalg.spsolve_triangular(self.U, z, lower=False)
+        return z[self.perm_c]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lu'] = None
+        return state
+
+
+class QRSolver(LinearSolver):
+    """
+    Least-squares using the R factor of a QR decomposition of ``A`` and
+    the corrected semi-normal equations ``R^T R x = A^T b``. This avoids
+    squaring the condition number. R is computed from chunks of rows of
+    ``A``, see ``sparse_qr_r``, and is stored dense, so it suits fits
+    with a moderate number of degrees of freedom.
+    """
+
+    name = 'qr'
+
+    def __init__(self):
+        LinearSolver.__init__(self)
+        self.A = None
+        self.R = None
+
+    def _factorize(self, A):
+        if A.shape[0] < A.shape[1]:
+            raise ValueError(
+                'The QR solver needs at least as many rows as degrees of '
+                "freedom, got %d rows for %d, use the 'svd' or 'lsqr' "
+                'solver' % A.shape)
+        self.A = A
+        self.R = sparse_qr_r(A)
+
+    def _reset(self):
+        self.A = None
+        self.R = None
+
+    def _solve_normal(self, rhs):
+        y = scipy.linalg.solve_triangular(self.R, rhs, trans='T')
+        return scipy.linalg.solve_triangular(self.R, y)
+
+    def _solve(self, b):
+        x = self._solve_normal(self.A.T.dot(b))
+        # One step of iterative refinement
+        r = b - self.A.dot(x)
+        return x + self._solve_normal(self.A.T.dot(r))
+
+
+class SVDSolver(LinearSolver):
+    """
+    SVD pseudo-inverse. If ``k`` is given, a truncated SVD with the
+    ``k`` largest singular values is computed with
+    ``scipy.sparse.linalg.svds``. Otherwise the SVD ``R = U S V^T`` of
+    the R factor of ``A``, see ``sparse_qr_r``, gives the singular
+    values and right singular vectors of ``A`` without densifying it,
+    and ``x = V S^-2 V^T A^T b``. Singular values smaller than ``rcond``
+    times the largest are discarded.
+    """
+
+    name = 'svd'
+
+    def __init__(self, k=None, rcond=1e-10):
+        LinearSolver.__init__(self)
+        self.k = k
+        self.rcond = rcond
+        self.UT, self.S, self.VT = None, None, None
+        self.A = None
+
+    def _factorize(self, A):
+        if self.k is None:
+            U, S, VT = scipy.linalg.svd(sparse_qr_r(A), full_matrices=False)
+            keep = S > self.rcond * S.max()
+            self.A, self.S, self.VT = A, S[keep], VT[keep]
+        else:
+            U, S, VT = scipy.sparse.linalg.svds(A, k=self.k)
+            keep = S > self.rcond * S.max()
+            self.UT, self.S, self.VT = U[:, keep].T, S[keep], VT[keep]
+
+    def _reset(self):
+        self.UT, self.S, self.VT = None, None, None
+        self.A = None
+
+    def _solve(self, b):
+        if self.UT is None:
+            y = self.VT.dot(self.A.T.dot(b))
+            if y.ndim == 1:
+                return self.VT.T.dot(y / self.S ** 2)
+            return self.VT.T.dot(y / self.S[:, numpy.newaxis] ** 2)
+        y = self.UT.dot(b)
+        if y.ndim == 1:
+            return self.VT.T.dot(y / self.S)
+        return self.VT.T.dot(y / self.S[:, numpy.newaxis])
+
+
+class InverseSolver(LinearSolver):
+    """
+    Applies a precomputed dense pseudo-inverse ``invA`` of size
+    (num_dof, num_rows), e.g., the ``invA`` stored in fits saved by
+    earlier versions. Factorizing computes the dense pseudo-inverse of
+    ``A`` so this solver is only meant for small or legacy fits.
+    """
+
+    name = 'inverse'
+
+    def __init__(self, invA=None):
+        LinearSolver.__init__(self)
+        self.invA = None
+        if invA is not None:
+            self.invA = numpy.asarray(invA, dtype=float)
+            self.shape = self.invA.shape[::-1]
+
+    def _factorize(self, A):
+        self.invA = numpy.linalg.pinv(A.toarray())
+
+    def _reset(self):
+        self.invA = None
+
+    def _solve(self, b):
+        return self.invA.dot(b)
+
+
+SOLVERS = {
+    'lsqr': LSQRSolver,
+    'cholesky': CholeskySolver,
+    'factorized': CholeskySolver,
+    'qr': QRSolver,
+    'svd': SVDSolver,
+    'inverse': InverseSolver}
+
+
+def get_solver(name, **kwargs):
+    """
+    Returns a new solver by name, one of 'lsqr', 'cholesky'
+    ('factorized'), 'qr', 'svd' or 'inverse'. ``kwargs`` are passed to the solver.
+    """
+    if name not in SOLVERS:
+        raise ValueError('Unknown solver %s' % name)
+    return SOLVERS[name](**kwargs)
+
+
+def load(filepath):
+    """
+    Loads a solver saved with ``LinearSolver.save``.
+    """
+    with open(filepath, 'rb') as f:
+        return pickle.load(f)
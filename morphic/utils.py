@@ -3,20 +3,44 @@ import morphic
 from scipy.spatial import cKDTree
 
 class PCAMesh(object):
+    """
+    Generates a PCA mesh from a population of meshes with the same
+    topology.
+
+    If ``incremental`` is True, the meshes are fitted in batches of
+    ``batch_size`` meshes, by default twice ``max_modes``, with
+    ``sklearn.decomposition.IncrementalPCA`` as they are added instead
+    of being stored. Only the mean, the ``max_modes`` largest modes and
+    one batch are kept, so memory use does not depend on the population
+    size. Meshes can then be given as file paths, which are loaded one
+    at a time. The modes are exact if the population has at most
+    ``max_modes`` modes, otherwise they are approximated.
+    """
 
-    def __init__(self, groups=None):
+    def __init__(self, groups=None, incremental=False, max_modes=20,
+                 batch_size=None):
         self.X = []
         self.pca = None
         self.num_modes = 5
         self.input_mesh = None
         self.groups = groups
         self.mesh = None
+        self.incremental = incremental
+        self.num_samples = 0
+        self.mean = None
+        self.max_modes = max_modes
+        if batch_size is None:
+            batch_size = 2 * max_modes
+        # The first batch sets the number of modes kept
+        self.batch_size = max(batch_size, max_modes)
+        self.batch = []
+        self.ipca = None
 
     def add_mesh(self, mesh, index=0):
-        if self.input_mesh == None:
-            self.input_mesh = mesh
         if isinstance(mesh, str):
             mesh = morphic.Mesh(mesh)
+        if self.input_mesh == None:
+            self.input_mesh = mesh
         x = []
         if self.groups is None:
             for node in mesh.nodes:
@@ -26,20 +50,56 @@ class PCAMesh(object):
             for node in mesh.nodes:
                 if node.in_group(self.groups):
                     x.extend(node.values.flatten().tolist())
-        self.X.append(x)
+        if self.incremental:
+            self._add_sample(numpy.array(x))
+        else:
+            self.X.append(x)
 
-    def generate(self, num_modes=5):
+    def _add_sample(self, x):
+        self.num_samples += 1
+        self.batch.append(x)
+        if len(self.batch) >= self.batch_size:
+            self._fit_batch()
+
+    def _fit_batch(self):
         from sklearn import decomposition
-        self.X = numpy.array(self.X)
+        X = numpy.array(self.batch)
+        if self.ipca is None:
+            self.ipca = decomposition.IncrementalPCA(
+                n_components=min(self.max_modes, X.shape[0], X.shape[1]))
+        self.ipca.partial_fit(X)
+        self.batch = []
+
+    def generate(self, num_modes=5):
         self.num_modes = num_modes
-        self.pca = decomposition.PCA(n_components=num_modes)
-        self.pca.fit(self.X)
-        self.mean = self.pca.mean_
-        self.components = self.pca.components_.T
-        self.variance = self.pca.explained_variance_
+        num_samples = self.num_samples if self.incremental else len(self.X)
+        if num_samples < 2:
+            raise ValueError('A PCA mesh needs at least 2 meshes, got %d'
+                             % num_samples)
+        if self.incremental:
+            self._generate_incremental()
+        else:
+            from sklearn import decomposition
+            self.X = numpy.array(self.X)
+            self.pca = decomposition.PCA(n_components=num_modes)
+            self.pca.fit(self.X)
+            self.mean = self.pca.mean_
+            self.components = self.pca.components_.T
+            self.variance = self.pca.explained_variance_
         self.generate_mesh()
         return self.mesh
 
+    def _generate_incremental(self):
+        if len(self.batch) > 0:
+            self._fit_batch()
+        if self.num_modes > self.ipca.n_components_:
+            raise ValueError('%d modes requested, the incremental PCA keeps '
+                             '%d, see max_modes' % (self.num_modes,
+                                                   self.ipca.n_components_))
+        self.mean = self.ipca.mean_
+        self.components = self.ipca.components_[:self.num_modes].T
+        self.variance = self.ipca.explained_variance_[:self.num_modes]
+
     def generate_mesh(self):
         ### Generate mesh from PCA results
         self.mesh = morphic.Mesh()
@@ -96,6 +156,48 @@ class PCAMesh(object):
         else:
             print('Cannot reshape this node when genrating pca mesh')
 
+    def synthesize(self, weights, chunk_size=None):
+        """
+        Synthesizes the mesh parameter vectors for a matrix of mode
+        weights of size (num_samples, num_modes). The weights are scaled
+        by the mode standard deviations as in the PCA mesh.
+
+        Returns an array of size (num_samples, num_params) that can be
+        used with ``mesh.core.P``. If ``chunk_size`` is given, a
+        generator of arrays of at most ``chunk_size`` samples is
+        returned instead to bound memory use.
+        """
+        weights = numpy.atleast_2d(weights)
+        if chunk_size is None:
+            return self._synthesize(weights)
+        return (self._synthesize(weights[i:i + chunk_size])
+                for i in range(0, weights.shape[0], chunk_size))
+
+    def synthesize_surfaces(self, weights, res=8, chunk_size=None, **kwargs):
+        """
+        Synthesizes the surface point clouds of the PCA mesh for a
+        matrix of mode weights of size (num_samples, num_modes).
+
+        Returns (X, T) where X has size (num_samples, num_points,
+        num_fields) and T is the triangulation shared by all the
+        samples. If ``chunk_size`` is given, a generator of (X, T)
+        tuples of at most ``chunk_size`` samples is returned instead.
+        Other keyword arguments are passed to ``Mesh.get_surfaces``.
+        """
+        if chunk_size is None:
+            return self.mesh.get_surfaces(
+                res=res, params=self.synthesize(weights), **kwargs)
+        return (self.mesh.get_surfaces(res=res, params=params, **kwargs)
+                for params in self.synthesize(weights, chunk_size=chunk_size))
+
+    def _synthesize(self, weights):
+        core = self.mesh.core
+        weights_cids = numpy.asarray(self.mesh.nodes['weights'].cids)
+        Ps = numpy.tile(core.P, (weights.shape[0], 1))
+        Ps[:, weights_cids[1:]] = 0
+        Ps[:, weights_cids[1:weights.shape[1] + 1]] = weights
+        return core.update_batch(Ps)
+
 
 def grid(divs=10, dims=2):
     if isinstance(divs, int):
@@ -7,6 +7,8 @@ import numpy.testing as npt
 
 sys.path.append('..')
 from morphic import core
+from morphic import discretizer
+from morphic import interpolator
 from morphic import mesher
 
 class TestObjectList(unittest.TestCase):
@@ -147,7 +149,239 @@ class TestCore(unittest.TestCase):
         c.fix_parameters(cids, [False, True, False, True, True])
         c.generate_fixed_index()
         npt.assert_equal(c.idx_unfixed, [0, 2])
+
+    def test_variables(self):
+        c = core.Core()
+        cids = c.add_params(numpy.array([3, 6, 9, 5, 2]))
+        c.add_variables([3, 0])
+        c.add_variables(3)
+        c.add_variables(numpy.array([2]))
+        npt.assert_equal(c.variable_ids, [0, 2, 3])
+        npt.assert_equal(c.variable_mask, [True, False, True, True, False])
+        npt.assert_equal(c.get_variables(), [3, 9, 5])
+        c.remove_variables(2)
+        c.set_variables([7, 8])
+        npt.assert_equal(c.P, [7, 6, 9, 8, 2])
+        c.add_params(numpy.array([1]))
+        c.add_variables(5)
+        npt.assert_equal(c.variable_ids, [0, 3, 5])
+
+    def test_param_version(self):
+        c = core.Core()
+        cids = c.add_params(numpy.array([3, 6, 9, 5, 2]))
+        version = c.param_version
+        c.update_params([1], [4])
+        self.assertEqual(c.param_version, version + 1)
+        c.add_variables([0, 2])
+        self.assertEqual(c.param_version, version + 1)
+        c.set_variables([1, 2])
+        self.assertEqual(c.param_version, version + 2)
+        c.update_maps()
+        c.update_dependent_nodes()
+        self.assertEqual(c.param_version, version + 2)
+
+        mesh = mesher.Mesh()
+        mesh.add_stdnode(1, [0., 1.])
+        mesh.add_stdnode(2, [1., 1.])
+        mesh.add_element(1, ['L1'], [1, 2])
+        mesh.generate()
+        version = mesh.core.param_version
+        mesh.nodes[1].values = numpy.array([0., 2.])
+        self.assertEqual(mesh.core.param_version, version + 1)
+        mesh.nodes[2].values[1] = 3.
+        self.assertEqual(mesh.core.param_version, version + 2)
+        mesh.nodes[2].set_values([1., 4.])
+        self.assertEqual(mesh.core.param_version, version + 3)
+
+    def test_get_variable_map(self):
+        mesh = mesher.Mesh()
+        mesh.add_stdnode('weights', [1, 1, -0.1])
+        mesh.add_stdnode('vars', [1, 0.1, 0.04])
+        mesh.add_pcanode(1, [[[0.5, 0.1, 0.01]], [[0.7, 0.2, 0.02]]],
+                         'weights', 'vars', group='pca')
+        mesh.add_pcanode(2, [[[0.0, -0.1, 0.01]], [[0.0, 0.02, -0.01]]],
+                         'weights', 'vars', group='pca')
+        mesh.add_stdnode('xi', [0.3])
+        mesh.add_stdnode(5, [2., 1.])
+        mesh.add_element(1, ['L1'], [2, 1])
+        mesh.add_element(2, ['L1'], [1, 5])
+        mesh.add_depnode(3, 1, 'xi')
+        mesh.add_stdnode(4, [9., 9.])
+        mesh.generate()
+        mesh.add_map((3, 1), (4, 0), 2.)
+        mesh.update(force=True)
+        mesh.nodes['weights'].variables(True, [1, 2])
+        mesh.nodes['vars'].variables(True, 2)
+        mesh.nodes[5].variables(True)
+        c = mesh.core
+        M = c.get_variable_map()
+        self.assertEqual(M.shape, (c.P.size, 5))
+        x0 = c.get_variables()
+        Mn = numpy.zeros(M.shape)
+        for k in range(x0.size):
+            for h in [1e-6, -1e-6]:
+                x = x0.copy()
+                x[k] += h
+                c.set_variables(x)
+                mesh.update(force=True)
+                Mn[:, k] += c.P / (2 * h)
+        npt.assert_almost_equal(M.toarray(), Mn)
+
+    def test_get_variable_map_xi(self):
+        mesh = mesher.Mesh()
+        mesh.add_stdnode(1, [0., 0.])
+        mesh.add_stdnode(2, [1., 2.])
+        mesh.add_element(1, ['L1'], [1, 2])
+        mesh.add_stdnode('xi', [0.3])
+        mesh.add_depnode(3, 1, 'xi')
+        mesh.add_stdnode(4, [0.5, 3.])
+        mesh.add_element(2, ['L1'], [3, 4])
+        mesh.add_stdnode('xi2', [0.6])
+        mesh.add_depnode(5, 2, 'xi2')
+        mesh.generate()
+        mesh.nodes['xi'].variables(True)
+        mesh.nodes['xi2'].variables(True)
+        mesh.nodes[2].variables(True)
+        c = mesh.core
+        M = c.get_variable_map()
+        col = numpy.searchsorted(c.variable_ids, mesh.nodes['xi'].cids[0])
+        npt.assert_almost_equal(
+            M[mesh.nodes[3].cids, col].toarray().ravel(), [1, 2])
+        x0 = c.get_variables()
+        Mn = numpy.zeros(M.shape)
+        for k in range(x0.size):
+            for h in [1e-6, -1e-6]:
+                x = x0.copy()
+                x[k] += h
+                c.set_variables(x)
+                mesh.update(force=True)
+                Mn[:, k] += numpy.sign(h) * c.P / (2 * 1e-6)
+        npt.assert_almost_equal(M.toarray(), Mn)
+
+    def test_evaluates_mixed_basis(self):
+        mesh = mesher.Mesh()
+        mesh.add_stdnode(1, [0., 0.])
+        mesh.add_stdnode(2, [1., 1.])
+        mesh.add_stdnode(3, [2., 0.])
+        mesh.add_stdnode(4, [3., 2.])
+        mesh.add_element(1, ['L1'], [1, 2])
+        mesh.add_element(2, ['L2'], [2, 3, 4])
+        mesh.add_element(3, ['L1'], [3, 4])
+        mesh.generate()
+        xi = numpy.array([[0.], [0.25], [1.]])
+        cids = mesh.get_element_cids()
+        X = mesh.core.evaluates(cids, xi)
+        Xe = numpy.concatenate([mesh.core.evaluate(cid, xi) for cid in cids])
+        npt.assert_almost_equal(X, Xe)
+        Xout = numpy.zeros((9, 2))
+        mesh.core.evaluates(cids, xi, deriv=[1], X=Xout)
+        Xe = numpy.concatenate([mesh.core.evaluate(cid, xi, deriv=[1])
+                                for cid in cids])
+        npt.assert_almost_equal(Xout, Xe)
+
+    def test_evaluate_points(self):
+        mesh = mesher.Mesh()
+        mesh.add_stdnode(1, [0., 0., 0.])
+        mesh.add_stdnode(2, [1., 0., 1.])
+        mesh.add_stdnode(3, [0., 1., 2.])
+        mesh.add_stdnode(4, [1., 1., 1.])
+        mesh.add_stdnode(5, [2., 0., 0.])
+        mesh.add_stdnode(6, [2., 1., 3.])
+        mesh.add_element(1, ['L1', 'L1'], [1, 2, 3, 4])
+        mesh.add_element(2, ['L1', 'L1'], [2, 5, 4, 6])
+        mesh.add_element(3, ['T11'], [5, 6, 4])
+        mesh.generate()
+        eids = [2, 1, 3, 2, 1]
+        xi = numpy.array([[0.1, 0.2], [0.5, 0.5], [0.3, 0.3],
+                          [1.0, 0.7], [0.9, 0.0]])
+        X = mesh.evaluate_points(eids, xi)
+        for i, eid in enumerate(eids):
+            npt.assert_almost_equal(X[i], mesh.elements[eid].evaluate(xi[i]))
+        X = mesh.evaluate_points(eids[:2], xi[:2], deriv=[1, 0])
+        npt.assert_almost_equal(X[0], [1., 0., -0.4])
+        npt.assert_almost_equal(X[1], [1., 0., 0.])
+        X = mesh.evaluate_points([], numpy.zeros((0, 2)))
+        self.assertEqual(X.shape, (0, 3))
+
+    def test_generate_element_groups(self):
+        mesh = mesher.Mesh()
+        mesh.add_stdnode(1, [0., 0.])
+        mesh.add_stdnode(2, [1., 1.])
+        mesh.add_stdnode(3, [2., 0.])
+        mesh.add_stdnode(4, [3., 2.])
+        mesh.add_element(1, ['L1'], [1, 2])
+        mesh.add_element(2, ['L2'], [2, 3, 4])
+        mesh.add_element(3, ['L1'], [3, 4])
+        mesh.generate()
+        c = mesh.core
+        self.assertEqual(len(c.EGroups), 2)
+        self.assertEqual(c.EGroups[0][0], ['L1'])
+        npt.assert_equal(c.EGroups[0][1], [0, 2])
+        npt.assert_equal(c.EGroups[0][2], [[[0, 2], [1, 3]], [[4, 6], [5, 7]]])
+        self.assertEqual(c.EGroups[0][2].dtype, numpy.int32)
+        self.assertEqual(c.EGroups[1][0], ['L2'])
+        npt.assert_equal(c.EGroups[1][2], [[[2, 4, 6], [3, 5, 7]]])
+        npt.assert_equal(c.EGroupId, [0, 1, 0])
+        npt.assert_equal(c.EGroupIndex, [0, 0, 1])
+        npt.assert_equal(c.element_params([2, 0]),
+                         [[[2., 3.], [0., 2.]], [[0., 1.], [0., 1.]]])
         
+    def test_gauss_points(self):
+        for ng in [1, 4, 9]:
+            Xi, W = core.gauss_points(ng)
+            self.assertEqual(Xi.shape, (ng, 1))
+            for n in range(2 * ng):
+                npt.assert_almost_equal(
+                    (W * Xi[:, 0] ** n).sum(), 1. / (n + 1))
+        Xi, W = core.gauss_points([3, 2, 2])
+        self.assertEqual(Xi.shape, (12, 3))
+        npt.assert_almost_equal((W * Xi[:, 0] ** 4 * Xi[:, 2] ** 3).sum(),
+                                0.2 * 0.25)
+        self.assertIs(core.gauss_points([3, 2, 2])[0], Xi)
+        self.assertFalse(Xi.flags.writeable)
+
+    def test_triangle_gauss_points(self):
+        Xi, W = core.triangle_gauss_points(3)
+        self.assertTrue((Xi.sum(1) <= 1).all())
+        npt.assert_almost_equal(W.sum(), 0.5)
+        # int x^a y^b over the triangle is a! b! / (a + b + 2)!
+        npt.assert_almost_equal((W * Xi[:, 0] ** 2 * Xi[:, 1] ** 3).sum(),
+                                2. * 6. / 5040.)
+        self.assertIs(core.basis_gauss_points(['T11'], 3)[0], Xi)
+
+    def test_quadrature_weights(self):
+        Phi = core.get_quadrature_weights(['L2', 'L1'], 3, deriv=[1, 0])
+        Xi = core.basis_gauss_points(['L2', 'L1'], 3)[0]
+        npt.assert_almost_equal(
+            Phi, interpolator.weights(['L2', 'L1'], Xi, deriv=[1, 0]))
+        self.assertIs(
+            core.get_quadrature_weights(['L2', 'L1'], [3, 3], [1, 0]), Phi)
+
+    def test_basis_corners(self):
+        self.assertEqual(core.basis_corners(['L1', 'L1']), [0, 1, 2, 3])
+        self.assertEqual(core.basis_corners(['H3', 'L3']), [0, 1, 6, 7])
+        self.assertEqual(core.basis_corners(['T22']), [0, 2, 5])
+        self.assertEqual(core.basis_corners(['T11', 'L2']),
+                         [0, 1, 2, 6, 7, 8])
+        xi = numpy.array([[0.25, 0.], [0.3, 0.5]])
+        npt.assert_almost_equal(core.basis_corner_weights(['L2', 'L1'], xi),
+                                [[0.75, 0.25, 0, 0], [0.35, 0.15, 0.35, 0.15]])
+        npt.assert_almost_equal(core.basis_corner_weights(['T33'], xi),
+                                [[0.75, 0.25, 0], [0.2, 0.3, 0.5]])
+
+    def test_basis_xi_grid(self):
+        self.assertEqual(core.basis_shape(['L1', 'H3']), 'quad')
+        self.assertEqual(core.basis_shape(['T22']), 'tri')
+        self.assertEqual(core.basis_shape(['L1', 'L1', 'L1']), 'hex')
+        self.assertIsNone(core.basis_shape(['T11', 'L1']))
+        self.assertIs(core.basis_xi_grid(['L2', 'H3'], 4),
+                      discretizer.xi_grid(shape='quad', res=4)[0])
+        Xi = core.basis_xi_grid(['T11', 'L1'], 2)
+        self.assertEqual(Xi.shape, (18, 3))
+        self.assertFalse(Xi.flags.writeable)
+        self.assertTrue((Xi[:, 0] + Xi[:, 1] <= 1).all())
+        self.assertEqual(len(set(map(tuple, Xi))), 18)
+
     #~ def test_get_variables(self):
         #~ c = core.Core()
         #~ cids = c.add_params(numpy.array([3, 6, 9, 5, 2]))
@@ -0,0 +1,72 @@
+import sys
+import unittest
+
+import numpy
+import numpy.testing as npt
+
+sys.path.append('..')
+from morphic import discretizer
+
+
+class TestXiGrid(unittest.TestCase):
+    """Unit tests for morphic discretizer xi grids."""
+
+    def test_line(self):
+        Xi, T = discretizer.xi_grid(shape='line', res=4)
+        npt.assert_almost_equal(Xi[:, 0], [0, 0.25, 0.5, 0.75, 1])
+        npt.assert_equal(T, [[0, 1], [1, 2], [2, 3], [3, 4]])
+
+    def test_quad(self):
+        Xi, T = discretizer.xi_grid(shape='quad', res=2)
+        self.assertEqual(Xi.shape, (9, 2))
+        npt.assert_almost_equal(Xi[5], [1, 0.5])
+        npt.assert_equal(T[:4], [[0, 1, 3], [1, 4, 3], [1, 2, 4], [2, 5, 4]])
+        self.assertEqual(T.shape, (8, 3))
+        self.assertEqual(T.dtype, numpy.uint32)
+
+    def test_quad_anisotropic(self):
+        Xi, T = discretizer.xi_grid(shape='quad', res=[3, 1])
+        self.assertEqual(Xi.shape, (8, 2))
+        npt.assert_almost_equal(Xi[:4, 0], [0, 1. / 3, 2. / 3, 1])
+        npt.assert_almost_equal(Xi[:, 1], [0] * 4 + [1] * 4)
+        npt.assert_equal(T[-2:], [[2, 3, 6], [3, 7, 6]])
+
+    def test_tri(self):
+        Xi, T = discretizer.xi_grid(shape='tri', res=2)
+        npt.assert_almost_equal(
+            Xi, [[0, 0], [0.5, 0], [1, 0], [0, 0.5], [0.5, 0.5], [0, 1]])
+        npt.assert_equal(T, [[0, 1, 3], [1, 4, 3], [1, 2, 4], [3, 4, 5]])
+        self.assertRaises(ValueError, discretizer.xi_grid, shape='tri',
+                          res=[2, 3])
+
+    def test_center(self):
+        Xi, T = discretizer.xi_grid(shape='quad', res=1, method='center')
+        npt.assert_almost_equal(Xi[:, 0], [0.25, 0.75, 0.25, 0.75])
+
+    def test_hex(self):
+        Xi, T = discretizer.xi_grid(shape='hex', res=[2, 1, 1])
+        self.assertEqual(Xi.shape, (12, 3))
+        npt.assert_equal(T, [[0, 1, 3, 4, 6, 7, 9, 10],
+                             [1, 2, 4, 5, 7, 8, 10, 11]])
+        npt.assert_almost_equal(Xi[T[1]].min(0), [0.5, 0, 0])
+        npt.assert_almost_equal(Xi[T[1]].max(0), [1, 1, 1])
+        Xh = discretizer.xi_grid(shape='hexagonal', res=2)[0]
+        self.assertEqual(Xh.shape, (27, 3))
+
+    def test_cache(self):
+        discretizer.clear_xi_grid_cache()
+        Xi, T = discretizer.xi_grid(shape='quad', res=3)
+        Xi2, T2 = discretizer.xi_grid(shape='quad', res=[3, 3])
+        self.assertIs(Xi, Xi2)
+        self.assertIs(T, T2)
+        self.assertFalse(Xi.flags.writeable)
+        self.assertFalse(T.flags.writeable)
+        self.assertIsNot(discretizer.xi_grid(shape='quad', res=3,
+                                             method='center')[0], Xi)
+
+    def test_unknown_shape(self):
+        self.assertRaises(ValueError, discretizer.xi_grid, shape='wedge')
+
+
+if __name__ == "__main__":
+    unittest.main()
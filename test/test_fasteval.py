@@ -4,6 +4,7 @@ import doctest
 
 import numpy as np
 import numpy.testing as npt
+import scipy.sparse
 
 sys.path.append('..')
 from morphic import mesher
@@ -163,5 +164,58 @@ class TestFastEval(unittest.TestCase):
         npt.assert_almost_equal(dx_matrix, x2 - x1)
 
 
+    def test_add_element_points_bulk(self):
+        xi = np.array([[0.1, 0.7], [0.6, 0.5], [0.3, 0.2], [0.9, 0.9]])
+        fields = [0, 2, 1, 2]
+        derivs = np.array([[0, 0], [1, 0], [0, 1], [0, 0]])
+        scalars = [1., -2., 0.5, 3.]
+
+        fe = fasteval.FEMatrix((4, 12))
+        fe.auto_increment_rows()
+        fe.add_mesh(self.mesh)
+        for i in range(4):
+            fe.add_element_point(1, xi[i], fields[i], deriv=derivs[i].tolist(),
+                                 scalar=scalars[i])
+
+        fe_bulk = fasteval.FEMatrix((4, 12))
+        fe_bulk.auto_increment_rows()
+        fe_bulk.add_mesh(self.mesh)
+        fe_bulk.add_element_points([1, 1, 1, 1], xi, fields, deriv=derivs,
+                                   scalars=scalars)
+        self.assertEqual(fe_bulk.row_id, 4)
+        self.assertTrue(scipy.sparse.isspmatrix_csr(fe_bulk.A))
+        npt.assert_almost_equal(fe_bulk.A.toarray(), fe.A.toarray())
+
+    def test_add_element_points_rows(self):
+        xi1 = np.array([[0.1, 0.7]] * 3)
+        xi2 = np.array([[0.6, 0.5]] * 3)
+        fe = fasteval.FEMatrix((3, 12))
+        fe.add_mesh(self.mesh)
+        fe.add_element_points([1, 1, 1], xi1, [0, 1, 2], scalars=-1,
+                              rows=[0, 1, 2])
+        fe.add_element_points([1, 1, 1], xi2, [0, 1, 2], rows=[0, 1, 2])
+        dx_matrix = fe.dot(self.mesh.get_variables())
+        x1 = self.mesh.evaluate(1, xi1[0])[0]
+        x2 = self.mesh.evaluate(1, xi2[0])[0]
+        npt.assert_almost_equal(dx_matrix, x2 - x1)
+
+    def test_add_element_points_mixed_basis(self):
+        mesh = mesher.Mesh()
+        mesh.add_stdnode(1, [0., 1.])
+        mesh.add_stdnode(2, [1., 3.])
+        mesh.add_stdnode(3, [2., 2.])
+        mesh.add_stdnode(4, [4., 0.])
+        mesh.add_element(1, ['L1'], [1, 2])
+        mesh.add_element(2, ['L2'], [2, 3, 4])
+        mesh.generate()
+        eids = [2, 1, 2, 1]
+        xi = np.array([[0.3], [0.6], [0.9], [0.1]])
+        fe = fasteval.FEMatrix((4, mesh._core.P.size))
+        fe.add_mesh(mesh)
+        fe.add_element_points(eids, xi, 1, rows=range(4))
+        npt.assert_almost_equal(fe.dot(mesh._core.P),
+                                mesh.evaluate_points(eids, xi)[:, 1])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -79,6 +79,24 @@ class TestData(unittest.TestCase):
         d = fit.data['mydata']
         self.assertEqual(d.id, 'mydata')
         npt.assert_almost_equal(d.values, Xd)
+    
+    def test_query_tolerance(self):
+        numpy.random.seed(3)
+        d = fitter.Data('mydata', numpy.random.rand(200, 3))
+        x = numpy.random.rand(50, 3)
+        rr, ii = d.query(x)
+        x1 = x.copy()
+        x1[:5] += 0.2
+        x1[5:] += 1e-4
+        rr1, ii1 = d.query(x1, tolerance=1e-2)
+        rr2, ii2 = d.tree.query(x1)
+        npt.assert_equal(ii1[:5], ii2[:5])
+        npt.assert_equal(ii1[5:], ii[5:])
+        npt.assert_almost_equal(rr1, numpy.sqrt(
+            ((x1 - d.values[ii1]) ** 2).sum(1)))
+        rr1, ii1 = d.query(x1)
+        npt.assert_equal(ii1, ii2)
+        npt.assert_almost_equal(rr1, rr2)
         
         
         
@@ -172,6 +190,116 @@ class TestFitter(unittest.TestCase):
         Xr = fit.get_data(self.mesh)
         npt.assert_almost_equal(Xr, [0.4, 2.7])
         
+    def test_generate_matrix_many_points(self):
+        mesh = mesher.Mesh()
+        mesh.add_stdnode(1, [0, 0])
+        mesh.add_stdnode(2, [1, 0.5])
+        mesh.add_stdnode(3, [2, 0.2])
+        mesh.add_element(1, ['L1'], [1, 2])
+        mesh.add_element(2, ['L1'], [2, 3])
+        mesh.generate()
+        numpy.random.seed(1)
+        eids = numpy.random.randint(1, 3, 50)
+        xi = numpy.random.rand(50)
+        fit = fitter.Fit()
+        for eid, x in zip(eids, xi):
+            fit.bind_element_point(int(eid), [x], 'datacloud')
+        fit.bind_node_value(3, 1, 0, 'x3', weight=2)
+        fit.update_from_mesh(mesh)
+        self.assertEqual(fit.num_rows, 101)
+        self.assertEqual(fit.param_ids, list(range(6)))
+        npt.assert_equal(fit.get_column_index([5, 0, 3]), [5, 0, 3])
+        X = fit.A.dot(mesh._core.P[fit.param_ids])
+        npt.assert_almost_equal(
+            X[:100].reshape((50, 2)),
+            mesh.evaluate_points(eids, xi[:, numpy.newaxis]))
+        npt.assert_almost_equal(X[100], 0.4)
+        self.assertEqual(fit.data_map[-1], [50, 1])
+
+    def test_solve_linear(self):
+        fit = fitter.Fit()
+        fit.bind_element_point(9, [0.3], 'datacloud', 0, weight=2)
+        fit.bind_element_point(9, [0.8], 'datacloud', 1, weight=1)
+        fit.bind_element_point(9, [0.5], 'datacloud', 1, weight=1)
+        fit.update_from_mesh(self.mesh)
+        fit.set_solver('factorized')
+        Xd = numpy.array([0.3, 0.1, 0.7, 0.4, 0.5, 0.2])
+        x = fit.solve_linear(Xd)
+        npt.assert_almost_equal(
+            x, numpy.linalg.lstsq(fit.A.toarray(), Xd, rcond=None)[0])
+        lu = fit.solver._lu
+        fit.solve_linear(2 * Xd)
+        self.assertIs(fit.solver._lu, lu)
+
+        fit.set_solver('factorized', regularisation=0.1)
+        x = fit.solve_linear(Xd)
+        A = fit.A.toarray()
+        npt.assert_almost_equal(x, numpy.linalg.solve(
+            A.T.dot(A) + 0.1 * numpy.eye(4), A.T.dot(Xd)))
+
+        fit.update_from_mesh(self.mesh)
+        self.assertFalse(fit.solver.factorized)
+        self.assertRaises(ValueError, fit.set_solver, 'cg')
+
+    def test_invert_matrix(self):
+        fit = fitter.Fit()
+        fit.bind_element_point(9, [0.3], 'datacloud', 0)
+        fit.bind_element_point(9, [0.8], 'datacloud', 1)
+        fit.update_from_mesh(self.mesh)
+        fit.invert_matrix()
+        self.assertTrue(fit.solver.factorized)
+        self.assertEqual(fit.solver.name, 'svd')
+        Xd = numpy.array([0.3, 0.1, 0.7, 0.4])
+        npt.assert_almost_equal(fit.solve_linear(Xd),
+                                numpy.linalg.solve(fit.A.toarray(), Xd))
+        fit.invert_matrix('cholesky')
+        npt.assert_almost_equal(fit.solve_linear(Xd),
+                                numpy.linalg.solve(fit.A.toarray(), Xd))
+
+    def test_invert_matrix_rank_deficient(self):
+        # One data point does not determine the two nodes
+        fit = fitter.Fit()
+        fit.bind_element_point(9, [0.3], 'datacloud')
+        fit.update_from_mesh(self.mesh)
+        fit.invert_matrix()
+        Xd = numpy.array([0.3, 0.7])
+        npt.assert_almost_equal(fit.solve_linear(Xd),
+                                numpy.linalg.pinv(fit.A.toarray()).dot(Xd))
+        self.assertRaises(RuntimeError, fit.invert_matrix, 'cholesky')
+        fit.invert_matrix('cholesky', regularisation=1e-8)
+        npt.assert_almost_equal(fit.A.dot(fit.solve_linear(Xd)), Xd)
+
+    def test_generate_data_index(self):
+        fit = fitter.Fit()
+        fit.bind_element_point(9, [0.3], 'datacloud', 1)
+        fit.bind_node_value(2, 0, 0, 'x0')
+        fit.bind_element_point(9, [0.8], 'datacloud', fields=[1])
+        fit.update_from_mesh(self.mesh)
+        fit.generate_data_index()
+        rows_index, rows_elem, rows_node = fit.data_index['datacloud']
+        npt.assert_equal(rows_index, [[0, 1], [1, 1], [0, 1]])
+        npt.assert_equal(rows_elem, [[3], [1]])
+        self.assertEqual(rows_node[0].size, 0)
+        rows_index, rows_elem, rows_node = fit.data_index['x0']
+        npt.assert_equal(rows_node[0], [2])
+        self.assertEqual(rows_node[1], [2])
+        npt.assert_equal(rows_node[2], [0])
+
+    def test_update_point_data(self):
+        fit = fitter.Fit()
+        fit.bind_element_point(9, [0.2], 'cloud1')
+        fit.bind_element_point(9, [0.7], 'cloud1')
+        fit.bind_element_point(9, [0.5], 'cloud2')
+        fit.set_data('cloud1', numpy.array([[0.1, 0.2], [0.8, -0.1]]))
+        fit.set_data('cloud2', numpy.array([[0.4, 0.1], [2., 0.]]))
+        fit.update_from_mesh(self.mesh)
+        fit.generate_fast_data()
+        fit.update_point_data(self.mesh._core.P[fit.param_ids])
+        npt.assert_almost_equal(fit.data['cloud1'].xc,
+                                [0.1, 0.2, 0.8, -0.1])
+        npt.assert_almost_equal(fit.data['cloud2'].xc, [0.4, 0.1])
+        npt.assert_almost_equal(fit.compute_rms_err(), numpy.sqrt(0.09 / 3))
+    
     def test_set_data(self):
         fit = fitter.Fit()
         Xd = numpy.array([[0.1, 0.2], [0.3, 0.4]])
@@ -253,5 +381,230 @@ class TestFitter(unittest.TestCase):
         
         
         
+class TestOptimize(unittest.TestCase):
+    """Unit tests for morphic nonlinear fits."""
+
+    def setUp(self):
+        self.mesh = mesher.Mesh()
+        for i in range(3):
+            self.mesh.add_stdnode(i + 1, [i, 0.2 * i])
+        self.mesh.add_element(1, ['L1'], [1, 2])
+        self.mesh.add_element(2, ['L1'], [2, 3])
+        self.mesh.generate()
+        self.mesh.nodes[2].variables(True)
+        self.mesh.nodes[3].variables(True, 1)
+        x = numpy.linspace(0, 2, 30)
+        self.Xd = numpy.array([x, 0.3 * numpy.sin(x)]).T
+
+    def _fit(self, method):
+        fit = fitter.Fit(method)
+        fit.Xi = numpy.array([numpy.linspace(0, 1, 7)]).T
+        fit.X = numpy.zeros((14, 2))
+        return fit
+
+    def test_jacobians(self):
+        from scipy.spatial import cKDTree
+        args = [self.mesh, self.Xd, cKDTree(self.Xd)]
+        x0 = self.mesh.get_variables() + 0.01
+        for method in ['m2dc', 'd2mc']:
+            fit = self._fit(method)
+            fit.generate_sensitivity(self.mesh)
+            J = fit.jacfn(x0, args)
+            Jn = numpy.zeros(J.shape)
+            for k in range(x0.size):
+                dx = numpy.zeros(x0.size)
+                dx[k] = 1e-6
+                Jn[:, k] = (fit.objfn(x0 + dx, args) -
+                            fit.objfn(x0 - dx, args)) / 2e-6
+            npt.assert_almost_equal(J.toarray(), Jn)
+
+    def test_jacobian_surface(self):
+        args = [self.mesh, self.Xd, None]
+        x0 = self.mesh.get_variables() + 0.01
+        fit = fitter.Fit('d2ms')
+        J = fit.jacfn(x0, args)
+        Jn = numpy.zeros(J.shape)
+        for k in range(x0.size):
+            dx = numpy.zeros(x0.size)
+            dx[k] = 1e-6
+            Jn[:, k] = (fit.objfn(x0 + dx, args) -
+                        fit.objfn(x0 - dx, args)) / 2e-6
+        npt.assert_almost_equal(J.toarray(), Jn)
+
+    def create_dependent_mesh(self):
+        mesh = mesher.Mesh()
+        for i in range(3):
+            mesh.add_stdnode(i + 1, [i, 0.2 * i])
+        mesh.add_element(1, ['L1'], [1, 2])
+        mesh.add_element(2, ['L1'], [2, 3])
+        mesh.add_stdnode('xi', [0.5])
+        mesh.add_depnode(4, 2, 'xi')
+        mesh.add_stdnode(5, [3, 0.])
+        mesh.add_element(3, ['L1'], [4, 5])
+        mesh.generate()
+        mesh.add_map((2, 1), (5, 1))
+        mesh.update(force=True)
+        mesh.nodes[2].variables(True)
+        mesh.nodes[3].variables(True, 1)
+        mesh.nodes['xi'].variables(True)
+        return mesh
+
+    def test_jacobians_dependent(self):
+        from scipy.spatial import cKDTree
+        mesh = self.create_dependent_mesh()
+        x = numpy.linspace(0, 3, 30)
+        Xd = numpy.array([x, 0.3 * numpy.sin(x)]).T
+        args = [mesh, Xd, cKDTree(Xd)]
+        x0 = mesh.get_variables() + 0.01
+        for method in ['m2dc', 'd2mc', 'd2ms']:
+            fit = fitter.Fit(method)
+            fit.Xi = numpy.array([numpy.linspace(0, 1, 7)]).T
+            fit.X = numpy.zeros((21, 2))
+            fit.generate_sensitivity(mesh)
+            J = fit.jacfn(x0, args)
+            Jn = numpy.zeros(J.shape)
+            for k in range(x0.size):
+                dx = numpy.zeros(x0.size)
+                dx[k] = 1e-6
+                Jn[:, k] = (fit.objfn(x0 + dx, args) -
+                            fit.objfn(x0 - dx, args)) / 2e-6
+            npt.assert_almost_equal(J.toarray(), Jn, decimal=5)
+            if method == 'm2dc':
+                S = fit.get_jac_sparsity(mesh).toarray()
+                self.assertEqual(S.shape, J.shape)
+                self.assertTrue((S[J.toarray() != 0] != 0).all())
+
+    def test_optimize2_param_jacobian(self):
+        mesh = self.create_dependent_mesh()
+        mesh.nodes['xi'].variables(False)
+        target = mesh.core.P + 0.1 * numpy.sin(numpy.arange(mesh.core.P.size))
+        fit = fitter.Fit()
+
+        def objective_function(x, args):
+            fit._set_variables(args[0], x)
+            return args[0].core.P - args[1]
+
+        def jac(x, args):
+            return numpy.eye(args[0].core.P.size)
+
+        fit.objective_function = objective_function
+        x0 = mesh.get_variables()
+        fit.optimize2(mesh, target, output=False, jac=jac)
+        x1 = mesh.get_variables()
+        mesh.set_variables(x0)
+        fit.optimize2(mesh, target, output=False,
+                      jac_sparsity=numpy.eye(mesh.core.P.size))
+        npt.assert_almost_equal(mesh.get_variables(), x1)
+        mesh.set_variables(x0)
+        mesh.update(force=True)
+        M = mesh.core.get_variable_map().toarray()
+        dx = numpy.linalg.lstsq(M, target - mesh.core.P, rcond=None)[0]
+        npt.assert_almost_equal(x1, x0 + dx)
+
+    def test_optimize_surface(self):
+        args = [self.mesh, self.Xd, None]
+        fit = fitter.Fit('d2ms')
+        err0 = fit.objfn(self.mesh.get_variables(), args)
+        npt.assert_almost_equal(err0, self.mesh.project(self.Xd)[2] ** 2)
+        fit.optimize(self.mesh, self.Xd, output=False)
+        err1 = fit.objfn(self.mesh.get_variables(), args)
+        self.assertLess(err1.sum(), 0.6 * err0.sum())
+
+    def test_optimize(self):
+        x0 = self.mesh.get_variables()
+        fit = self._fit('m2dc')
+        fit.optimize(self.mesh, self.Xd, output=False, jac=False)
+        x1 = self.mesh.get_variables()
+        self.mesh.set_variables(x0)
+        fit.optimize(self.mesh, self.Xd, output=False)
+        npt.assert_almost_equal(self.mesh.get_variables(), x1, decimal=5)
+
+    def test_optimize_data_to_mesh(self):
+        from scipy.spatial import cKDTree
+        args = [self.mesh, self.Xd, cKDTree(self.Xd)]
+        fit = self._fit('d2mc')
+        err0 = fit.objfn(self.mesh.get_variables(), args).sum()
+        fit.optimize(self.mesh, self.Xd, output=False)
+        err1 = fit.objfn(self.mesh.get_variables(), args).sum()
+        self.assertLess(err1, 0.6 * err0)
+
+    def test_optimize_project(self):
+        args = [self.mesh, self.Xd, None]
+        fit = self._fit('d2mp')
+        err0 = fit.objfn(self.mesh.get_variables(), args)
+        npt.assert_almost_equal(err0, self.mesh.project(self.Xd)[2] ** 2)
+        fit.optimize(self.mesh, self.Xd, output=False)
+        err1 = fit.objfn(self.mesh.get_variables(), args)
+        self.assertLess(err1.sum(), 0.6 * err0.sum())
+
+
+class TestCompiledFit(unittest.TestCase):
+    """Unit tests for morphic compiled fits."""
+
+    def setUp(self):
+        self.mesh = mesher.Mesh()
+        self.mesh.add_stdnode(1, [0, 0])
+        self.mesh.add_stdnode(2, [1, 0])
+        self.mesh.add_element(9, ['L1'], [1, 2])
+        self.mesh.generate()
+
+    def test_solve_data_index(self):
+        fit = fitter.Fit()
+        fit.bind_element_point(9, [0.3], 'datacloud', 0, weight=2)
+        fit.bind_element_point(9, [0.8], 'datacloud', 1, weight=2)
+        fit.bind_node_value(1, 1, 0, 'y1', 0)
+        fit.update_from_mesh(self.mesh)
+        compiled = fit.compile(self.mesh)
+        P, rms = compiled.solve({
+            'datacloud': numpy.array([[0.3, 0.15], [0.8, 0.4]]),
+            'y1': numpy.array([[0, 0]])})
+        npt.assert_almost_equal(P, [0, 0, 1.0, 0.5])
+        npt.assert_almost_equal(self.mesh._core.P, [0, 0, 1, 0])
+
+    def create_fit(self, data=None):
+        fit = fitter.Fit()
+        for xi in numpy.linspace(0, 1, 11):
+            fit.bind_element_point(9, [xi], 'cloud')
+        if data is not None:
+            fit.set_data('cloud', data)
+        fit.update_from_mesh(self.mesh)
+        fit.set_solver('cholesky')
+        return fit
+
+    def test_solve_batch(self):
+        compiled = self.create_fit().compile(self.mesh)
+        x = numpy.linspace(0, 2, 201)
+        datas = [numpy.array([x, 0.5 * x + 1]).T,
+                 numpy.array([x, 0.2 * x]).T,
+                 numpy.array([x - 0.5, 0.1 * x]).T]
+        P0 = numpy.array([0.1, 0, 1.2, 0.2])
+        Ps, rms = compiled.solve_batch(datas, Ps=[compiled.P, compiled.P, P0])
+        for i, data in enumerate(datas):
+            P = P0 if i == 2 else None
+            Pi, rmsi = compiled.solve(data, P=P)
+            npt.assert_almost_equal(Ps[i], Pi)
+            npt.assert_almost_equal(rms[i], rmsi)
+
+            # The same subject fitted on the mesh
+            self.mesh._core.P[:] = compiled.P if P is None else P
+            self.mesh._core.touch_params()
+            fit = self.create_fit(data)
+            fit.generate_fast_data()
+            mesh, rms_fit = fit.solve(self.mesh)
+            npt.assert_almost_equal(Ps[i], mesh._core.P)
+            npt.assert_almost_equal(rms[i], rms_fit)
+
+    def test_solve_after_regenerate(self):
+        fit = self.create_fit()
+        compiled = fit.compile(self.mesh)
+        x = numpy.linspace(0, 2, 201)
+        data = numpy.array([x, 0.5 * x + 1]).T
+        P0, rms0 = compiled.solve(data)
+        fit.update_from_mesh(self.mesh)
+        self.assertFalse(fit.solver.factorized)
+        P1, rms1 = compiled.solve(data)
+        npt.assert_almost_equal(P1, P0)
+        npt.assert_almost_equal(rms1, rms0)
+
 if __name__ == "__main__":
     unittest.main()
@@ -442,6 +442,16 @@ class TestBasisFunction(unittest.TestCase):
             array([[ 0.1792,  0.3328, -0.0962,  0.5888,  0.1196, -0.1242],
                    [-0.1122,  0.5236,  0.4158,  0.0408,  0.1848, -0.0528]]))
     
+    def test_T11_T22_derivatives(self):
+        x = numpy.array([[0.13, 0.23], [0.77, 0.06]])
+        dx = numpy.array([[1e-6, 0], [0, 1e-6]])
+        for fn, d1, d2 in [
+                [interpolator.T11, interpolator.T11d1, interpolator.T11d2],
+                [interpolator.T22, interpolator.T22d1, interpolator.T22d2]]:
+            for deriv, h in zip([d1, d2], dx):
+                numpy.testing.assert_almost_equal(deriv(x),
+                    (fn(x + h) - fn(x - h)) / 2e-6)
+    
     def test_T33(self):
         x = numpy.array([[0.13, 0.23], [0.77, 0.06]])
         numpy.testing.assert_almost_equal(interpolator.T33(x),
@@ -527,5 +537,32 @@ class TestVectorElements(unittest.TestCase):
         W = interpolator.weights(['V1', 'V1', 'V1'], [[-0.33, 1.44, 15]], deriv=[1, 0, 2])
         numpy.testing.assert_almost_equal(W, [0, 0, 0, 0])
 
+    def test_get_kernel_cached(self):
+        """Tests kernels are reused for the same basis and deriv"""
+        interpolator.clear_kernel_cache()
+        k1 = interpolator.get_kernel(['H3', 'H3'], deriv=[1, 0])
+        k2 = interpolator.get_kernel(('H3', 'H3'), deriv=numpy.array([1, 0]))
+        self.assertTrue(k1 is k2)
+        k3 = interpolator.get_kernel(['H3', 'H3'], deriv=[0, 1])
+        self.assertFalse(k1 is k3)
+        self.assertEqual(k1.num_weights, 16)
+        self.assertEqual(k1.product_indices.shape, (2, 16))
+        interpolator.clear_kernel_cache()
+        self.assertFalse(k1 is interpolator.get_kernel(['H3', 'H3'], deriv=[1, 0]))
+
+    def test_kernel_H3H3H3(self):
+        """Tests the kernel against the tensor product of 1D weights"""
+        Xi = numpy.array([[0.1, 0.4, 0.7], [0.9, 0.2, 0.35]])
+        BPInd = interpolator._get_basis_product_indices(
+            ['H3', 'H3', 'H3'], 3, None)
+        for deriv in [None, [1, 0, 0], [0, 1, 1]]:
+            d = [0, 0, 0] if deriv is None else deriv
+            W1 = [interpolator.weights(['H3'], Xi[:, [i]], deriv=[d[i]])
+                  for i in range(3)]
+            Wexp = numpy.array([W1[0][:, ii[0]] * W1[1][:, ii[1]] *
+                                W1[2][:, ii[2]] for ii in BPInd]).T
+            W = interpolator.weights(['H3', 'H3', 'H3'], Xi, deriv=deriv)
+            numpy.testing.assert_almost_equal(W, Wexp)
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,4 +1,7 @@
+import os
 import sys
+import shutil
+import tempfile
 import unittest
 import doctest
 
@@ -16,9 +19,15 @@ from morphic import mesher
 class TestPyTablesMesh(unittest.TestCase):
     """Unit tests for morphic interpolants."""
     
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
     @ddt.file_data('io_formats.json')
     def test_save_empty_mesh(self, value):
-        filepath = 'data/%s.mesh' % (value)
+        filepath = os.path.join(self.tmpdir, '%s.mesh' % (value))
         mesh0 = mesher.Mesh(label='cube', units='mm')
         mesh0.generate()
         # mesh0.save(filepath, format=value)
@@ -29,7 +38,7 @@ class TestPyTablesMesh(unittest.TestCase):
     
     @ddt.file_data('io_formats.json')
     def test_metadata(self, value):
-        filepath = 'data/%s.mesh' % (value)
+        filepath = os.path.join(self.tmpdir, '%s.mesh' % (value))
         mesh0 = mesher.Mesh(label='cube', units='mm')
         mesh0.add_stdnode(1, [0.5])
         mesh0.generate()
@@ -48,7 +57,7 @@ class TestPyTablesMesh(unittest.TestCase):
     
     @ddt.file_data('io_formats.json')
     def test_metadata(self, value):
-        filepath = 'data/%s.mesh' % (value)
+        filepath = os.path.join(self.tmpdir, '%s.mesh' % (value))
         mesh0 = mesher.Mesh(label='cube', units='mm')
         mesh0.metadata.name = 'Joe Bloggs'
         mesh0.metadata.age = 23
@@ -75,7 +84,7 @@ class TestPyTablesMesh(unittest.TestCase):
     
     @ddt.file_data('io_formats.json')
     def test_stdnodes(self, value):
-        filepath = 'data/%s.mesh' % (value)
+        filepath = os.path.join(self.tmpdir, '%s.mesh' % (value))
         mesh0 = mesher.Mesh()
         mesh0.add_stdnode(1, [0.5, 0.5])
         mesh0.add_stdnode(2, [0.0, 0.3])
@@ -93,7 +102,7 @@ class TestPyTablesMesh(unittest.TestCase):
 
     @ddt.file_data('io_formats.json')
     def test_depnodes(self, value):
-        filepath = 'data/%s.mesh' % (value)
+        filepath = os.path.join(self.tmpdir, '%s.mesh' % (value))
         mesh0 = mesher.Mesh()
         mesh0.add_stdnode('xi', [0.5])
         mesh0.add_stdnode(1, [0.0, 0.0])
@@ -109,7 +118,7 @@ class TestPyTablesMesh(unittest.TestCase):
         
     @ddt.file_data('io_formats.json')
     def test_pcanodes(self, value):
-        filepath = 'data/%s.mesh' % (value)
+        filepath = os.path.join(self.tmpdir, '%s.mesh' % (value))
         mesh0 = mesher.Mesh()
         mesh0.add_stdnode('weights', [1, 1, -0.1])
         mesh0.add_stdnode('vars', [1, 0.1, 0.04])
@@ -141,7 +150,7 @@ class TestPyTablesMesh(unittest.TestCase):
 
     @ddt.file_data('io_formats.json')
     def test_elements(self, value):
-        filepath = 'data/%s.mesh' % (value)
+        filepath = os.path.join(self.tmpdir, '%s.mesh' % (value))
         mesh0 = mesher.Mesh()
         mesh0.add_stdnode(1, [0.5, 0.7, 1.2])
         mesh0.add_stdnode(2, [0.0, 0.3, 0.4])
@@ -174,7 +183,7 @@ class TestPyTablesMesh(unittest.TestCase):
             nids1 = [n.id for n in mesh1.elements.groups[group]]
             self.assertEqual(nids0, nids1)
         
-        filepath = 'data/%s.mesh' % (value)
+        filepath = os.path.join(self.tmpdir, '%s.mesh' % (value))
         mesh0 = mesher.Mesh()
         mesh0.add_stdnode(1, [0., 0.])
         mesh0.add_stdnode('2', [3., 0.])
@@ -384,6 +384,287 @@ class TestElementIntegration(unittest.TestCase):
         # ~ npt.assert_almost_equal(W, true_W)
 
 
+class TestMeshIntegration(unittest.TestCase):
+    """Unit tests for morphic mesh integration."""
+
+    def create_quad_mesh(self):
+        mesh = mesher.Mesh()
+        nid = 0
+        for j in range(3):
+            for i in range(3):
+                nid += 1
+                mesh.add_stdnode(nid, [0.5 * i + 0.1 * j, j, 0.2 * i * j])
+        mesh.add_element(1, ['L1', 'L1'], [1, 2, 4, 5])
+        mesh.add_element(2, ['L1', 'L1'], [2, 3, 5, 6])
+        mesh.add_element(3, ['L1', 'L1'], [4, 5, 7, 8])
+        mesh.add_element(4, ['L1', 'L1'], [5, 6, 8, 9])
+        mesh.generate()
+        return mesh
+
+    def test_integrate(self):
+        mesh = self.create_quad_mesh()
+        fields = [[0, 0, 0], [2, 1, 0], [1, 0, 1]]
+        integrals, total = mesh.integrate(fields)
+        for i, element in enumerate(mesh.elements):
+            npt.assert_almost_equal(integrals[i], element.integrate(fields))
+        npt.assert_almost_equal(total, integrals.sum(0))
+
+    def test_integrate_func(self):
+        def mag(x):
+            return numpy.sqrt((x * x).sum(1))
+
+        mesh = self.create_quad_mesh()
+        fields = [[0, 0, 0], [2, 0, 0]]
+        integrals, total = mesh.integrate(fields, func=mag, elements=[4, 2])
+        npt.assert_almost_equal(integrals[0],
+                                mesh.elements[4].integrate(fields, func=mag))
+        npt.assert_almost_equal(integrals[1],
+                                mesh.elements[2].integrate(fields, func=mag))
+
+    def test_integrate_triangle(self):
+        mesh = mesher.Mesh()
+        mesh.add_stdnode(1, [0, 0])
+        mesh.add_stdnode(2, [2, 0])
+        mesh.add_stdnode(3, [0, 1])
+        mesh.add_element(1, ['T11'], [1, 2, 3])
+        integrals, total = mesh.integrate([[0, 0, 0], [1, 0, 0]], ng=2)
+        npt.assert_almost_equal(total, [1. / 3., 1. / 6.])
+
+    def test_areas(self):
+        mesh = self.create_quad_mesh()
+        areas = mesh.areas()
+        for i, element in enumerate(mesh.elements):
+            npt.assert_almost_equal(areas[i], element.area())
+        npt.assert_almost_equal(mesh.area(), areas.sum())
+
+    def test_lengths(self):
+        mesh = mesher.Mesh()
+        mesh.add_stdnode(1, [0, 0])
+        mesh.add_stdnode(2, [3, 4])
+        mesh.add_stdnode(3, [3, 5])
+        mesh.add_element(1, ['L1'], [1, 2])
+        mesh.add_element(2, ['L1'], [2, 3])
+        npt.assert_almost_equal(mesh.lengths(), [5, 1])
+        npt.assert_almost_equal(mesh.length(), 6)
+        npt.assert_almost_equal(mesh.lengths(elements=[2]), [1])
+
+    def test_metric_element_dimensions(self):
+        mesh = self.create_quad_mesh()
+        mesh.add_stdnode('a', [0, 0, 0])
+        mesh.add_stdnode('b', [1, 1, 1])
+        mesh.add_element('line', ['L1'], ['a', 'b'])
+        self.assertEqual(mesh.areas().size, 4)
+        self.assertRaises(ValueError, mesh.areas, elements=['line'])
+        self.assertRaises(ValueError, mesh.lengths, elements=[1, 'line'])
+        self.assertRaises(ValueError, mesh.volumes, elements=['line'])
+
+    def test_volumes(self):
+        mesh = mesher.Mesh()
+        nid = 0
+        for k in range(2):
+            for j in range(2):
+                for i in range(3):
+                    nid += 1
+                    mesh.add_stdnode(nid, [i, 2 * j, 3 * k])
+        mesh.add_element(1, ['L1', 'L1', 'L1'], [1, 2, 4, 5, 7, 8, 10, 11])
+        mesh.add_element(2, ['L1', 'L1', 'L1'], [2, 3, 5, 6, 8, 9, 11, 12])
+        npt.assert_almost_equal(mesh.volumes(), [6, 6])
+        npt.assert_almost_equal(mesh.volume(), 12)
+
+
+class TestMeshProject(unittest.TestCase):
+    """Unit tests for morphic mesh projection."""
+
+    def create_mesh(self):
+        mesh = mesher.Mesh()
+        nid = 0
+        for j in range(3):
+            for i in range(5):
+                nid += 1
+                mesh.add_stdnode(nid, [0.5 * i, 0.5 * j,
+                                       0.3 * numpy.sin(i + j)])
+        mesh.add_element(1, ['L2', 'L2'], [1, 2, 3, 6, 7, 8, 11, 12, 13])
+        mesh.add_element(2, ['L2', 'L2'], [3, 4, 5, 8, 9, 10, 13, 14, 15])
+        mesh.add_stdnode(16, [2.5, 0., 0.])
+        mesh.add_stdnode(17, [2.5, 1., 0.5])
+        mesh.add_element(3, ['T11'], [5, 16, 17])
+        mesh.generate()
+        return mesh
+
+    def test_project(self):
+        mesh = self.create_mesh()
+        numpy.random.seed(4)
+        X = numpy.random.rand(40, 3) * [3., 1., 0.5] - [0.2, 0., 0.2]
+        Xi = core.basis_xi_grid(['L2', 'L2'], 100)
+        Xt = core.basis_xi_grid(['T11'], 100)
+        Xs = numpy.concatenate([mesh.evaluate([1, 2], Xi),
+                                mesh.evaluate(3, Xt)])
+        brute = numpy.sqrt(((X[:, None] - Xs[None]) ** 2).sum(2)).min(1)
+        eids, xi, dist = mesh.project(X)
+        self.assertEqual(xi.shape, (40, 2))
+        self.assertTrue((dist <= brute + 1e-8).all())
+        self.assertTrue((dist >= brute - 1e-2).all())
+        Xp = mesh.evaluate_points(eids, xi)
+        npt.assert_almost_equal(numpy.sqrt(((Xp - X) ** 2).sum(1)), dist)
+        for eid, x in zip(eids, xi):
+            if eid == 3:
+                self.assertTrue(x.sum() <= 1 + 1e-12)
+
+    def test_project_elements(self):
+        mesh = self.create_mesh()
+        X = numpy.array([[0.5, 0.5, 1.], [2.6, 0.4, 0.3]])
+        eids, xi, dist = mesh.project(X, elements=[1])
+        self.assertEqual(eids, [1, 1])
+        npt.assert_almost_equal(xi[1], [1, xi[1, 1]])
+        xi0 = mesh.elements[1].project(X[0])
+        npt.assert_almost_equal(xi0, xi[0])
+
+    def test_project_cubic_hermite(self):
+        # Strongly curved surface with points far from it, the closest
+        # points must not stop short or in a local minimum
+        from scipy.spatial import cKDTree
+        rng = numpy.random.RandomState(1)
+        mesh = mesher.Mesh()
+        nid = 0
+        for j in range(3):
+            for i in range(3):
+                nid += 1
+                mesh.add_stdnode(nid, [
+                    [i, 1 + 0.3 * rng.randn(), 0.3 * rng.randn(),
+                     0.3 * rng.randn()],
+                    [j, 0.3 * rng.randn(), 1 + 0.3 * rng.randn(),
+                     0.3 * rng.randn()],
+                    [0.4 * rng.randn(), 1.5 * rng.randn(),
+                     1.5 * rng.randn(), rng.randn()]])
+        mesh.add_element(1, ['H3', 'H3'], [1, 2, 4, 5])
+        mesh.add_element(2, ['H3', 'H3'], [2, 3, 5, 6])
+        mesh.add_element(3, ['H3', 'H3'], [4, 5, 7, 8])
+        mesh.add_element(4, ['H3', 'H3'], [5, 6, 8, 9])
+        mesh.generate()
+        rng = numpy.random.RandomState(101)
+        X = rng.rand(300, 3) * [2.4, 2.4, 1.6] - [0.2, 0.2, 0.8]
+        Xi = core.basis_xi_grid(['H3', 'H3'], 300)
+        brute = cKDTree(mesh.evaluate([1, 2, 3, 4], Xi)).query(X)[0]
+        eids, xi, dist = mesh.project(X)
+        self.assertTrue((dist <= brute + 1e-3).all())
+        Xp = mesh.evaluate_points(eids, xi)
+        npt.assert_almost_equal(numpy.sqrt(((Xp - X) ** 2).sum(1)), dist)
+
+        # Starting next to the closest point converges to it
+        xi0 = mesh.elements[eids[0]].project(X[0], xi=xi[0] + 0.02)
+        npt.assert_almost_equal(xi0, xi[0], decimal=6)
+
+    def test_project_ftol(self):
+        mesh = self.create_mesh()
+        x = numpy.array([0.5, 0.5, 1.])
+        xi = mesh.elements[1].project(x)
+        with self.assertWarns(DeprecationWarning):
+            xi1 = mesh.elements[1].project(x, None, 1e-8, 1e-4)
+        npt.assert_almost_equal(xi1, xi)
+
+
+class TestMeshTessellation(unittest.TestCase):
+    """Unit tests for morphic mesh surface and face tessellations."""
+
+    def create_mesh(self):
+        return TestMeshProject.create_mesh(self)
+
+    def create_hex_mesh(self):
+        mesh = mesher.Mesh()
+        nid = 0
+        for k in range(2):
+            for j in range(2):
+                for i in range(3):
+                    nid += 1
+                    mesh.add_stdnode(nid, [i, j + 0.1 * i, k])
+        mesh.add_element(1, ['L1', 'L1', 'L1'], [1, 2, 4, 5, 7, 8, 10, 11])
+        mesh.add_element(2, ['L1', 'L1', 'L1'], [2, 3, 5, 6, 8, 9, 11, 12])
+        mesh.generate()
+        return mesh
+
+    def test_surfaces(self):
+        mesh = self.create_mesh()
+        X, T, Xi = mesh.get_surfaces(res=3, include_xi=True)
+        self.assertEqual(X.shape, (2 * 16 + 10, 3))
+        self.assertEqual(T.shape, (2 * 18 + 9, 3))
+        npt.assert_almost_equal(X[:16], mesh.elements[1].evaluate(Xi[:16]))
+        npt.assert_almost_equal(X[-10:], mesh.elements[3].evaluate(Xi[-10:]))
+        self.assertIs(mesh.get_surface_tessellation(res=3),
+                      mesh.get_surface_tessellation(res=3))
+        self.assertFalse(T.flags.writeable)
+
+        mesh.nodes[8].values = numpy.array([1., 0.5, 1.])
+        X1, T1 = mesh.get_surfaces(res=3)
+        self.assertIs(T1, T)
+        out = numpy.zeros(X.shape)
+        self.assertIs(mesh.get_surfaces(res=3, out=out)[0], out)
+        mesh.generate(force=True)
+        X2, T2 = mesh.get_surfaces(res=3)
+        self.assertIsNot(T2, T)
+        npt.assert_almost_equal(X1, X2)
+        npt.assert_almost_equal(out, X2)
+        npt.assert_equal(T2, T)
+        self.assertRaises(ValueError, mesh.get_surfaces, res=3,
+                          out=numpy.zeros((2, 3)))
+
+    def test_grid(self):
+        mesh = self.create_mesh()
+        Xi = mesh.grid(res=2)
+        Xi[0] = [0.5, 0.5]
+        npt.assert_almost_equal(mesh.grid(res=2)[0], [0, 0])
+        Xe = mesh.elements[3].grid(res=2)
+        self.assertTrue(Xe.flags.writeable)
+        self.assertEqual(Xe.shape, (6, 2))
+
+    def test_surfaces_elements(self):
+        mesh = self.create_mesh()
+        X, T = mesh.get_surfaces(res=2, elements=[3])
+        npt.assert_almost_equal(X, mesh.get_surfaces(res=2)[0][-6:])
+        npt.assert_equal(T, mesh.get_surfaces(res=2)[1][-4:] - 18)
+
+    def test_faces(self):
+        mesh = self.create_hex_mesh()
+        X, T, Xi = mesh.get_faces(res=2, include_xi=True)
+        self.assertEqual(X.shape, (10 * 9, 3))
+        self.assertIs(mesh.get_face_tessellation(res=2),
+                      mesh.get_face_tessellation(res=2))
+        mesh.nodes[12].values = numpy.array([2.5, 1.5, 1.5])
+        X1, T1 = mesh.get_faces(res=2)
+        self.assertIs(T1, T)
+        self.assertGreater(numpy.absolute(X1 - X).max(), 0)
+        mesh.generate(force=True)
+        npt.assert_almost_equal(mesh.get_faces(res=2)[0], X1)
+        self.assertEqual(mesh.get_faces(res=2, exterior_only=False)[0].shape,
+                         (11 * 9, 3))
+
+
+    def test_surfaces_shared(self):
+        mesh = self.create_mesh()
+        X, T = mesh.get_surfaces(res=4)
+        Xs, Ts, Xi = mesh.get_surfaces(res=4, shared=True, include_xi=True)
+        # Elements 1 and 2 share an edge and elements 2 and 3 a corner
+        self.assertEqual(Xs.shape, (X.shape[0] - 6, 3))
+        self.assertEqual(Xi.shape, (X.shape[0] - 6, 2))
+        npt.assert_almost_equal(Xs[Ts], X[T])
+        dX = numpy.sqrt(((Xs[:, None] - Xs[None]) ** 2).sum(2))
+        self.assertGreater((dX + numpy.eye(Xs.shape[0])).min(), 1e-6)
+        mesh.nodes[13].values = numpy.array([1., 1., 1.])
+        npt.assert_almost_equal(mesh.get_surfaces(res=4, shared=True)[0][Ts],
+                                mesh.get_surfaces(res=4)[0][T])
+
+    def test_faces_shared(self):
+        mesh = self.create_hex_mesh()
+        X, T = mesh.get_faces(res=3)
+        Xs, Ts = mesh.get_faces(res=3, shared=True)
+        npt.assert_almost_equal(Xs[Ts], X[T])
+        # The exterior surface is closed, each edge has two triangles
+        edges = numpy.sort(numpy.concatenate(
+            [Ts[:, [0, 1]], Ts[:, [1, 2]], Ts[:, [2, 0]]]), axis=1)
+        edges, counts = numpy.unique(edges, axis=0, return_counts=True)
+        npt.assert_equal(counts, 2)
+        self.assertEqual(Xs.shape[0] - edges.shape[0] + Ts.shape[0], 2)
+
+
 class TestNode(unittest.TestCase):
     """Unit tests for morphic Node superclass."""
 
@@ -871,6 +1152,30 @@ class TestDepNode(unittest.TestCase):
         x = mesh.elements[2].evaluate([0.5])
         npt.assert_array_almost_equal(x, [0.25, 0.75])
 
+    def test_dependent_node_plan(self):
+        mesh = mesher.Mesh()
+        mesh.add_node('xi', [0.5])
+        mesh.add_node('xi2', [0.5])
+        mesh.add_node(1, [0.0, 0.0])
+        mesh.add_node(2, [1.0, 1.0])
+        mesh.add_node(4, [0.0, 1.0])
+        mesh.add_element(1, ['L1'], [1, 2])
+        mesh.add_element(2, ['L1'], ['dn', 4])
+        mesh.add_depnode('dn', 1, 'xi')
+        mesh.add_depnode('dn2', 2, 'xi2')
+        mesh.generate()
+        npt.assert_array_almost_equal(mesh.nodes['dn2'].values, [0.25, 0.75])
+        self.assertEqual(len(mesh.core.DNPlan[2]), 2)
+        plan = mesh.core.DNPlan
+        mesh.nodes[2].values = numpy.array([2.0, 2.0])
+        mesh.update(force=True)
+        self.assertTrue(mesh.core.DNPlan is plan)
+        npt.assert_array_almost_equal(mesh.nodes['dn2'].values, [0.5, 1.0])
+        mesh.core.P[mesh.nodes['xi'].cids] = 0.
+        mesh.update(force=True)
+        self.assertFalse(mesh.core.DNPlan is plan)
+        npt.assert_array_almost_equal(mesh.nodes['dn2'].values, [0.0, 0.5])
+
 
         # def test_generate_weighted_sum(self):
         #     mesh = mesher.Mesh()
@@ -961,6 +1266,40 @@ class TestPCANode(unittest.TestCase):
         mesh.update_pca_nodes()
         npt.assert_almost_equal(node.values, Xn)
 
+    def test_pca_plan(self):
+        mesh = mesher.Mesh()
+        mesh.add_stdnode(1, [[[1, 0.2, 0.1], [2, 0.55, 0.11]]])
+        mesh.add_stdnode(2, [[[2.1, 0.02, 0.01], [2.3, 0.15, 0.06]]])
+        mesh.add_stdnode('weights', [1, 0.0, 0.0])
+        mesh.add_stdnode('variance', [1, 1., 1.])
+        node1 = mesher.PCANode(mesh, 3, 1, 'weights', 'variance')
+        node2 = mesher.PCANode(mesh, 4, 2, 'weights', 'variance')
+        mesh.nodes.add(node1)
+        mesh.nodes.add(node2)
+        mesh.generate()
+        self.assertEqual(len(mesh.core.PCAPlan), 1)
+        targets, mode_cids = mesh.core.PCAPlan[0][:2]
+        self.assertEqual(mode_cids.shape, (4, 3))
+        mesh.nodes['weights'].values = numpy.array([1, 2.0, -1.5])
+        mesh.update_pca_nodes()
+        npt.assert_almost_equal(node1.values, [[1.25, 2.935]])
+        npt.assert_almost_equal(node2.values, [[2.125, 2.51]])
+
+    def test_pca_plan_mode_edit(self):
+        mesh = mesher.Mesh()
+        mesh.add_stdnode(1, [[[1, 0.2, 0.1], [2, 0.55, 0.11]]])
+        mesh.add_stdnode('weights', [1, 0.0, 0.0])
+        mesh.add_stdnode('variance', [1, 1., 1.])
+        node = mesher.PCANode(mesh, 2, 1, 'weights', 'variance')
+        mesh.nodes.add(node)
+        mesh.generate()
+        npt.assert_almost_equal(node.values, [[1, 2]])
+        mesh.nodes[1].values = numpy.array([[[2, 0.2, 0.1], [7, 0.55, 0.11]]])
+        mesh.update(force=True)
+        npt.assert_almost_equal(node.values, [[2, 7]])
+        Ps = mesh.core.update_batch(numpy.array([mesh.core.P]))
+        npt.assert_almost_equal(Ps[0], mesh.core.P)
+
     def test_node_init_list(self):
         mesh = mesher.Mesh()
         Xpca = [[[1, 0.2, 0.1], [2, 0.55, 0.11]],
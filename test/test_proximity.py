@@ -0,0 +1,107 @@
+import sys
+import unittest
+
+import numpy
+import numpy.testing as npt
+
+sys.path.append('..')
+from morphic import core
+from morphic import mesher
+from morphic import proximity
+
+
+def create_mesh(nx=6, ny=4):
+    mesh = mesher.Mesh()
+    nid = 0
+    for j in range(2 * ny + 1):
+        for i in range(2 * nx + 1):
+            nid += 1
+            mesh.add_stdnode(nid, [0.25 * i, 0.25 * j,
+                                   0.2 * numpy.sin(0.5 * i + 0.3 * j)])
+    eid = 0
+    for j in range(ny):
+        for i in range(nx):
+            eid += 1
+            n0 = 2 * j * (2 * nx + 1) + 2 * i + 1
+            nids = [n0 + r * (2 * nx + 1) + c
+                    for r in range(3) for c in range(3)]
+            mesh.add_element(eid, ['L2', 'L2'], nids)
+    mesh.generate()
+    return mesh
+
+
+def brute_force(mesh, X):
+    Xi = core.basis_xi_grid(['L2', 'L2'], 60)
+    Xs = mesh.evaluate([e.id for e in mesh.elements], Xi)
+    return numpy.sqrt(((X[:, None] - Xs[None]) ** 2).sum(2)).min(1)
+
+
+class TestElementTree(unittest.TestCase):
+    """Unit tests for morphic element trees."""
+
+    def setUp(self):
+        numpy.random.seed(5)
+        self.mesh = create_mesh()
+        self.X = numpy.random.rand(30, 3) * [3., 2., 0.6] - [0., 0., 0.3]
+
+    def test_build(self):
+        tree = proximity.ElementTree(self.mesh)
+        leaves = tree.node_element >= 0
+        self.assertEqual(leaves.sum(), 24)
+        npt.assert_equal(numpy.sort(tree.node_element[leaves]),
+                         numpy.arange(24))
+        for node in numpy.nonzero(~leaves)[0]:
+            for child in tree.children[node]:
+                self.assertTrue((tree.node_lower[node] <=
+                                 tree.node_lower[child]).all())
+                self.assertTrue((tree.node_upper[node] >=
+                                 tree.node_upper[child]).all())
+
+    def test_query(self):
+        tree = proximity.ElementTree(self.mesh)
+        points, elements = tree.candidates(self.X)
+        self.assertLess(points.size, 0.25 * 30 * 24)
+        eids, xi, dist = tree.query(self.X)
+        brute = brute_force(self.mesh, self.X)
+        self.assertTrue((dist <= brute + 1e-8).all())
+        self.assertTrue((dist >= brute - 5e-3).all())
+        Xp = self.mesh.evaluate_points(eids, xi)
+        npt.assert_almost_equal(
+            numpy.sqrt(((Xp - self.X) ** 2).sum(1)), dist)
+
+    def test_refit(self):
+        tree = proximity.ElementTree(self.mesh)
+        eids0, xi0, dist0 = tree.query(self.X)
+        self.mesh._core.P[2::3] *= -2
+        self.assertIs(tree.query(self.X)[2], dist0)
+        self.mesh._core.touch_params()
+        eids, xi, dist = tree.query(self.X)
+        self.assertEqual(tree.param_version,
+                         self.mesh._core.param_version)
+        tree1 = proximity.ElementTree(self.mesh)
+        npt.assert_almost_equal(tree.node_lower, tree1.node_lower)
+        npt.assert_almost_equal(tree.node_upper, tree1.node_upper)
+        brute = brute_force(self.mesh, self.X)
+        self.assertTrue((dist <= brute + 1e-8).all())
+        self.assertTrue((dist >= brute - 5e-3).all())
+
+    def test_mesh_element_tree(self):
+        tree = self.mesh.get_element_tree()
+        self.assertIs(self.mesh.get_element_tree(), tree)
+        self.assertIsNot(self.mesh.get_element_tree(res=2), tree)
+        eids, xi, dist = self.mesh.project(self.X)
+        self.mesh.nodes[1].values = numpy.array([0., 0., 1.])
+        self.assertIs(self.mesh.get_element_tree(), tree)
+        eids1, xi1, dist1 = self.mesh.project(self.X)
+        self.assertGreater(numpy.absolute(dist1 - dist).max(), 0)
+        self.mesh.add_stdnode(200, [0., 0., 0.])
+        self.assertIsNot(self.mesh.get_element_tree(), tree)
+
+    def test_elements(self):
+        tree = proximity.ElementTree(self.mesh, elements=[3, 7])
+        eids, xi, dist = tree.query(self.X)
+        self.assertEqual(set(eids), set([3, 7]))
+
+
+if __name__ == "__main__":
+    unittest.main()
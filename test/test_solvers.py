@@ -0,0 +1,119 @@
+import os
+import sys
+import pickle
+import tempfile
+import unittest
+
+import numpy
+import numpy.testing as npt
+import scipy.sparse
+
+sys.path.append('..')
+from morphic import solvers
+
+
+class TestSolvers(unittest.TestCase):
+    """Unit tests for morphic solvers."""
+
+    def setUp(self):
+        numpy.random.seed(3)
+        A = numpy.random.rand(40, 12)
+        A[A < 0.6] = 0
+        A += numpy.eye(40, 12)
+        self.A = scipy.sparse.csc_matrix(A)
+        self.b = numpy.random.rand(40, 3)
+        self.x = numpy.linalg.lstsq(A, self.b, rcond=None)[0]
+
+    def test_solvers(self):
+        for name in ['lsqr', 'cholesky', 'qr', 'svd', 'inverse']:
+            solver = solvers.get_solver(name)
+            self.assertFalse(solver.factorized)
+            solver.factorize(self.A)
+            self.assertEqual(solver.shape, (40, 12))
+            npt.assert_almost_equal(solver.solve(self.b[:, 0]), self.x[:, 0],
+                                    decimal=5)
+            npt.assert_almost_equal(solver.solve(self.b), self.x, decimal=5)
+
+    def test_sparse_qr_r(self):
+        R = solvers.sparse_qr_r(self.A, chunk_rows=7)
+        Rd = numpy.linalg.qr(self.A.toarray(), mode='r')
+        npt.assert_almost_equal(numpy.abs(R), numpy.abs(Rd))
+        npt.assert_almost_equal(R.T.dot(R), self.A.T.dot(self.A).toarray())
+
+    def test_inverse(self):
+        invA = numpy.linalg.pinv(self.A.toarray())
+        solver = solvers.InverseSolver(invA)
+        self.assertTrue(solver.factorized)
+        self.assertEqual(solver.shape, (40, 12))
+        npt.assert_almost_equal(solver.solve(self.b), self.x)
+
+    def test_cholesky_regularisation(self):
+        solver = solvers.get_solver('cholesky', regularisation=0.5)
+        solver.factorize(self.A)
+        A = self.A.toarray()
+        npt.assert_almost_equal(solver.solve(self.b), numpy.linalg.solve(
+            A.T.dot(A) + 0.5 * numpy.eye(12), A.T.dot(self.b)))
+
+    def test_truncated_svd(self):
+        solver = solvers.SVDSolver(k=4)
+        solver.factorize(self.A)
+        self.assertEqual(solver.S.size, 4)
+        U, S, VT = numpy.linalg.svd(self.A.toarray(), full_matrices=False)
+        x = VT[:4].T.dot(U[:, :4].T.dot(self.b) / S[:4, numpy.newaxis])
+        npt.assert_almost_equal(solver.solve(self.b), x)
+
+    def test_pickle(self):
+        for name in ['lsqr', 'cholesky', 'qr', 'svd', 'inverse']:
+            solver = solvers.get_solver(name)
+            solver.factorize(self.A)
+            solver = pickle.loads(pickle.dumps(solver))
+            npt.assert_almost_equal(solver.solve(self.b), self.x, decimal=5)
+
+    def test_copy(self):
+        for name in ['lsqr', 'cholesky', 'qr', 'svd', 'inverse']:
+            solver = solvers.get_solver(name)
+            solver.factorize(self.A)
+            copied = solver.copy()
+            solver.reset()
+            self.assertTrue(copied.factorized)
+            npt.assert_almost_equal(copied.solve(self.b), self.x, decimal=5)
+
+    def test_save_load(self):
+        solver = solvers.get_solver('cholesky')
+        solver.factorize(self.A)
+        filepath = os.path.join(tempfile.mkdtemp(), 'solver.pkl')
+        solver.save(filepath)
+        solver = solvers.load(filepath)
+        npt.assert_almost_equal(solver.solve(self.b), self.x)
+
+    def test_rank_deficient(self):
+        A = self.A.toarray()
+        A[:, 3] = 0
+        x = numpy.linalg.pinv(A).dot(self.b)
+        solver = solvers.get_solver('svd')
+        solver.factorize(A)
+        npt.assert_almost_equal(solver.solve(self.b), x)
+        solver = solvers.get_solver('cholesky')
+        self.assertRaises(RuntimeError, solver.factorize, A)
+
+    def test_qr_underdetermined(self):
+        solver = solvers.get_solver('qr')
+        self.assertRaises(ValueError, solver.factorize, self.A[:8])
+        solver = solvers.get_solver('svd')
+        solver.factorize(self.A[:8])
+        npt.assert_almost_equal(
+            solver.solve(self.b[:8]),
+            numpy.linalg.pinv(self.A[:8].toarray()).dot(self.b[:8]))
+
+    def test_not_factorized(self):
+        solver = solvers.get_solver('qr')
+        self.assertRaises(RuntimeError, solver.solve, self.b)
+        solver.factorize(self.A)
+        self.assertRaises(ValueError, solver.solve, self.b[:10])
+        solver.reset()
+        self.assertFalse(solver.factorized)
+        self.assertRaises(ValueError, solvers.get_solver, 'cg')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import sys
+import unittest
+
+import numpy
+import numpy.testing as npt
+
+sys.path.append('..')
+from morphic import mesher
+from morphic import utils
+
+
+def create_mesh(dx, dz):
+    mesh = mesher.Mesh()
+    nid = 0
+    for j in range(2):
+        for i in range(3):
+            mesh.add_stdnode(nid + 1, [i + dx[nid], j, dz[nid]])
+            nid += 1
+    mesh.add_element(1, ['L1', 'L1'], [1, 2, 4, 5])
+    mesh.add_element(2, ['L1', 'L1'], [2, 3, 5, 6])
+    mesh.generate()
+    return mesh
+
+
+class TestPCAMesh(unittest.TestCase):
+    """Unit tests for morphic utils PCAMesh."""
+
+    def setUp(self):
+        numpy.random.seed(1)
+        self.pca = utils.PCAMesh()
+        for i in range(6):
+            self.pca.add_mesh(create_mesh(
+                0.1 * numpy.random.randn(6), 0.2 * numpy.random.randn(6)))
+        self.mesh = self.pca.generate(num_modes=3)
+
+    def test_synthesize(self):
+        W = numpy.array([[0., 0., 0.], [1., -0.5, 0.2], [-2., 0.3, 1.]])
+        Ps = self.pca.synthesize(W)
+        self.assertEqual(Ps.shape, (3, self.mesh.core.P.size))
+        for w, P in zip(W, Ps):
+            self.mesh.nodes['weights'].values = numpy.append(1, w)
+            self.mesh.update_pca_nodes()
+            npt.assert_almost_equal(P, self.mesh.core.P)
+
+    def test_synthesize_chunks(self):
+        W = numpy.random.randn(5, 3)
+        Ps = self.pca.synthesize(W)
+        chunks = list(self.pca.synthesize(W, chunk_size=2))
+        self.assertEqual([c.shape[0] for c in chunks], [2, 2, 1])
+        npt.assert_almost_equal(numpy.concatenate(chunks), Ps)
+
+    def test_synthesize_surfaces(self):
+        W = numpy.array([[1., -0.5, 0.2], [-2., 0.3, 1.]])
+        Xs, Ts = self.pca.synthesize_surfaces(W, res=2)
+        for w, X in zip(W, Xs):
+            self.mesh.nodes['weights'].values = numpy.append(1, w)
+            self.mesh.update_pca_nodes()
+            Xm, Tm = self.mesh.get_surfaces(res=2)
+            npt.assert_almost_equal(X, Xm)
+            npt.assert_equal(Ts, Tm)
+
+
+class TestIncrementalPCAMesh(unittest.TestCase):
+    """Unit tests for morphic utils PCAMesh incremental training."""
+
+    def test_incremental_matches_batch(self):
+        numpy.random.seed(2)
+        pca = utils.PCAMesh()
+        ipca = utils.PCAMesh(incremental=True, max_modes=7)
+        for i in range(8):
+            mesh = create_mesh(
+                0.1 * numpy.random.randn(6), 0.2 * numpy.random.randn(6))
+            pca.add_mesh(mesh)
+            ipca.add_mesh(mesh)
+        self.assertEqual(ipca.X, [])
+        self.assertEqual(ipca.num_samples, 8)
+        pca.generate(num_modes=3)
+        imesh = ipca.generate(num_modes=3)
+        npt.assert_almost_equal(ipca.mean, pca.mean)
+        npt.assert_almost_equal(ipca.variance, pca.variance)
+        npt.assert_almost_equal(
+            numpy.abs(numpy.dot(ipca.components.T, pca.components)),
+            numpy.eye(3))
+        imesh.nodes['weights'].values = numpy.array([1, 0., 0., 0.])
+        imesh.update_pca_nodes()
+        X, T = imesh.get_surfaces(res=2)
+        npt.assert_almost_equal(X, pca.mesh.get_surfaces(res=2)[0])
+
+    def test_incremental_batches(self):
+        # A population with 3 modes is fitted exactly in batches
+        numpy.random.seed(3)
+        modes = numpy.random.randn(3, 12)
+        pca = utils.PCAMesh()
+        ipca = utils.PCAMesh(incremental=True, max_modes=4, batch_size=4)
+        for i in range(14):
+            d = numpy.dot(numpy.random.randn(3) * [0.3, 0.1, 0.05], modes)
+            mesh = create_mesh(d[:6], d[6:])
+            pca.add_mesh(mesh)
+            ipca.add_mesh(mesh)
+            self.assertLessEqual(len(ipca.batch), 4)
+        self.assertEqual(ipca.ipca.n_samples_seen_, 12)
+        pca.generate(num_modes=3)
+        ipca.generate(num_modes=3)
+        self.assertEqual(ipca.ipca.n_samples_seen_, 14)
+        npt.assert_almost_equal(ipca.mean, pca.mean)
+        npt.assert_almost_equal(ipca.variance, pca.variance)
+        npt.assert_almost_equal(
+            numpy.abs(numpy.dot(ipca.components.T, pca.components)),
+            numpy.eye(3))
+        self.assertRaises(ValueError, ipca.generate, num_modes=5)
+
+    def test_too_few_samples(self):
+        ipca = utils.PCAMesh(incremental=True)
+        self.assertRaises(ValueError, ipca.generate, num_modes=1)
+        pca = utils.PCAMesh()
+        mesh = create_mesh(numpy.zeros(6), numpy.zeros(6))
+        ipca.add_mesh(mesh)
+        pca.add_mesh(mesh)
+        self.assertRaises(ValueError, ipca.generate, num_modes=1)
+        self.assertRaises(ValueError, pca.generate, num_modes=1)
+
+
+if __name__ == "__main__":
+    unittest.main()